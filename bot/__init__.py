@@ -1,3 +1,6 @@
+import atexit
+import threading
+import time
 from time import sleep
 
 import telebot
@@ -6,17 +9,80 @@ from django_docker_helpers.utils import run_env_once
 from django.conf import settings
 from requests.exceptions import ReadTimeout, ConnectionError
 
-assert settings.BOT['TOKEN'], 'BOT TOKEN unassigned!'
+_bot = None
+_bot_lock = threading.Lock()
+_background_lock = threading.Lock()
+_background_started = False
 
-telebot.logger.setLevel(telebot.logging.INFO)
-telebot.apihelper.proxy = settings.BOT['PROXY']
-bot = telebot.TeleBot(settings.BOT['TOKEN'], threaded=settings.BOT['THREADED'])
+
+def get_bot() -> telebot.TeleBot:
+    """
+    бот создаётся при первом обращении (from bot import bot): приложение bot загружается в каждом процессе django,
+    а токен и настройки telebot нужны только обрабатывающим обновления и отправляющим сообщения
+    """
+    global _bot
+    with _bot_lock:
+        if _bot is None:
+            assert settings.BOT['TOKEN'], 'BOT TOKEN unassigned!'
+
+            telebot.logger.setLevel(telebot.logging.INFO)
+            telebot.apihelper.proxy = settings.BOT['PROXY']
+            telebot.apihelper.API_URL = settings.BOT['API_URL']
+            telebot.apihelper.FILE_URL = settings.BOT['FILE_URL']
+            _bot = telebot.TeleBot(
+                settings.BOT['TOKEN'], threaded=settings.BOT['THREADED'] and settings.BOT['WORKERS'] <= 1
+            )
+    return _bot
+
+
+def __getattr__(name: str):
+    if name == 'bot':
+        return get_bot()
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+
+def start_background_jobs():
+    """
+    фоновые задачи процесса, обрабатывающего обновления (запись статистики и лога, отправка сообщений).
+    Запускаются один раз на процесс (в т.ч. в каждом процессе uwsgi после fork).
+    """
+    global _background_started
+    from bot.logbuffer import log_writer
+    from bot.outbox import outbox
+    from dictionary.stats import StatsFlusher, flush
+
+    with _background_lock:
+        if _background_started:
+            return
+        StatsFlusher(settings.STATS_FLUSH_INTERVAL).start()
+        log_writer.start()
+        atexit.register(flush)
+        atexit.register(outbox.drain, 10)
+        atexit.register(log_writer.flush)
+        _background_started = True
 
 
 @run_env_once
-def run_bot():
+def run_bot(use_async: bool = None):
     from bot import handlers    # NOQA
 
+    use_async = settings.BOT['ASYNC'] if use_async is None else use_async
+    bot = get_bot()
+
+    start_background_jobs()
+    if settings.BOT['WEBHOOK_URL']:
+        # обновления принимает web-сервис (bot.views.webhook), здесь остаются только фоновые задачи
+        print('webhook mode, polling disabled')
+        while 1:
+            sleep(3600)
+
+    bot.remove_webhook()    # getUpdates не работает при установленном webhook
+    if use_async:
+        from bot.aio import run_bot_async
+        return run_bot_async()
+    if settings.BOT['WORKERS'] > 1:
+        return poll_sharded()
+
     while 1:
         try:
             bot.polling(non_stop=True)
@@ -24,3 +90,38 @@ def run_bot():
             print(e)
             print('reconnect in 1s...')
             sleep(1)
+
+
+def poll_sharded():
+    """
+    long polling с обработкой обновлений в нескольких потоках (см. bot.dispatcher.ShardedDispatcher).
+    Пока очередь шарда заполнена, новые обновления не запрашиваются.
+    """
+    from bot.dispatcher import ShardedDispatcher
+    from bot.outbox import outbox
+
+    bot = get_bot()
+    dispatcher = ShardedDispatcher(
+        bot.process_new_updates, settings.BOT['WORKERS'], settings.BOT['WORKER_QUEUE_SIZE']
+    )
+    atexit.register(dispatcher.stop, 10)
+
+    offset = None
+    reported_at = time.monotonic()
+    while 1:
+        try:
+            updates = bot.get_updates(offset=offset, timeout=20, long_polling_timeout=20)
+        except (ReadTimeout, ConnectionError, telebot.apihelper.ApiException) as e:
+            print(e)
+            print('reconnect in 1s...')
+            sleep(1)
+            continue
+
+        for update in updates:
+            dispatcher.put(update)
+            offset = update.update_id + 1
+
+        if time.monotonic() - reported_at > settings.BOT['METRICS_INTERVAL']:
+            reported_at = time.monotonic()
+            print(dispatcher.report())
+            print(outbox.report())
@@ -0,0 +1,173 @@
+"""
+Asyncio-рантайм бота (bot.async в конфиге).
+
+Long polling и все запросы обработчиков к Bot API идут через один event loop и общий пул соединений
+aiohttp (AsyncTeleBot), а сами обработчики (синхронные, с ORM) выполняются через sync_to_async
+в ограниченном пуле потоков. Поток обработчика, ожидающий ответа telegram, не держит event loop,
+поэтому сетевые ожидания и работа с БД разных юзеров перекрываются.
+Обновления одного чата обрабатываются строго по очереди.
+
+Требует aiohttp: poetry install -E async.
+"""
+import asyncio
+import json
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import close_old_connections
+from requests import exceptions as requests_exceptions
+from telebot import apihelper
+from telebot.types import Update
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+from bot import bot
+from bot.dispatcher import get_chat_id
+
+AIOHTTP_MISSING = 'asyncio runtime (bot.async, run_bot --async) requires aiohttp: poetry install -E async'
+
+
+class ApiResponse:
+    """ответ aiohttp в виде, который ожидает telebot.apihelper (как у requests.Response)"""
+
+    def __init__(self, status_code: int, reason: str, text: str):
+        self.status_code = status_code
+        self.reason = reason
+        self.text = text
+
+    def json(self):
+        return json.loads(self.text)
+
+
+class AsyncRuntime:
+
+    def __init__(self, workers: int, concurrency: int, pool_size: int):
+        from telebot import asyncio_helper
+        from telebot.async_telebot import AsyncTeleBot
+
+        asyncio_helper.API_URL = settings.BOT['API_URL'] or asyncio_helper.API_URL
+        asyncio_helper.FILE_URL = settings.BOT['FILE_URL']
+        asyncio_helper.proxy = settings.BOT['PROXY']['https']
+        asyncio_helper.REQUEST_LIMIT = pool_size
+        self.asyncio_helper = asyncio_helper
+        self.async_bot = AsyncTeleBot(settings.BOT['TOKEN'])
+
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='bot-handler')
+        self.concurrency = concurrency
+        self.semaphore: Optional[asyncio.Semaphore] = None
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.loop_thread: Optional[threading.Thread] = None
+        self.tasks = set()
+        self.chat_locks = {}    # chat_id -> [asyncio.Lock, кол-во ожидающих обновлений]
+
+    # запросы к Bot API из синхронных обработчиков
+
+    async def request(self, method: str, url: str, params: dict, timeout) -> ApiResponse:
+        connect_timeout, read_timeout = timeout
+        params = {k: str(v) for k, v in (params or {}).items() if v is not None}
+        session = await self.asyncio_helper.session_manager.get_session()
+        async with session.request(
+            method, url, params=params, proxy=self.asyncio_helper.proxy,
+            timeout=aiohttp.ClientTimeout(sock_connect=connect_timeout, sock_read=read_timeout),
+        ) as response:
+            return ApiResponse(response.status, response.reason, await response.text())
+
+    def send_request(self, method: str, url: str, params=None, files=None, timeout=None, proxies=None):
+        """
+        apihelper.CUSTOM_REQUEST_SENDER: запрос выполняется в event loop через общий пул соединений,
+        поток обработчика ждёт результат
+        """
+        if files or self.loop is None or threading.current_thread() is self.loop_thread:
+            return apihelper._get_req_session().request(
+                method, url, params=params, files=files, timeout=timeout, proxies=proxies)
+        future = asyncio.run_coroutine_threadsafe(self.request(method, url, params, timeout), self.loop)
+        try:
+            return future.result()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            raise as_requests_exception(e) from e
+
+    # обработка обновлений
+
+    @staticmethod
+    def process(update: Update):
+        close_old_connections()
+        try:
+            bot.process_new_updates([update])
+        except Exception:
+            traceback.print_exc()
+        finally:
+            close_old_connections()
+
+    async def handle(self, update: Update):
+        chat_id = get_chat_id(update)
+        lock = self.chat_locks.setdefault(chat_id, [asyncio.Lock(), 0])
+        lock[1] += 1
+        try:
+            async with lock[0]:
+                await sync_to_async(self.process, thread_sensitive=False, executor=self.executor)(update)
+        finally:
+            lock[1] -= 1
+            if not lock[1]:
+                del self.chat_locks[chat_id]
+            self.semaphore.release()
+
+    async def poll(self):
+        self.loop = asyncio.get_running_loop()
+        self.loop_thread = threading.current_thread()
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        apihelper.CUSTOM_REQUEST_SENDER = self.send_request
+
+        offset = None
+        try:
+            while 1:
+                try:
+                    updates = await self.async_bot.get_updates(offset=offset, timeout=20, request_timeout=30)
+                except Exception as e:
+                    print(e)
+                    print('reconnect in 1s...')
+                    await asyncio.sleep(1)
+                    continue
+
+                for update in updates:
+                    # не больше concurrency обновлений в обработке, иначе ждём (и не запрашиваем новые)
+                    await self.semaphore.acquire()
+                    task = asyncio.create_task(self.handle(update))
+                    self.tasks.add(task)
+                    task.add_done_callback(self.tasks.discard)
+                    offset = update.update_id + 1
+        finally:
+            apihelper.CUSTOM_REQUEST_SENDER = None
+            await self.async_bot.close_session()
+
+
+def as_requests_exception(e: Exception) -> requests_exceptions.RequestException:
+    """
+    сетевые ошибки aiohttp в виде исключений requests: их (а не aiohttp) ожидают обработчики,
+    bot.outbox и сам telebot
+    """
+    if isinstance(e, asyncio.TimeoutError):     # в т.ч. aiohttp.ServerTimeoutError
+        return requests_exceptions.ReadTimeout(str(e))
+    if isinstance(e, aiohttp.ClientConnectionError):
+        return requests_exceptions.ConnectionError(str(e))
+    return requests_exceptions.RequestException(str(e))
+
+
+def run_bot_async():
+    if aiohttp is None:
+        raise ImproperlyConfigured(AIOHTTP_MISSING)
+
+    bot.threaded = False    # обработчики выполняются в пуле потоков рантайма
+    runtime = AsyncRuntime(
+        workers=settings.BOT['ASYNC_WORKERS'],
+        concurrency=settings.BOT['ASYNC_CONCURRENCY'],
+        pool_size=settings.BOT['HTTP_POOL_SIZE'],
+    )
+    asyncio.run(runtime.poll())
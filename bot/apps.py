@@ -4,3 +4,15 @@ from django.apps import AppConfig
 class BotAppConfig(AppConfig):
     name = 'bot'
     default_auto_field = 'django.db.models.BigAutoField'
+
+    def ready(self):
+        from django.contrib.auth.models import User
+        from django.db.models.signals import post_save, pre_delete
+        from dictionary.models import Dictionary
+        from . import usercache
+        from .models import TelegramProfile
+
+        post_save.connect(usercache.store_profile, sender=TelegramProfile, dispatch_uid='user_cache_store_profile')
+        post_save.connect(usercache.invalidate_user, sender=User, dispatch_uid='user_cache_invalidate_user')
+        post_save.connect(usercache.invalidate_dictionary, sender=Dictionary, dispatch_uid='user_cache_dict_save')
+        pre_delete.connect(usercache.invalidate_dictionary, sender=Dictionary, dispatch_uid='user_cache_dict_delete')
@@ -0,0 +1,132 @@
+"""
+Параллельная обработка обновлений с сохранением порядка внутри чата.
+
+Обновления шардируются по chat.id между N потоками: обновления одного чата всегда попадают
+в один и тот же поток и обрабатываются строго по очереди (в т.ч. без гонок на TelegramProfile.state),
+а разные чаты обрабатываются параллельно. Очереди потоков ограничены: если очередь шарда заполнена,
+put() ждёт (backpressure), и следующие обновления не запрашиваются у telegram.
+"""
+import queue
+import threading
+import time
+import traceback
+from typing import Callable, List, Optional
+
+from django.db import close_old_connections
+from telebot.types import Update
+
+STOP = object()
+
+
+def get_chat_id(update: Update) -> Optional[int]:
+    """id чата (юзера), к которому относится обновление"""
+    for message in (update.message, update.edited_message, update.channel_post, update.edited_channel_post):
+        if message:
+            return message.chat.id
+    if update.callback_query:
+        message = update.callback_query.message
+        return message.chat.id if message else update.callback_query.from_user.id
+    for member in (update.my_chat_member, update.chat_member, update.chat_join_request):
+        if member:
+            return member.chat.id
+    for query in (update.inline_query, update.chosen_inline_result, update.shipping_query, update.pre_checkout_query):
+        if query:
+            return query.from_user.id
+    if update.poll_answer:
+        return update.poll_answer.user.id
+    return None
+
+
+class Shard(threading.Thread):
+
+    def __init__(self, index: int, process: Callable[[List[Update]], None], queue_size: int):
+        super().__init__(name=f'updates-shard-{index}', daemon=True)
+        self.index = index
+        self.process = process
+        self.queue = queue.Queue(maxsize=queue_size)
+
+        # метрики
+        self.processed = 0
+        self.failed = 0
+        self.busy_time = 0.0    # сек, суммарное время обработки
+        self.max_time = 0.0     # сек, самое долгое обновление
+        self.max_wait = 0.0     # сек, самое долгое ожидание в очереди
+        self.blocked_puts = 0   # сколько раз put() ждал места в очереди
+
+    def run(self):
+        while 1:
+            item = self.queue.get()
+            if item is STOP:
+                return
+            update, queued_at = item
+            started_at = time.monotonic()
+            close_old_connections()
+            try:
+                self.process([update])
+            except Exception:
+                self.failed += 1
+                traceback.print_exc()
+            finally:
+                close_old_connections()
+                finished_at = time.monotonic()
+                self.processed += 1
+                self.busy_time += finished_at - started_at
+                self.max_time = max(self.max_time, finished_at - started_at)
+                self.max_wait = max(self.max_wait, started_at - queued_at)
+
+    def put(self, update: Update):
+        item = (update, time.monotonic())
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            self.blocked_puts += 1
+            self.queue.put(item)
+
+    def metrics(self) -> dict:
+        return {
+            'shard': self.index,
+            'queued': self.queue.qsize(),
+            'processed': self.processed,
+            'failed': self.failed,
+            'avg_time': self.busy_time / self.processed if self.processed else 0.0,
+            'max_time': self.max_time,
+            'max_wait': self.max_wait,
+            'blocked_puts': self.blocked_puts,
+        }
+
+
+class ShardedDispatcher:
+    """
+    process - обработчик пачки обновлений (как правило, bot.process_new_updates у бота с threaded=False)
+    """
+
+    def __init__(self, process: Callable[[List[Update]], None], workers: int, queue_size: int):
+        self.shards = [Shard(i, process, queue_size) for i in range(workers)]
+        for shard in self.shards:
+            shard.start()
+
+    def shard_for(self, update: Update) -> Shard:
+        chat_id = get_chat_id(update)
+        key = chat_id if chat_id is not None else update.update_id
+        return self.shards[key % len(self.shards)]
+
+    def put(self, update: Update):
+        """ставит обновление в очередь шарда, при заполненной очереди ждёт"""
+        self.shard_for(update).put(update)
+
+    def metrics(self) -> List[dict]:
+        return [shard.metrics() for shard in self.shards]
+
+    def report(self) -> str:
+        return '\n'.join(
+            'shard {shard}: queued={queued} processed={processed} failed={failed} '
+            'avg={avg_time:.3f}s max={max_time:.3f}s max_wait={max_wait:.3f}s blocked={blocked_puts}'.format(**m)
+            for m in self.metrics()
+        )
+
+    def stop(self, timeout: float = None):
+        """дожидается обработки уже поставленных в очередь обновлений"""
+        for shard in self.shards:
+            shard.queue.put(STOP)
+        for shard in self.shards:
+            shard.join(timeout)
@@ -1,13 +1,18 @@
 from django.contrib.auth.models import User
 from django.utils.translation import gettext as _
 
-from telebot.types import Message, CallbackQuery
+from telebot.types import Message, CallbackQuery, InlineQuery
 
 from bot import responses
 from bot.models import USER_STATES
-from bot.utils import get_user, CallbackHandler, str_to_int
+from bot.utils import get_user, CallbackHandler
 from bot import bot
-from dictionary.models import Dictionary, Language, Phrase, DictionaryUserStat
+from bot.outbox import outbox
+from bot.usercache import user_cache
+from dictionary.languages import get_registry
+from dictionary.models import Dictionary, Phrase, DictionaryUserStat
+from dictionary.prefix_index import prefix_indexes
+from dictionary.training import TrainingQueue
 
 
 @bot.message_handler(commands=['start'])
@@ -33,8 +38,7 @@ def dict_detail(msg: Message):
 @bot.message_handler(commands=['list_dicts'])
 def list_dicts(msg: Message):
     user = get_user(msg)
-    qs = Dictionary.objects.for_user(user)
-    responses.dict_list(qs).answer_to(msg)
+    responses.dict_list(user).answer_to(msg)
 
 
 @bot.message_handler(commands=['help'])
@@ -45,86 +49,99 @@ def readme(msg: Message):
 
 @CallbackHandler
 def list_dicts_callback(callback: CallbackQuery, user: User):
-    qs = Dictionary.objects.for_user(user)
-    responses.dict_list(qs).replace_prev(callback)
+    responses.dict_list(user).replace_prev(callback)
 
 
 @CallbackHandler
-def select_dictionary(callback: CallbackQuery, user: User, dict_id: str):
+def list_dicts_page(callback: CallbackQuery, user: User, cursor: int, direction: int):
+    responses.dict_list(user, cursor=cursor, direction=direction).replace_prev(callback)
+
+
+@CallbackHandler
+def select_dictionary(callback: CallbackQuery, user: User, dict_id: int):
     qs = Dictionary.objects.for_user(user)
     dictionary = qs.filter(id=dict_id).first()
     if dictionary:
         responses.dictionary_detail(dictionary, user).replace_prev(callback)
     else:
-        responses.dict_list(qs, text=_('Dictionary not found.')).replace_prev(callback)
+        responses.dict_list(user, text=_('Dictionary not found.')).replace_prev(callback)
 
 
 @CallbackHandler
-def dict_contents(callback: CallbackQuery, user: User, dict_id: str, offset: str, count: str, src_lang_id: str, dst_lang_id: str):
+def dict_contents(callback: CallbackQuery, user: User, dict_id: int, offset: int, count: int, src_lang_id: int, dst_lang_id: int):
+    # кнопки со смещением в ранее отправленных сообщениях открывают первую страницу
+    dict_contents_page.func(callback, user, dict_id, 1, 0, 1, count, src_lang_id, dst_lang_id)
+
+
+@CallbackHandler
+def dict_contents_page(callback: CallbackQuery, user: User, dict_id: int, page: int, cursor: int, direction: int, count: int,
+                       src_lang_id: int, dst_lang_id: int):
     qs = Dictionary.objects.for_user(user)
     dictionary = qs.filter(id=dict_id).first()
-    src_lang = Language.objects.filter(id=src_lang_id).first()
-    dst_lang = Language.objects.filter(id=dst_lang_id).first()
+    src_lang = get_registry().get(src_lang_id)
+    dst_lang = get_registry().get(dst_lang_id)
 
     if dictionary and src_lang and dst_lang:
         responses.dict_contents(
-            dictionary, offset=str_to_int(offset), count=str_to_int(count), src_lang=src_lang, dst_lang=dst_lang
+            dictionary, src_lang, dst_lang, page=page, cursor=cursor, direction=direction, count=count
         ).replace_prev(callback)
     else:
-        responses.dict_list(qs, text=_('Language or dictionary not found.')).replace_prev(callback)
+        responses.dict_list(user, text=_('Language or dictionary not found.')).replace_prev(callback)
 
 
 @CallbackHandler
-def delete_dictionary_request(callback: CallbackQuery, user: User, dict_id: str):
+def delete_dictionary_request(callback: CallbackQuery, user: User, dict_id: int):
     qs = Dictionary.objects.for_user(user)
     dictionary = qs.filter(id=dict_id).first()
     if dictionary and user.has_perm('delete_dictionary', dictionary):
         responses.delete_dictionary_request(dictionary).replace_prev(callback)
     else:
-        responses.dict_list(qs, text=_('Dictionary not found.')).replace_prev(callback)
+        responses.dict_list(user, text=_('Dictionary not found.')).replace_prev(callback)
 
 
 @CallbackHandler
-def dict_delete_confirm(callback: CallbackQuery, user: User, dict_id: str):
+def dict_delete_confirm(callback: CallbackQuery, user: User, dict_id: int):
     qs = Dictionary.objects.for_user(user)
     dictionary = qs.filter(id=dict_id).first()
     if dictionary and user.has_perm('delete_dictionary', dictionary):
+        prefix_indexes.invalidate_dictionary(dictionary)
         dictionary.delete()
         text = _('Dictionary deleted.')
     else:
         text = _('Dictionary not found.')
-    responses.dict_list(qs, text=text).replace_prev(callback)
+    responses.dict_list(user, text=text).replace_prev(callback)
 
 
 @CallbackHandler
-def dict_training(callback: CallbackQuery, user: User, dict_id: str, src_lang_id: str, dst_lang_id: str):
+def dict_training(callback: CallbackQuery, user: User, dict_id: int, src_lang_id: int, dst_lang_id: int):
     qs = Dictionary.objects.for_user(user)
     dictionary = qs.filter(id=dict_id).first()
-    src_lang = Language.objects.filter(id=src_lang_id).first()
-    dst_lang = Language.objects.filter(id=dst_lang_id).first()
+    src_lang = get_registry().get(src_lang_id)
+    dst_lang = get_registry().get(dst_lang_id)
 
     if dictionary and src_lang and dst_lang:
-        DictionaryUserStat.objects.get_training_stat_for_user(dictionary, user).delete()
+        DictionaryUserStat.objects.get_training_stat_for_user(dictionary, user).reset()
+        TrainingQueue.for_training(user, dictionary, src_lang, dst_lang).build()
 
         responses.training(user, dictionary, src_lang, dst_lang).answer_to_callback(callback)
     else:
-        responses.dict_list(qs, text=_('Language or dictionary not found.')).replace_prev(callback)
+        responses.dict_list(user, text=_('Language or dictionary not found.')).replace_prev(callback)
 
 
 @CallbackHandler
-def dict_training_phrase(callback: CallbackQuery, user: User, dict_id: str, phrase_id: str, dst_lang_id: str, is_guessed: str):
+def dict_training_phrase(callback: CallbackQuery, user: User, dict_id: int, phrase_id: int, dst_lang_id: int, is_guessed: bool):
     qs = Dictionary.objects.for_user(user)
     dictionary = qs.filter(id=dict_id).first()
     phrase = Phrase.objects.filter(id=phrase_id, phrase_groups__dictionaries=dictionary).first()
-    dst_lang = Language.objects.filter(id=dst_lang_id).first()
+    dst_lang = get_registry().get(dst_lang_id)
 
     if not (dictionary and phrase and dst_lang):
-        return responses.dict_list(qs, text=_('Language or phrase not found.')).replace_prev(callback)
+        return responses.dict_list(user, text=_('Language or phrase not found.')).replace_prev(callback)
 
-    phrase.guessed_or_not(user, dictionary, int(is_guessed))
+    phrase.guessed_or_not(user, dictionary, is_guessed, dst_lang)
 
     # убираем клавиатуру в предыдущем сообщении и показываем перевод
-    bot.edit_message_text(
+    outbox.edit_message_text(
         phrase.verbose_translations(dst_lang),
         chat_id=callback.message.chat.id,
         message_id=callback.message.message_id,
@@ -138,12 +155,12 @@ def dict_training_phrase(callback: CallbackQuery, user: User, dict_id: str, phra
 
 
 @CallbackHandler
-def training_done(callback: CallbackQuery, user: User, dict_id: str):
+def training_done(callback: CallbackQuery, user: User, dict_id: int):
     qs = Dictionary.objects.for_user(user)
     dictionary = qs.filter(id=dict_id).first()
 
     if not dictionary:
-        return responses.dict_list(qs, text=_('Dictionary not found.')).answer_to_callback(callback)
+        return responses.dict_list(user, text=_('Dictionary not found.')).answer_to_callback(callback)
 
     stats = dictionary.get_user_training_stats(user)
     responses.training_done(stats).answer_to_callback(callback)
@@ -161,9 +178,24 @@ def answer(msg: Message):
         responses.search_translations(user, msg.text).answer_to(msg)
 
 
+@bot.message_handler(content_types=['document'])
+def import_document(msg: Message):
+    user = get_user(msg)
+    # id сообщения нужен для обновления прогресса, поэтому ждём отправки
+    status = outbox.send_message(msg.chat.id, _('Importing phrases...'), reply_to_message_id=msg.message_id).result()
+    responses.import_phrases_document(user, msg, status).replace_message(msg, status)
+
+
 @bot.edited_message_handler()
 def edit(msg: Message):
     user = get_user(msg, update_state=False)
     resp = responses.replace_phrase_groups(user, msg)
     if resp.text:
         resp.answer_to(msg)
+
+
+@bot.inline_handler(func=lambda query: bool(query.query.strip()))
+def inline_search(query: InlineQuery):
+    user = user_cache.load(query.from_user.id)
+    results = responses.inline_translations(user, query.query) if user else []
+    bot.answer_inline_query(query.id, results, is_personal=True, cache_time=10)
@@ -1,26 +1,32 @@
-from math import ceil, floor
+from typing import List
 
 from django.contrib.auth.models import User
 from django.utils.translation import gettext as _
-from django.db.models import QuerySet
 from django.conf import settings
 
 from telebot.types import InlineKeyboardMarkup
 
 from bot import handlers
 from dictionary.models import Dictionary, Language, Phrase
-from dictionary.querysets import PhraseQuerySet
 
 
-def dict_list(qs: QuerySet) -> InlineKeyboardMarkup:
+def dict_list(dictionaries: List[Dictionary], has_prev: bool, has_next: bool) -> InlineKeyboardMarkup:
+    """страница списка словарей: курсор - первый (назад) или последний (вперёд) словарь страницы"""
     keyboard = InlineKeyboardMarkup()
 
     buttons = [
         handlers.select_dictionary(d.name, d.id)
-        for d in qs[:6]   # TODO: pagination
+        for d in dictionaries
     ]
-
     keyboard.add(*buttons)
+
+    actions = []
+    if has_prev:
+        actions.append(handlers.list_dicts_page('«', cursor=dictionaries[0].id, direction=-1))
+    if has_next:
+        actions.append(handlers.list_dicts_page('»', cursor=dictionaries[-1].id, direction=1))
+    if actions:
+        keyboard.row(*actions)
     return keyboard
 
 
@@ -33,10 +39,10 @@ def dictionary_actions(d: Dictionary, user: User) -> InlineKeyboardMarkup:
                 _('Start training {0}-{1}').format(src.code.upper(), dst.code.upper()),
                 dict_id=d.id, src_lang_id=src.id, dst_lang_id=dst.id
             ),
-            handlers.dict_contents(
+            handlers.dict_contents_page(
                 _('View {0}-{1} contents').format(src.code.upper(), dst.code.upper()),
                 dict_id=d.id, src_lang_id=src.id, dst_lang_id=dst.id,
-                offset=0, count=settings.DICT_CONTENTS_PAGE_SIZE
+                page=1, cursor=0, direction=1, count=settings.DICT_CONTENTS_PAGE_SIZE
             )
         )
 
@@ -58,25 +64,26 @@ def delete_dictionary_confirm(d: Dictionary) -> InlineKeyboardMarkup:
     return kb
 
 
-# noinspection PyTypeChecker
-def dict_contents_paginator(d: Dictionary, queryset: PhraseQuerySet, offset: int, count: int, src_lang: Language, dst_lang: Language) -> InlineKeyboardMarkup:
-    total_count = queryset.count()
-    params = dict(count=count, src_lang_id=src_lang.id, dst_lang_id=dst_lang.id)
-    page = floor(offset / count) + 1
-    last_page = ceil(total_count / count)
+def dict_contents_paginator(d: Dictionary, phrases: List[Phrase], page: int, last_page: int, count: int,
+                            src_lang: Language, dst_lang: Language) -> InlineKeyboardMarkup:
+    """навигация по страницам: курсор - первая (назад) или последняя (вперёд) фраза текущей страницы"""
+    params = dict(dict_id=d.id, count=count, src_lang_id=src_lang.id, dst_lang_id=dst_lang.id)
     actions = []
 
     if page > 1:
-        actions.append(handlers.dict_contents(_('Page 1'), dict_id=d.id, offset=0, **params))
+        actions.append(handlers.dict_contents_page(_('Page 1'), page=1, cursor=0, direction=1, **params))
 
         if page > 2:
-            actions.append(handlers.dict_contents(_('Page %d') % (page - 1), dict_id=d.id, offset=offset - count, **params))
+            actions.append(handlers.dict_contents_page(
+                _('Page %d') % (page - 1), page=page - 1, cursor=phrases[0].id, direction=-1, **params))
 
     if page < last_page:
         if page < last_page - 1:
-            actions.append(handlers.dict_contents(_('Page %d') % (page + 1), dict_id=d.id, offset=offset + count, **params))
+            actions.append(handlers.dict_contents_page(
+                _('Page %d') % (page + 1), page=page + 1, cursor=phrases[-1].id, direction=1, **params))
 
-        actions.append(handlers.dict_contents(_('Page %d') % last_page, dict_id=d.id, offset=(last_page - 1) * count, **params))
+        actions.append(handlers.dict_contents_page(
+            _('Page %d') % last_page, page=last_page, cursor=0, direction=-1, **params))
 
     actions.append(handlers.select_dictionary(_('Back'), d.id))
     kb = InlineKeyboardMarkup()
@@ -0,0 +1,110 @@
+"""
+Буферизованная запись TelegramLogEntry.
+
+Ответ юзеру не ждёт INSERT в лог: записи копятся в памяти процесса и пишутся фоновым потоком
+одним bulk_create, как только накопится LOG_FLUSH_BATCH записей или пройдёт LOG_FLUSH_INTERVAL сек.
+Буфер ограничен (LOG_BUFFER_SIZE): если БД не успевает, самые старые записи отбрасываются,
+но ответы не блокируются. При завершении процесса остаток сбрасывается (flush через atexit).
+"""
+import logging
+import threading
+from collections import deque
+from typing import List, Optional
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.db.models import Case, DateTimeField, Value, When
+
+from bot.models import TelegramLogEntry, TelegramProfile
+
+logger = logging.getLogger(__name__)
+
+
+class LogWriter:
+    """
+    Фоновый поток запускается из bot.start_background_jobs (см. start): до этого записи только копятся в буфере,
+    так что web-процессы без обработки обновлений и тесты не пишут в БД из другого потока.
+    """
+
+    def __init__(self, batch_size: int, interval: float, max_size: int):
+        self.batch_size = batch_size
+        self.interval = interval
+        self.entries = deque(maxlen=max_size)
+        self.condition = threading.Condition()
+        self.flush_lock = threading.Lock()
+        self.thread: Optional[threading.Thread] = None
+        self.started = False
+
+        # метрики
+        self.written = 0
+        self.dropped = 0
+
+    def start(self):
+        with self.condition:
+            self.started = True
+            self.ensure_running()
+
+    def ensure_running(self):
+        """запускает поток, в т.ч. заново, если он завершился (вызывается под self.condition)"""
+        if self.started and (self.thread is None or not self.thread.is_alive()):
+            self.thread = threading.Thread(target=self.run, name='log-writer', daemon=True)
+            self.thread.start()
+
+    def add(self, entry: TelegramLogEntry):
+        entry.prepare()
+        with self.condition:
+            self.ensure_running()
+            if len(self.entries) == self.entries.maxlen:
+                self.dropped += 1
+            self.entries.append(entry)
+            if len(self.entries) >= self.batch_size:
+                self.condition.notify()
+
+    def run(self):
+        while 1:
+            with self.condition:
+                self.condition.wait_for(lambda: len(self.entries) >= self.batch_size, timeout=self.interval)
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('log writer: flush failed')
+            finally:
+                close_old_connections()
+
+    def flush(self):
+        """пишет накопленные записи; ошибки БД только логируются - ответы юзерам от лога не зависят"""
+        with self.flush_lock:
+            with self.condition:
+                batch = list(self.entries)
+                self.entries.clear()
+            if not batch:
+                return
+            try:
+                TelegramLogEntry.objects.bulk_create(batch, batch_size=self.batch_size)
+            except Exception:
+                self.dropped += len(batch)
+                logger.exception('log writer: flush failed, %d entries dropped', len(batch))
+                return
+            self.written += len(batch)
+            try:
+                update_last_action(batch)
+            except Exception:
+                logger.exception('log writer: last action of %d entries not updated', len(batch))
+
+
+def update_last_action(entries: List[TelegramLogEntry]):
+    """TelegramProfile.last_action_dt по записанным в лог ответам, одним UPDATE"""
+    last_action = {}
+    for entry in entries:
+        last_action[entry.profile_id] = max(entry.timestamp, last_action.get(entry.profile_id, entry.timestamp))
+    TelegramProfile.objects.filter(id__in=last_action).update(last_action_dt=Case(
+        *(When(id=profile_id, then=Value(dt)) for profile_id, dt in last_action.items()),
+        output_field=DateTimeField(),
+    ))
+
+
+log_writer = LogWriter(
+    batch_size=settings.LOG_FLUSH_BATCH,
+    interval=settings.LOG_FLUSH_INTERVAL,
+    max_size=settings.LOG_BUFFER_SIZE,
+)
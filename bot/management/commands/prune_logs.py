@@ -0,0 +1,31 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connections, router
+from django.utils import timezone
+
+from bot import partitions
+from bot.models import TelegramLogEntry
+
+
+class Command(BaseCommand):
+    help = 'Delete log entries older than retention period, create upcoming log partitions'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=settings.LOG_RETENTION_DAYS, help='retention period')
+        parser.add_argument('--batch-size', type=int, default=5000)
+
+    def handle(self, *args: tuple, **options: dict):
+        now = timezone.now()
+        before = now - timedelta(days=options['days'])
+        connection = connections[router.db_for_write(TelegramLogEntry)]
+
+        if partitions.is_partitioned(connection):
+            until = partitions.add_months(partitions.month_start(now), settings.LOG_PARTITIONS_AHEAD)
+            print('created partitions:', partitions.create_partitions(connection, now, until))
+            print('dropped partitions:', partitions.drop_partitions(connection, before))
+            print('deleted from default partition:',
+                  partitions.delete_from_default_partition(connection, before, options['batch_size']))
+        else:
+            print('deleted log entries:', partitions.delete_batched(before, options['batch_size']))
@@ -1,4 +1,5 @@
-from django.core.management.base import BaseCommand
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
 
 from bot import run_bot
 
@@ -6,5 +7,14 @@ from bot import run_bot
 class Command(BaseCommand):
     requires_system_checks = []
 
+    def add_arguments(self, parser):
+        parser.add_argument('--async', action='store_true', dest='use_async',
+                            help='asyncio runtime (see bot.aio), requires the "async" extra')
+
     def handle(self, *args: tuple, **options: dict):
-        run_bot()
+        use_async = options['use_async'] or settings.BOT['ASYNC']
+        if use_async:
+            from bot import aio
+            if aio.aiohttp is None:
+                raise CommandError(aio.AIOHTTP_MISSING)
+        run_bot(use_async)
@@ -0,0 +1,29 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from bot import bot
+
+
+class Command(BaseCommand):
+    help = 'Sets (or deletes) telegram webhook, see BOT["WEBHOOK_URL"] and BOT["WEBHOOK_SECRET"] settings'
+    requires_system_checks = []
+
+    def add_arguments(self, parser):
+        parser.add_argument('--delete', action='store_true', help='Delete webhook (e.g. to return to polling)')
+        parser.add_argument('--drop-pending', action='store_true', help='Drop updates not delivered yet')
+
+    def handle(self, *args: tuple, **options: dict):
+        if options['delete']:
+            bot.delete_webhook(drop_pending_updates=options['drop_pending'])
+            self.stdout.write('webhook deleted')
+            return
+
+        if not (settings.BOT['WEBHOOK_URL'] and settings.BOT['WEBHOOK_SECRET']):
+            raise CommandError('bot.webhook.url and bot.webhook.secret must be configured')
+
+        bot.set_webhook(
+            url=settings.BOT['WEBHOOK_URL'],
+            secret_token=settings.BOT['WEBHOOK_SECRET'],
+            drop_pending_updates=options['drop_pending'],
+        )
+        self.stdout.write('webhook set to {}'.format(settings.BOT['WEBHOOK_URL']))
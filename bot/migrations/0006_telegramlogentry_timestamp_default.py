@@ -0,0 +1,19 @@
+# Generated by Django 4.1 on 2026-10-18 06:59
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bot', '0005_alter_telegramlogentry_id_and_more'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='telegramlogentry',
+            name='timestamp',
+            field=models.DateTimeField(default=django.utils.timezone.now, editable=False),
+        ),
+    ]
@@ -0,0 +1,76 @@
+# Generated by Django 4.1 on 2026-10-18 07:00
+
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+from django.utils import timezone
+
+from bot.partitions import LOG_TABLE, DEFAULT_PARTITION, add_months, create_partitions, month_start
+
+
+def fill_last_action(apps, schema_editor):
+    TelegramProfile = apps.get_model('bot', 'TelegramProfile')
+    TelegramLogEntry = apps.get_model('bot', 'TelegramLogEntry')
+
+    TelegramProfile.objects.update(last_action_dt=Subquery(
+        TelegramLogEntry.objects.filter(profile=OuterRef('pk')).order_by('-timestamp').values('timestamp')[:1]
+    ))
+
+
+def partition_log_table(apps, schema_editor):
+    """
+    postgresql: таблица лога заменяется на партиционированную по месяцам (timestamp), записи копируются.
+    Первичный ключ партиционированной таблицы обязан включать ключ партиционирования: (id, timestamp).
+    """
+    connection = schema_editor.connection
+    if connection.vendor != 'postgresql':
+        return
+
+    with connection.cursor() as cursor:
+        cursor.execute(f'SELECT MIN("timestamp"), MAX(id) FROM {LOG_TABLE}')
+        first_timestamp, max_id = cursor.fetchone()
+
+    now = timezone.now()
+    schema_editor.execute(f'ALTER TABLE {LOG_TABLE} RENAME TO {LOG_TABLE}_old')
+    schema_editor.execute(f'''
+        CREATE TABLE {LOG_TABLE} (
+            id bigint GENERATED BY DEFAULT AS IDENTITY,
+            text text NOT NULL,
+            text_length integer NOT NULL,
+            response varchar(128) NOT NULL,
+            version varchar(64) NOT NULL,
+            "timestamp" timestamp with time zone NOT NULL,
+            profile_id bigint NOT NULL,
+            CONSTRAINT {LOG_TABLE}_partitioned_pkey PRIMARY KEY (id, "timestamp"),
+            CONSTRAINT {LOG_TABLE}_partitioned_profile_id_fk FOREIGN KEY (profile_id)
+                REFERENCES bot_telegramprofile (id) DEFERRABLE INITIALLY DEFERRED
+        ) PARTITION BY RANGE ("timestamp")
+    ''')
+    schema_editor.execute(f'CREATE INDEX {LOG_TABLE}_profile_timestamp ON {LOG_TABLE} (profile_id, "timestamp")')
+    schema_editor.execute(f'CREATE TABLE {DEFAULT_PARTITION} PARTITION OF {LOG_TABLE} DEFAULT')
+    create_partitions(connection, first_timestamp or now, add_months(month_start(now), 2))
+
+    schema_editor.execute(f'''
+        INSERT INTO {LOG_TABLE} (id, text, text_length, response, version, "timestamp", profile_id)
+        SELECT id, text, text_length, response, version, "timestamp", profile_id FROM {LOG_TABLE}_old
+    ''')
+    schema_editor.execute(f'DROP TABLE {LOG_TABLE}_old')
+    if max_id:
+        schema_editor.execute(f"SELECT setval(pg_get_serial_sequence('{LOG_TABLE}', 'id'), %s)", [max_id])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bot', '0006_telegramlogentry_timestamp_default'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='telegramprofile',
+            name='last_action_dt',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.RunPython(fill_last_action, migrations.RunPython.noop),
+        # обратно партиционированная таблица не преобразуется: django с ней работает так же
+        migrations.RunPython(partition_log_table, migrations.RunPython.noop),
+    ]
@@ -1,10 +1,7 @@
-from datetime import datetime
-from typing import Optional
-
 from django.contrib.auth.models import User
 from django.db import models
 from django.db.models import SET_NULL, CASCADE
-from django.utils.functional import cached_property
+from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 
 from model_utils import Choices
@@ -27,6 +24,7 @@ class TelegramProfile(TimeStampedModel):
     user = models.OneToOneField(User, on_delete=CASCADE, related_name='tg')
     state = models.CharField(choices=USER_STATES, default=USER_STATES.wait_nothing, max_length=64)
     current_dict = models.ForeignKey('dictionary.Dictionary', blank=True, null=True, on_delete=SET_NULL)
+    last_action_dt = models.DateTimeField(blank=True, null=True, editable=False)    # время последней записи в лог
 
     class Meta:
         verbose_name = _('Profile')
@@ -39,16 +37,12 @@ class TelegramProfile(TimeStampedModel):
         if self.state != state:
             self.state = state
             if save:
-                self.save()
+                # профиль может быть из кэша (bot.usercache), остальные поля в нём могут быть устаревшими
+                self.save(update_fields=['state', 'modified'])
 
     def reset_state(self, save=True):
         self.set_state(USER_STATES.wait_nothing, save)
 
-    @cached_property
-    def last_action_dt(self) -> Optional[datetime]:
-        last_log_entry = self.logs.only('timestamp').last()
-        return last_log_entry.timestamp if last_log_entry else None
-
 
 class TelegramLogEntry(models.Model):
     profile = models.ForeignKey(TelegramProfile, on_delete=CASCADE, related_name='logs')
@@ -56,7 +50,7 @@ class TelegramLogEntry(models.Model):
     text_length = models.IntegerField(default=0)
     response = models.CharField(help_text=_('Response to user'), max_length=128)
     version = models.CharField(max_length=64, default=current_version, editable=False)
-    timestamp = models.DateTimeField(auto_now_add=True)
+    timestamp = models.DateTimeField(default=timezone.now, editable=False)   # время ответа, а не записи в БД
 
     class Meta:
         verbose_name = _('Log entry')
@@ -65,10 +59,14 @@ class TelegramLogEntry(models.Model):
     def __str__(self):
         return _('LogEntry #{0}').format(self.id)
 
-    def save(self, *args, **kwargs):
+    def prepare(self):
+        """обрезка текстов до записи (в т.ч. через bulk_create, который не вызывает save)"""
         self.text_length = len(self.text)
         self.text = self.text[:128]
         self.response = self.response[:128]
+
+    def save(self, *args, **kwargs):
+        self.prepare()
         return super().save(*args, **kwargs)
 
 
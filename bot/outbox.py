@@ -0,0 +1,257 @@
+"""
+Очередь исходящих сообщений с учётом ограничений telegram.
+
+Поток-диспетчер выбирает сообщения с учётом ограничений скорости (token bucket) глобально
+и для каждого чата, а отправляют их параллельно потоки пула (запросы к Bot API не ждут друг друга).
+Порядок внутри чата сохраняется: следующее сообщение чата не отправляется, пока не завершена отправка
+предыдущего. На 429 (flood control) чат ставится на паузу на retry_after сек, и сообщение отправляется
+повторно. Из нескольких ожидающих отправки правок одного сообщения отправляется только последняя.
+"""
+import logging
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Optional
+
+from django.conf import settings
+from telebot.apihelper import ApiTelegramException
+
+from bot import bot
+
+MAX_IDLE_BUCKETS = 1000
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now: float) -> float:
+        """сколько ждать до появления токена"""
+        self.refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+    def is_full(self, now: float) -> bool:
+        self.refill(now)
+        return self.tokens >= self.capacity
+
+
+class Job:
+
+    def __init__(self, chat_id: int, method: str, kwargs: dict, message_id: Optional[int] = None):
+        self.chat_id = chat_id
+        self.method = method    # метод TeleBot
+        self.kwargs = kwargs
+        self.message_id = message_id    # для правок сообщения
+        self.future = Future()
+        self.queued_at = time.monotonic()
+
+
+class Outbox:
+
+    def __init__(self, global_rate: float, chat_rate: float, chat_burst: float, workers: int):
+        self.thread: Optional[threading.Thread] = None     # диспетчер
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='outbox-send')
+        self.condition = threading.Condition()
+        self.chats = OrderedDict()  # chat_id -> deque[Job], порядок - очередь обхода чатов
+        self.edits = {}     # (chat_id, message_id) -> ожидающая отправки правка
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_buckets = {}
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.paused_until = {}  # chat_id -> time.monotonic()
+        self.sending = set()    # чаты, сообщение которых отправляется сейчас
+
+        # метрики
+        self.sent = 0
+        self.failed = 0
+        self.coalesced = 0
+        self.throttled = 0  # ответов 429
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+    # постановка в очередь
+
+    def submit(self, job: Job) -> Future:
+        with self.condition:
+            self.ensure_running()
+
+            if job.message_id is not None:
+                pending = self.edits.get((job.chat_id, job.message_id))
+                if pending:
+                    pending.kwargs = job.kwargs
+                    self.coalesced += 1
+                    return pending.future
+                self.edits[(job.chat_id, job.message_id)] = job
+
+            self.chats.setdefault(job.chat_id, deque()).append(job)
+            self.condition.notify()
+        return job.future
+
+    def send_message(self, chat_id: int, text: str, **kwargs) -> Future:
+        return self.submit(Job(chat_id, 'send_message', dict(chat_id=chat_id, text=text, **kwargs)))
+
+    def edit_message_text(self, text: str, chat_id: int, message_id: int, **kwargs) -> Future:
+        """правка сообщения; если предыдущая правка этого сообщения ещё не отправлена, она заменяется"""
+        kwargs = dict(text=text, chat_id=chat_id, message_id=message_id, **kwargs)
+        return self.submit(Job(chat_id, 'edit_message_text', kwargs, message_id=message_id))
+
+    def answer_callback_query(self, chat_id: int, callback_query_id: str, **kwargs) -> Future:
+        """ответ на нажатие кнопки (убирает индикатор загрузки), в очереди чата кнопки"""
+        return self.submit(Job(chat_id, 'answer_callback_query', dict(callback_query_id=callback_query_id, **kwargs)))
+
+    # отправка
+
+    def ensure_running(self):
+        """запускает диспетчер, в т.ч. заново, если поток завершился (вызывается под self.condition)"""
+        if self.thread is None or not self.thread.is_alive():
+            self.thread = threading.Thread(target=self.run, name='outbox', daemon=True)
+            self.thread.start()
+
+    def next_job(self):
+        """(следующее сообщение, которое можно отправить сейчас, или None; сколько ждать, если нечего)"""
+        now = time.monotonic()
+        wait = self.global_bucket.wait_time(now)
+        if wait:
+            return None, wait
+
+        wait = None
+        for chat_id, jobs in self.chats.items():
+            if chat_id in self.sending:
+                continue
+            chat_wait = max(
+                self.paused_until.get(chat_id, 0) - now,
+                self.get_chat_bucket(chat_id).wait_time(now),
+            )
+            if chat_wait <= 0:
+                job = jobs.popleft()
+                if not jobs:
+                    del self.chats[chat_id]
+                else:
+                    self.chats.move_to_end(chat_id)
+                if job.message_id is not None:
+                    del self.edits[(job.chat_id, job.message_id)]
+                self.paused_until.pop(chat_id, None)
+                self.global_bucket.take()
+                self.chat_buckets[chat_id].take()
+                return job, 0
+            wait = chat_wait if wait is None else min(wait, chat_wait)
+        return None, wait
+
+    def get_chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self.chat_buckets) > len(self.chats) + MAX_IDLE_BUCKETS:
+                now = time.monotonic()
+                self.chat_buckets = {
+                    k: b for k, b in self.chat_buckets.items() if k in self.chats or not b.is_full(now)
+                }
+            bucket = self.chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    def run(self):
+        while 1:
+            with self.condition:
+                job, wait = self.next_job()
+                if job is None:
+                    self.condition.wait(wait)
+                    continue
+                self.sending.add(job.chat_id)
+            try:
+                self.executor.submit(self.send, job)
+            except Exception as e:
+                self.done(job)
+                job.future.set_exception(e)
+                logger.exception('outbox: %s to %s not submitted', job.method, job.chat_id)
+
+    def done(self, job: Job):
+        with self.condition:
+            self.sending.discard(job.chat_id)
+            self.condition.notify_all()
+
+    def send(self, job: Job):
+        """отправка в потоке пула"""
+        try:
+            result = getattr(bot, job.method)(**job.kwargs)
+        except ApiTelegramException as e:
+            if e.error_code == 429:
+                self.retry_later(job, e.result_json.get('parameters', {}).get('retry_after', 1))
+                return
+            self.fail(job, e)
+        except Exception as e:
+            self.fail(job, e)
+        else:
+            latency = time.monotonic() - job.queued_at
+            with self.condition:
+                self.sent += 1
+                self.latency_total += latency
+                self.latency_max = max(self.latency_max, latency)
+            job.future.set_result(result)
+        finally:
+            self.done(job)
+
+    def fail(self, job: Job, e: Exception):
+        """ошибка уходит в future и в лог (с трейсбеком, попадает в sentry): ответы обычно никто не ждёт"""
+        with self.condition:
+            self.failed += 1
+        logger.error('outbox: %s to %s failed', job.method, job.chat_id, exc_info=e)
+        job.future.set_exception(e)
+
+    def retry_later(self, job: Job, retry_after: float):
+        """flood control: чат на паузе retry_after сек, сообщение отправится первым после паузы"""
+        with self.condition:
+            self.throttled += 1
+            self.paused_until[job.chat_id] = time.monotonic() + retry_after
+            if job.message_id is not None:
+                if (job.chat_id, job.message_id) in self.edits:
+                    # пока ждали ответа, пришла более новая правка этого сообщения
+                    job.future.set_result(None)
+                    return
+                self.edits[(job.chat_id, job.message_id)] = job
+            self.chats.setdefault(job.chat_id, deque()).appendleft(job)
+            self.chats.move_to_end(job.chat_id, last=False)
+
+    def drain(self, timeout: float):
+        """ждёт отправки поставленных в очередь сообщений, но не дольше timeout сек"""
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            while (self.chats or self.sending) and time.monotonic() < deadline:
+                self.condition.wait(deadline - time.monotonic())
+
+    def metrics(self) -> dict:
+        with self.condition:
+            depth = sum(len(jobs) for jobs in self.chats.values())
+        return {
+            'depth': depth,
+            'sent': self.sent,
+            'failed': self.failed,
+            'coalesced': self.coalesced,
+            'throttled': self.throttled,
+            'avg_latency': self.latency_total / self.sent if self.sent else 0.0,
+            'max_latency': self.latency_max,
+        }
+
+    def report(self) -> str:
+        return 'outbox: depth={depth} sent={sent} failed={failed} coalesced={coalesced} throttled={throttled} ' \
+               'avg_latency={avg_latency:.3f}s max_latency={max_latency:.3f}s'.format(**self.metrics())
+
+
+outbox = Outbox(
+    global_rate=settings.BOT['SEND_GLOBAL_RATE'],
+    chat_rate=settings.BOT['SEND_CHAT_RATE'],
+    chat_burst=settings.BOT['SEND_CHAT_BURST'],
+    workers=settings.BOT['SEND_WORKERS'],
+)
@@ -0,0 +1,146 @@
+"""
+Хранение лога ответов (TelegramLogEntry) с ограниченным сроком.
+
+В postgresql таблица лога разбита на помесячные партиции по timestamp (см. миграцию 0007),
+удаление старых записей - отсоединение и удаление партиций целиком, без DELETE по строкам.
+Партиции на ближайшие месяцы создаются заранее (./manage.py prune_logs), строки вне имеющихся партиций
+попадают в партицию по умолчанию и переносятся из неё при создании партиции их месяца
+(см. create_partitions). В остальных БД старые записи удаляются пачками.
+"""
+import re
+from datetime import datetime, timezone as dt_timezone
+from typing import List, Tuple
+
+from django.db import transaction
+
+LOG_TABLE = 'bot_telegramlogentry'
+DEFAULT_PARTITION = LOG_TABLE + '_default'
+PARTITION_NAME = LOG_TABLE + '_y{:04d}m{:02d}'
+PARTITION_NAME_RE = re.compile(re.escape(LOG_TABLE) + r'_y(\d{4})m(\d{2})')
+LOG_COLUMNS = 'id, text, text_length, response, version, "timestamp", profile_id'
+
+
+def month_start(dt: datetime) -> datetime:
+    dt = dt.astimezone(dt_timezone.utc)
+    return datetime(dt.year, dt.month, 1, tzinfo=dt_timezone.utc)
+
+
+def add_months(month: datetime, n: int) -> datetime:
+    i = month.year * 12 + month.month - 1 + n
+    return datetime(i // 12, i % 12 + 1, 1, tzinfo=dt_timezone.utc)
+
+
+def is_partitioned(connection) -> bool:
+    if connection.vendor != 'postgresql':
+        return False
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT relkind FROM pg_class WHERE relname = %s', [LOG_TABLE])
+        row = cursor.fetchone()
+    return bool(row) and row[0] == 'p'
+
+
+def get_partitions(connection) -> List[Tuple[str, datetime]]:
+    """помесячные партиции: (имя таблицы, начало месяца), по возрастанию месяца"""
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'SELECT child.relname FROM pg_inherits '
+            'JOIN pg_class parent ON parent.oid = pg_inherits.inhparent '
+            'JOIN pg_class child ON child.oid = pg_inherits.inhrelid '
+            'WHERE parent.relname = %s',
+            [LOG_TABLE]
+        )
+        names = [row[0] for row in cursor.fetchall()]
+
+    partitions = []
+    for name in names:
+        match = PARTITION_NAME_RE.fullmatch(name)
+        if match:
+            partitions.append((name, datetime(int(match[1]), int(match[2]), 1, tzinfo=dt_timezone.utc)))
+    return sorted(partitions, key=lambda p: p[1])
+
+
+def create_partitions(connection, since: datetime, until: datetime) -> List[str]:
+    """создаёт недостающие партиции для месяцев с since по until включительно"""
+    existing = {name for name, _ in get_partitions(connection)}
+    created = []
+    month = month_start(since)
+    while month <= until:
+        name = PARTITION_NAME.format(month.year, month.month)
+        if name not in existing:
+            create_partition(connection, name, month, add_months(month, 1))
+            created.append(name)
+        month = add_months(month, 1)
+    return created
+
+
+def create_partition(connection, name: str, start: datetime, end: datetime):
+    """
+    Партиция для [start, end). postgresql не создаёт партицию, если строки её диапазона уже лежат
+    в партиции по умолчанию: тогда партиция по умолчанию на время переноса строк отсоединяется.
+    """
+    qn = connection.ops.quote_name
+    bounds = [start, end]
+    with transaction.atomic(using=connection.alias), connection.cursor() as cursor:
+        cursor.execute(
+            f'SELECT EXISTS (SELECT 1 FROM {qn(DEFAULT_PARTITION)} WHERE "timestamp" >= %s AND "timestamp" < %s)',
+            bounds
+        )
+        if not cursor.fetchone()[0]:
+            cursor.execute(
+                f'CREATE TABLE {qn(name)} PARTITION OF {qn(LOG_TABLE)} FOR VALUES FROM (%s) TO (%s)', bounds
+            )
+            return
+
+        cursor.execute(f'ALTER TABLE {qn(LOG_TABLE)} DETACH PARTITION {qn(DEFAULT_PARTITION)}')
+        cursor.execute(f'CREATE TABLE {qn(name)} PARTITION OF {qn(LOG_TABLE)} FOR VALUES FROM (%s) TO (%s)', bounds)
+        cursor.execute(
+            f'INSERT INTO {qn(name)} ({LOG_COLUMNS}) SELECT {LOG_COLUMNS} FROM {qn(DEFAULT_PARTITION)} '
+            f'WHERE "timestamp" >= %s AND "timestamp" < %s',
+            bounds
+        )
+        cursor.execute(f'DELETE FROM {qn(DEFAULT_PARTITION)} WHERE "timestamp" >= %s AND "timestamp" < %s', bounds)
+        cursor.execute(f'ALTER TABLE {qn(LOG_TABLE)} ATTACH PARTITION {qn(DEFAULT_PARTITION)} DEFAULT')
+
+
+def drop_partitions(connection, before: datetime) -> List[str]:
+    """отсоединяет и удаляет партиции, целиком лежащие раньше before"""
+    qn = connection.ops.quote_name
+    dropped = []
+    for name, month in get_partitions(connection):
+        if add_months(month, 1) > before:
+            break
+        with transaction.atomic(using=connection.alias), connection.cursor() as cursor:
+            cursor.execute(f'ALTER TABLE {qn(LOG_TABLE)} DETACH PARTITION {qn(name)}')
+            cursor.execute(f'DROP TABLE {qn(name)}')
+        dropped.append(name)
+    return dropped
+
+
+def delete_from_default_partition(connection, before: datetime, batch_size: int) -> int:
+    qn = connection.ops.quote_name
+    deleted = 0
+    while 1:
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'DELETE FROM {qn(DEFAULT_PARTITION)} WHERE ctid IN '
+                f'(SELECT ctid FROM {qn(DEFAULT_PARTITION)} WHERE "timestamp" < %s LIMIT %s)',
+                [before, batch_size]
+            )
+            if not cursor.rowcount:
+                return deleted
+            deleted += cursor.rowcount
+
+
+def delete_batched(before: datetime, batch_size: int) -> int:
+    """удаление записей старше before пачками по batch_size (для БД без партиций)"""
+    from bot.models import TelegramLogEntry
+
+    deleted = 0
+    while 1:
+        # id растут вместе со временем, старые записи находятся в начале индекса первичного ключа
+        ids = list(
+            TelegramLogEntry.objects.filter(timestamp__lt=before).order_by('id').values_list('id', flat=True)[:batch_size]
+        )
+        if not ids:
+            return deleted
+        deleted += TelegramLogEntry.objects.filter(id__in=ids).delete()[0]
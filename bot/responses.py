@@ -1,21 +1,34 @@
 from collections import defaultdict
-from math import ceil, floor
+from math import ceil
+from typing import List, Optional
+import csv
+import time
 
 from django.conf import settings
+from django.core.cache import cache
 from django.contrib.auth.models import User
 from django.utils.translation import gettext as _, ngettext
 from django.db import IntegrityError, transaction
-from django.db.models import QuerySet
+from requests import RequestException
 
-from telebot.types import Message, CallbackQuery
+from telebot.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineQueryResultArticle, InputTextMessageContent
 
+from bot.logbuffer import log_writer
 from bot.models import TelegramLogEntry, TelegramMessageEntity
 from bot import keyboards as kb
 from bot.commands import COMMANDS, commands_as_text
-from bot import bot
-from bot.utils import fix_input_uppercase
+from bot.outbox import outbox
+from bot.utils import fix_input_uppercase, chunks, iter_document_lines
+from dictionary import versions
+from dictionary.access import access_cache
 from dictionary.exceptions import PhraseParseInputError
-from dictionary.models import Dictionary, Language, Phrase, DictionaryUserStat, PhraseGroup
+from dictionary.models import Dictionary, Language, Phrase, DictionaryUserStat, DictionaryUserProgress
+from dictionary.ingest import PhraseImport
+from dictionary.languages import get_registry
+from dictionary.prefix_index import prefix_indexes
+
+DICT_LIST_KEY = 'bot:dict_list:{}:{}:{}:{}'
+DICT_DETAIL_KEY = 'bot:dict_detail:{}:{}:{}:{}:{}:{}'
 
 
 class Response:
@@ -28,28 +41,28 @@ class Response:
         return self.text
 
     def answer_to(self, msg: Message):
-        bot.send_message(
+        outbox.send_message(
             msg.chat.id,
             self.text,
             reply_markup=self.reply_markup,
             parse_mode=self.parse_mode
         )
 
-        TelegramLogEntry(text=msg.text, profile_id=msg.chat.id, response=str(self)).save()
+        log_writer.add(TelegramLogEntry(text=msg.text, profile_id=msg.chat.id, response=str(self)))
 
     def answer_to_callback(self, callback: CallbackQuery):
-        bot.send_message(
+        outbox.send_message(
             callback.message.chat.id,
             self.text,
             reply_markup=self.reply_markup,
             parse_mode=self.parse_mode
         )
 
-        TelegramLogEntry(text=callback.data, profile_id=callback.message.chat.id, response=str(self)).save()
+        log_writer.add(TelegramLogEntry(text=callback.data, profile_id=callback.message.chat.id, response=str(self)))
 
     def replace_prev(self, callback: CallbackQuery):
         msg = callback.message
-        bot.edit_message_text(
+        outbox.edit_message_text(
             self.text,
             chat_id=msg.chat.id,
             message_id=msg.message_id,
@@ -57,7 +70,20 @@ class Response:
             parse_mode=self.parse_mode
         )
 
-        TelegramLogEntry(text=callback.data, profile_id=msg.chat.id, response=str(self)).save()
+        log_writer.add(TelegramLogEntry(text=callback.data, profile_id=msg.chat.id, response=str(self)))
+
+    def replace_message(self, msg: Message, target: Message):
+        """заменяет текст отправленного ранее в ответ на msg сообщения target"""
+        outbox.edit_message_text(
+            self.text,
+            chat_id=target.chat.id,
+            message_id=target.message_id,
+            reply_markup=self.reply_markup,
+            parse_mode=self.parse_mode
+        )
+
+        log_text = msg.text or (msg.document.file_name if msg.document else '') or ''
+        log_writer.add(TelegramLogEntry(text=log_text, profile_id=msg.chat.id, response=str(self)))
 
 
 def commands_list(prepend_text=None, append_text=None) -> Response:
@@ -67,11 +93,11 @@ def commands_list(prepend_text=None, append_text=None) -> Response:
     return Response(text)
 
 
-def select_your_dictionary(qs: QuerySet, text=None) -> Response:
+def select_your_dictionary(reply_markup: InlineKeyboardMarkup, text=None) -> Response:
     text_default = _('Select active dictionary:')
     return Response(
         text=f'{text}\n{text_default}' if text else text_default,
-        reply_markup=kb.dict_list(qs)
+        reply_markup=reply_markup
     )
 
 
@@ -81,8 +107,39 @@ def your_dict_list_is_empty() -> Response:
     )
 
 
-def dict_list(qs: QuerySet, text=None) -> Response:
-    return select_your_dictionary(qs, text) if qs.count() else your_dict_list_is_empty()
+def dict_list_keyboard(user: User, cursor: int, direction: int) -> Optional[InlineKeyboardMarkup]:
+    """
+    страница списка словарей юзера (None - словарей нет), одним запросом.
+    Клавиатура кэшируется по версии прав юзера (см. dictionary.access): создание, удаление, переименование
+    словаря и изменение доступа к нему меняют версию, старые записи просто истекают.
+    """
+    key = DICT_LIST_KEY.format(user.id, access_cache.get_version(user.id), cursor, direction)
+    entry = cache.get(key)
+    if entry is not None:
+        return entry[0]
+
+    count = settings.DICT_LIST_PAGE_SIZE
+    dictionaries = Dictionary.objects.for_user(user).seek(cursor, direction, count + 1)
+    has_more = len(dictionaries) > count
+    if direction >= 0:
+        dictionaries = dictionaries[:count]
+        has_prev, has_next = bool(cursor), has_more
+    else:
+        dictionaries = dictionaries[-count:]
+        has_prev, has_next = has_more, True
+
+    if not dictionaries and cursor:
+        # страница опустела (словари удалены) - показываем первую
+        return dict_list_keyboard(user, 0, 1)
+
+    reply_markup = kb.dict_list(dictionaries, has_prev, has_next) if dictionaries else None
+    cache.set(key, (reply_markup,), timeout=settings.DICT_LIST_CACHE_TIMEOUT)
+    return reply_markup
+
+
+def dict_list(user: User, text=None, cursor=0, direction=1) -> Response:
+    reply_markup = dict_list_keyboard(user, cursor, direction)
+    return select_your_dictionary(reply_markup, text) if reply_markup else your_dict_list_is_empty()
 
 
 def current_dictionary_detail(user: User) -> Response:
@@ -91,20 +148,54 @@ def current_dictionary_detail(user: User) -> Response:
 
 
 def dictionary_detail(dictionary: Dictionary, user: User) -> Response:
-    user.tg.current_dict = dictionary
-    user.tg.save()
+    if user.tg.current_dict_id != dictionary.id:
+        user.tg.current_dict = dictionary
+        user.tg.save(update_fields=['current_dict', 'modified'])
+
+    return cached_response(
+        DICT_DETAIL_KEY.format(dictionary.id, user.id, *get_render_versions(dictionary, user)),
+        lambda: render_dictionary_detail(dictionary, user)
+    )
+
+
+def get_render_versions(dictionary: Dictionary, user: User) -> list:
+    """
+    версии всего, от чего зависит карточка словаря: содержимое словаря, прогресс и права юзера, языки
+    (см. dictionary.versions, dictionary.access, dictionary.languages)
+    """
+    content_key = versions.CONTENT_VERSION_KEY.format(dictionary.id)
+    stats_key = versions.STATS_VERSION_KEY.format(user.id)
+    current = versions.get_versions([content_key, stats_key])
+    return [current[content_key], current[stats_key], access_cache.get_version(user.id), get_registry().version]
 
-    stat = DictionaryUserStat.objects.get_total_stat_for_user(dictionary, user)
+
+def cached_response(key: str, render) -> Response:
+    """
+    ответ из кэша или render() с записью в кэш. Пока один поток рендерит, остальные не ждут блокировку
+    и рендерят сами, без записи (защита от одновременного пересчёта одного ключа)
+    """
+    # stale_cache_timeout обязателен: без него django-redis-cache записывает значение без срока хранения,
+    # а ключи с версиями устаревают при каждом изменении статистики
+    response = cache.get_or_set(
+        key, render, timeout=settings.RENDER_CACHE_TIMEOUT, lock_timeout=settings.RENDER_CACHE_LOCK_TIMEOUT,
+        stale_cache_timeout=0,
+    )
+    return response if response is not None else render()
+
+
+def render_dictionary_detail(dictionary: Dictionary, user: User) -> Response:
+    summary = dictionary.summary
+    trained_phrases = DictionaryUserProgress.objects.trained_phrases(user, dictionary)
     stat_dict = {
-        'all': stat.get_progress()
+        'all': summary.get_progress(trained_phrases)
     }
 
-    for l in dictionary.languages():
-        stat_dict[l.localized_name] = stat.get_progress(l)
+    for l in summary.languages():
+        stat_dict[l.localized_name] = summary.get_progress(trained_phrases, l)
 
     lines = [
         _('Dictionary: <b>%s</b>') % dictionary.name,
-        _('{0} entries').format(dictionary.phrase_groups.count()),
+        _('{0} entries').format(summary.groups_count),
         _('Training progress:')
     ]
 
@@ -139,31 +230,66 @@ def create_dictionary(user: User, name: str) -> Response:
             name=name
         )
         user.tg.current_dict = dictionary
-        user.tg.reset_state()
+        user.tg.reset_state(save=False)
+        user.tg.save(update_fields=['current_dict', 'state', 'modified'])
         return dictionary_detail(dictionary, user)
     except IntegrityError:
         return dictionary_create_error(name)
 
 
-def dict_contents(dictionary: Dictionary, offset: int, count: int, src_lang: Language, dst_lang: Language) -> Response:
+def dict_contents(dictionary: Dictionary, src_lang: Language, dst_lang: Language,
+                  page: int = 1, cursor: int = 0, direction: int = 1, count: int = None) -> Response:
+    """
+    страница содержимого словаря: count фраз после (direction > 0) или перед (direction < 0) фразой cursor,
+    см. PhraseQuerySet.seek. page - номер страницы для отображения.
+    """
+    count = count or settings.DICT_CONTENTS_PAGE_SIZE
     if count < 1 or count > settings.DICT_CONTENTS_PAGE_SIZE * 3:
         return Response(_('Invalid callback data'))
 
-    qs = Phrase.objects.filter(phrase_groups__dictionaries=dictionary, lang=src_lang).order_by('text')
-    total_count = qs.count()
-    text = '\n'.join([
-        phrase.verbose_translations(dst_lang) for phrase in qs[offset:offset+count]
-    ])
+    total_count = dictionary.summary.phrases_count.get(str(src_lang.id), 0)
     if not total_count:
         return Response(_('No phrases found'))
 
-    page = floor(offset / count) + 1
     last_page = ceil(total_count / count)
-    text = _('Page %d/%d\n\n%s') % (page, last_page, text)
+    page = min(max(page, 1), last_page)
+    limit = count
+    if direction < 0 and not cursor:
+        # последняя страница - остаток после полных страниц
+        limit = total_count - (last_page - 1) * count
+
+    # на одну фразу больше: есть ли страницы дальше по направлению (счётчик в сводке может отставать)
+    phrases_qs = Phrase.objects.filter(phrase_groups__dictionaries=dictionary, lang=src_lang).distinct()
+    phrases = phrases_qs.seek(cursor, direction, limit + 1)
+    if cursor and not phrases:
+        # фразы-курсора больше нет (удалена) - показываем первую страницу
+        page, cursor, direction, limit = 1, 0, 1, count
+        phrases = phrases_qs.seek(cursor, direction, limit + 1)
+    if not phrases:
+        return Response(_('No phrases found'))
 
+    has_more = len(phrases) > limit
+    if direction >= 0:
+        phrases = phrases[:limit]
+        last_page = max(last_page, page + 1) if has_more else page
+    else:
+        phrases = phrases[-limit:]
+        if has_more:
+            page = max(page, 2)
+            last_page = max(last_page, page)
+        else:
+            last_page, page = max(last_page - page + 1, 1), 1
+
+    translations = Phrase.objects.translations_in_dictionaries([(dictionary.id, p.id) for p in phrases])
+    lines = []
+    for phrase in phrases:
+        texts = translations.get((dictionary.id, phrase.id), {}).get(dst_lang.id)
+        lines.append('{} - {}'.format(phrase.text, ', '.join(texts)) if texts else phrase.text)
+
+    text = _('Page %d/%d\n\n%s') % (page, last_page, '\n'.join(lines))
     return Response(
         text=text,
-        reply_markup=kb.dict_contents_paginator(dictionary, qs, offset=offset, count=count, src_lang=src_lang, dst_lang=dst_lang)
+        reply_markup=kb.dict_contents_paginator(dictionary, phrases, page, last_page, count, src_lang, dst_lang)
     )
 
 
@@ -178,8 +304,7 @@ def delete_dictionary_request(dictionary: Dictionary) -> Response:
 def training(user: User, dictionary: Dictionary, src_lang: Language, dst_lang: Language) -> Response:
     phrase = Phrase.objects.get_next_for_training(user, dictionary, src_lang, dst_lang)
     if not phrase:
-        qs = Dictionary.objects.for_user(user)
-        return dict_list(qs, _('No available phrases found.'))
+        return dict_list(user, _('No available phrases found.'))
 
     return Response(
         text=phrase.text,
@@ -209,29 +334,23 @@ def add_phrase_groups(user: User, msg: Message) -> Response:
     if not user.has_perm('add_phrasegroup', dictionary):
         return Response(_('Error: you are not allowed to add phrases to dictionary "{}"').format(dictionary))
 
-    groups_count = 0
-    phrases_count = 0
+    importer = PhraseImport(user, dictionary)
     try:
         with transaction.atomic():
             msg_entity, created = TelegramMessageEntity.objects.get_or_create(
                 chat_id=msg.chat.id, message_id=msg.message_id)
 
-            for line in msg.text.split('\n'):
-                line = fix_input_uppercase(line)
-                result = PhraseGroup.create_from_input(line, user)
-
-                new_groups = result['new_groups']
-                new_phrases = result['new_phrases']
-
-                for group in new_groups:
-                    dictionary.phrase_groups.add(group)
-
-                groups_count += len(new_groups)
-                phrases_count += len(new_phrases)
-                msg_entity.phrases.add(*new_phrases)
+            lines = [fix_input_uppercase(line) for line in msg.text.split('\n')]
+            result = importer.add_lines(lines, strict=True)
+            msg_entity.phrases.add(*result.new_phrases)
 
     except PhraseParseInputError as e:
-        return Response(e)
+        return Response(str(e))
+
+    groups_count = result.groups_count
+    phrases_count = result.phrases_count
+    # новые фразы существующих групп попадают и в другие словари этих групп
+    prefix_indexes.invalidate_dictionaries(result.dictionary_ids)
 
     phrases_verbose = '{} {}'.format(phrases_count, ngettext(_('phrase'), _('phrases'), phrases_count))
     groups_verbose = '{} {}'.format(groups_count, ngettext(_('group'), _('groups'), groups_count))
@@ -242,14 +361,69 @@ def add_phrase_groups(user: User, msg: Message) -> Response:
     )
 
 
+def import_phrases_document(user: User, msg: Message, status: Message) -> Response:
+    """
+    импорт фраз из присланного файла (csv/tsv/строки "phrase - translation") пачками строк,
+    ход импорта показывается редактированием сообщения status
+    """
+    dictionary = user.tg.current_dict
+
+    if not dictionary:
+        return commands_list(_('You should select or create dictionary first.'))
+
+    if not user.has_perm('add_phrasegroup', dictionary):
+        return Response(_('Error: you are not allowed to add phrases to dictionary "{}"').format(dictionary))
+
+    if (msg.document.file_size or 0) > settings.IMPORT_MAX_FILE_SIZE:
+        return Response(_('Error: file is too large'))
+
+    importer = PhraseImport(user, dictionary)
+    lines = (fix_input_uppercase(line) for line in iter_document_lines(msg.document))
+    progress_at = time.monotonic()
+    error = None
+    try:
+        for batch in chunks(lines, settings.IMPORT_BATCH_SIZE):
+            importer.add_lines(batch)
+            if time.monotonic() - progress_at > settings.IMPORT_PROGRESS_INTERVAL:
+                progress_at = time.monotonic()
+                outbox.edit_message_text(
+                    _('Importing to dictionary "{}": {} phrases added...').format(
+                        dictionary, importer.result.phrases_count),
+                    chat_id=status.chat.id,
+                    message_id=status.message_id,
+                )
+    except PhraseParseInputError as e:
+        error = str(e)
+    except (UnicodeDecodeError, csv.Error):
+        error = _('Error: failed to read file, expected UTF-8 encoded CSV, TSV or text file')
+    except RequestException:
+        error = _('Error: failed to download file')
+
+    result = importer.result
+    prefix_indexes.invalidate_dictionaries(result.dictionary_ids)
+
+    phrases_verbose = '{} {}'.format(result.phrases_count, ngettext(_('phrase'), _('phrases'), result.phrases_count))
+    groups_verbose = '{} {}'.format(result.groups_count, ngettext(_('group'), _('groups'), result.groups_count))
+    lines = [_('Added {} with {} to dictionary "{}"').format(groups_verbose, phrases_verbose, dictionary)]
+    if result.errors:
+        lines.append(_('Skipped lines: {}').format(len(result.errors)))
+        lines += [f'{line[:64]}: {e}' for line, e in result.errors[:5]]
+    if error:
+        lines.append(error)
+    return Response(text='\n'.join(lines))
+
+
 def replace_phrase_groups(user, msg: Message) -> Response:
     entity = TelegramMessageEntity.objects.filter(chat_id=msg.chat.id, message_id=msg.message_id).first()
 
     if not entity or not entity.phrases.count():
         return Response('Nothing to edit (no phrases found in this message)')
 
+    # удаляемые фразы пропадают из всех словарей своих групп
+    dictionary_ids = set(entity.phrases.values_list('phrase_groups__dictionaries', flat=True)) - {None}
     entity.phrases.delete()
     entity.delete()
+    prefix_indexes.invalidate_dictionaries(dictionary_ids)
     resp = add_phrase_groups(user, msg)
     resp.text = resp.text.replace(_('Added'), _('Edited'))
     return resp
@@ -258,32 +432,52 @@ def replace_phrase_groups(user, msg: Message) -> Response:
 def search_translations(user: User, template: str) -> Response:
     """
     в доступных юзеру словарях ищет фразы, совпадающие с шаблоном и выдаёт переводы
+    (фиксированное число запросов независимо от кол-ва словарей и найденных фраз)
     """
-    dicts = Dictionary.objects.for_user(user)
-    lines_by_dict = defaultdict(list)
+    dicts = list(Dictionary.objects.for_user(user))
     phrases_per_dict_limit = 10
 
-    for dictionary in dicts:
-        phrases = dictionary.phrases.search(template)[:phrases_per_dict_limit]
-        for phrase in phrases:
-            languages = phrase.phrase_groups.filter(dictionaries=dictionary).languages().exclude(id=phrase.lang_id)
-            for lang in languages:
-                translation = ' - {} [{}]'.format(phrase.verbose_translations(lang), lang.code)
-                lines_by_dict[dictionary].append(translation)
+    found = Phrase.objects.search_in_dictionaries(template, [d.id for d in dicts], phrases_per_dict_limit)
+    translations = Phrase.objects.translations_in_dictionaries([(d_id, p_id) for d_id, p_id, text, lang_id in found])
+    languages = get_registry()
+
+    lines_by_dict_id = defaultdict(list)
+    for dictionary_id, phrase_id, text, lang_id in found:
+        for translation_lang_id, texts in translations[(dictionary_id, phrase_id)].items():
+            if translation_lang_id != lang_id:
+                translation = ' - {} - {} [{}]'.format(text, ', '.join(texts), languages.get(translation_lang_id).code)
+                lines_by_dict_id[dictionary_id].append(translation)
 
-    if lines_by_dict:
+    if lines_by_dict_id:
         response_lines = []
-        for num, (dictionary, lines) in enumerate(lines_by_dict.items()):
-            if num:
+        for dictionary in dicts:
+            lines = lines_by_dict_id.get(dictionary.id)
+            if not lines:
+                continue
+            if response_lines:
                 response_lines.append('')
             response_lines += [f'{dictionary.name}:'] + lines
         text = '\n'.join(response_lines)
     else:
-        text = _('No phrases found in %d dictionaries') % dicts.count()
+        text = _('No phrases found in %d dictionaries') % len(dicts)
 
     return Response(text=text)
 
 
+def inline_translations(user: User, template: str) -> List[InlineQueryResultArticle]:
+    """фразы доступных юзеру словарей, начинающиеся с template (для inline-режима)"""
+    entries = prefix_indexes.get(user.id).search(template, settings.INLINE_QUERY_RESULTS_LIMIT)
+    return [
+        InlineQueryResultArticle(
+            id=str(i),
+            title=entry.text,
+            description=entry.translations,
+            input_message_content=InputTextMessageContent(f'{entry.text} - {entry.translations}'),
+        )
+        for i, entry in enumerate(entries)
+    ]
+
+
 def readme() -> Response:
     with open('README.md') as f:
         text = f.read()
@@ -0,0 +1,523 @@
+import asyncio
+import io
+import json
+import threading
+import time
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock, skipIf
+from urllib.parse import parse_qsl, urlsplit
+
+import telebot
+from telebot.types import Update
+from telebot.apihelper import ApiTelegramException
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import CommandError, call_command
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.db.models import QuerySet
+from django.utils import timezone
+
+from requests import exceptions as requests_exceptions
+
+from bot import aio, callback_data, get_bot, handlers, responses
+from bot.dispatcher import ShardedDispatcher, get_chat_id
+from bot.outbox import Outbox, outbox
+from bot.logbuffer import LogWriter, update_last_action
+from bot.models import TelegramLogEntry, TelegramProfile, USER_STATES
+from bot.usercache import user_cache
+from bot.utils import callback_dispatcher, parse_callback_data
+from dictionary.ingest import PhraseImport
+from dictionary.languages import get_registry
+from dictionary.models import Dictionary, DictionarySummary, Phrase
+
+
+class RenderCacheTestCase(TestCase):
+
+    def test_cached_response_expires(self):
+        key = 'test:render:ttl'
+        renders = []
+
+        def render():
+            renders.append(1)
+            return responses.Response('text')
+
+        self.assertEqual(responses.cached_response(key, render).text, 'text')
+        self.assertEqual(responses.cached_response(key, render).text, 'text')
+        self.assertEqual(len(renders), 1)
+
+        ttl = cache.ttl(key)
+        self.assertIsNotNone(ttl, 'rendered response is stored without expiry')
+        self.assertGreater(ttl, 0)
+        self.assertLessEqual(ttl, settings.RENDER_CACHE_TIMEOUT)
+
+
+class UserCacheTestCase(TestCase):
+
+    def setUp(self):
+        user = User.objects.create(username='cached')
+        self.profile = TelegramProfile.objects.create(id=1001, user=user)
+        user_cache.invalidate([self.profile.id])
+
+    def test_cached_profile_keeps_last_action(self):
+        user = user_cache.load(self.profile.id)
+        last_action_dt = timezone.now() - timedelta(minutes=1)
+        update_last_action([TelegramLogEntry(profile_id=self.profile.id, timestamp=last_action_dt)])
+
+        user.tg.set_state(USER_STATES.wait_input__create_dict)
+        responses.dictionary_detail(Dictionary.objects.create(user=user, name='d'), user)
+
+        self.profile.refresh_from_db()
+        self.assertEqual(self.profile.last_action_dt, last_action_dt)
+        self.assertEqual(self.profile.state, USER_STATES.wait_input__create_dict)
+        self.assertEqual(self.profile.current_dict.name, 'd')
+
+
+class LogWriterTestCase(TestCase):
+
+    def setUp(self):
+        user = User.objects.create(username='logged')
+        self.profile = TelegramProfile.objects.create(id=3001, user=user)
+
+    def test_not_started_by_add(self):
+        writer = LogWriter(batch_size=1, interval=1, max_size=10)
+        writer.add(TelegramLogEntry(text='/help', profile_id=self.profile.id, response='help'))
+        self.assertIsNone(writer.thread)
+
+        writer.flush()
+        self.assertEqual(writer.written, 1)
+        self.assertEqual(TelegramLogEntry.objects.filter(profile=self.profile).count(), 1)
+
+    def test_flush_errors_do_not_break_replies(self):
+        writer = LogWriter(batch_size=100, interval=1, max_size=10)
+        writer.add(TelegramLogEntry(text='/help', profile_id=self.profile.id, response='help'))
+        with mock.patch('bot.logbuffer.update_last_action', side_effect=RuntimeError('db is gone')), \
+                self.assertLogs('bot.logbuffer', 'ERROR'):
+            writer.flush()
+        self.assertEqual(writer.written, 1)
+
+        with mock.patch.object(TelegramLogEntry.objects, 'bulk_create', side_effect=RuntimeError('db is gone')), \
+                self.assertLogs('bot.logbuffer', 'ERROR'):
+            writer.add(TelegramLogEntry(text='/help', profile_id=self.profile.id, response='help'))
+            writer.flush()
+        self.assertEqual(writer.dropped, 1)
+
+    def test_dead_thread_restarted(self):
+        writer = LogWriter(batch_size=100, interval=1, max_size=10)
+        with mock.patch.object(writer, 'run'):     # поток сразу завершается
+            writer.start()
+            first = writer.thread
+            first.join()
+            writer.add(TelegramLogEntry(text='/help', profile_id=self.profile.id, response='help'))
+            writer.thread.join()
+        self.assertIsNot(writer.thread, first)
+
+
+class PruneLogsTestCase(TestCase):
+
+    def test_batched_deletion(self):
+        user = User.objects.create(username='logged')
+        profile = TelegramProfile.objects.create(id=3002, user=user)
+        now = timezone.now()
+        TelegramLogEntry.objects.bulk_create(
+            [TelegramLogEntry(profile=profile, text='old', timestamp=now - timedelta(days=40)) for _ in range(7)] +
+            [TelegramLogEntry(profile=profile, text='new', timestamp=now - timedelta(days=1)) for _ in range(3)]
+        )
+
+        delete = QuerySet.delete
+        stdout = io.StringIO()
+        with mock.patch.object(QuerySet, 'delete', autospec=True, side_effect=delete) as deletes, \
+                mock.patch('sys.stdout', stdout):
+            call_command('prune_logs', days=30, batch_size=3)
+
+        self.assertIn('deleted log entries: 7', stdout.getvalue())
+        self.assertEqual(deletes.call_count, 3)
+        self.assertEqual(set(TelegramLogEntry.objects.values_list('text', flat=True)), {'new'})
+        self.assertEqual(TelegramLogEntry.objects.count(), 3)
+
+
+class ShardedDispatcherTestCase(SimpleTestCase):
+
+    @staticmethod
+    def make_update(update_id: int, chat_id: int, kind: str = 'message') -> Update:
+        user = {'id': chat_id, 'is_bot': False, 'first_name': 'user'}
+        message = {'message_id': update_id, 'date': 0, 'chat': {'id': chat_id, 'type': 'private'}, 'text': 'cat'}
+        payload = {
+            'message': message,
+            'edited_message': {**message, 'edit_date': 0},
+            'callback_query': {'id': str(update_id), 'from': user, 'chat_instance': '1', 'data': '', 'message': message},
+            'inline_query': {'id': str(update_id), 'from': user, 'query': 'cat', 'offset': ''},
+        }[kind]
+        return Update.de_json({'update_id': update_id, kind: payload})
+
+    def test_updates_of_chat_processed_in_order_by_one_shard(self):
+        kinds = ['message', 'edited_message', 'callback_query', 'inline_query']
+        updates = [
+            self.make_update(update_id, chat_id, kinds[update_id % len(kinds)])
+            for update_id, chat_id in enumerate([1, 2, 3, 1, 1, 4, 2, 1, 3, 5, 1, 2] * 5)
+        ]
+        processed = []
+
+        def process(batch):
+            for update in batch:
+                time.sleep(0.001)
+                processed.append((get_chat_id(update), threading.current_thread().name, update.update_id))
+
+        dispatcher = ShardedDispatcher(process, workers=3, queue_size=2)
+        for update in updates:
+            dispatcher.put(update)
+        dispatcher.stop(timeout=5)
+
+        self.assertEqual(len(processed), len(updates))
+        shards = {}
+        for chat_id, shard, update_id in processed:
+            shards.setdefault(chat_id, set()).add(shard)
+        self.assertEqual({chat_id: len(names) for chat_id, names in shards.items()}, dict.fromkeys(range(1, 6), 1))
+        self.assertEqual(len(set.union(*shards.values())), 3)
+        for chat_id in shards:
+            update_ids = [update_id for c, shard, update_id in processed if c == chat_id]
+            self.assertEqual(update_ids, sorted(update_ids))
+
+
+class OutboxTestCase(SimpleTestCase):
+    """диспетчер не запускается: очередь разбирается вызовами next_job()/send() из теста"""
+
+    def setUp(self):
+        self.outbox = Outbox(global_rate=1000, chat_rate=1000, chat_burst=10, workers=1)
+        self.api = mock.Mock()
+        patches = [mock.patch.object(Outbox, 'ensure_running'), mock.patch('bot.outbox.bot', self.api)]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def take(self):
+        """следующее сообщение, как его берёт диспетчер"""
+        job, wait = self.outbox.next_job()
+        if job is not None:
+            self.outbox.sending.add(job.chat_id)
+        return job
+
+    def test_pending_edit_coalesced(self):
+        first = self.outbox.edit_message_text('1%', chat_id=1, message_id=10)
+        second = self.outbox.edit_message_text('50%', chat_id=1, message_id=10)
+        self.assertIs(first, second)
+        self.assertEqual(self.outbox.coalesced, 1)
+
+        self.outbox.send(self.take())
+        self.assertIsNone(self.take())
+        self.api.edit_message_text.assert_called_once_with(text='50%', chat_id=1, message_id=10)
+        self.assertEqual(first.result(timeout=1), self.api.edit_message_text.return_value)
+
+        # отправленная правка не заменяется следующей
+        third = self.outbox.edit_message_text('100%', chat_id=1, message_id=10)
+        self.assertIsNot(third, first)
+
+    def test_paused_chat_retried_first(self):
+        self.api.send_message.side_effect = [
+            ApiTelegramException('sendMessage', None, {
+                'error_code': 429, 'description': 'Too Many Requests', 'parameters': {'retry_after': 0.05},
+            }),
+            'b1', 'a1', 'a2',
+        ]
+        a1 = self.outbox.send_message(1, 'a1')
+        a2 = self.outbox.send_message(1, 'a2')
+        b1 = self.outbox.send_message(2, 'b1')
+
+        self.outbox.send(self.take())
+        self.assertEqual(self.outbox.throttled, 1)
+        self.assertFalse(a1.done())
+
+        # чат 1 на паузе, отправляется сообщение другого чата
+        job = self.take()
+        self.assertEqual(job.kwargs['text'], 'b1')
+        self.outbox.send(job)
+        self.assertIsNone(self.take())
+
+        time.sleep(0.06)
+        for future, text in ((a1, 'a1'), (a2, 'a2')):
+            job = self.take()
+            self.assertEqual(job.kwargs['text'], text)
+            self.outbox.send(job)
+            self.assertEqual(future.result(timeout=1), text)
+        self.assertEqual(b1.result(timeout=1), 'b1')
+
+    def test_chat_order_while_sending(self):
+        for chat_id, text in ((1, 'a1'), (1, 'a2'), (2, 'b1')):
+            self.outbox.send_message(chat_id, text)
+
+        a1 = self.take()
+        self.assertEqual(a1.kwargs['text'], 'a1')
+        # a1 ещё отправляется: a2 ждёт, другие чаты - нет
+        self.assertEqual(self.take().kwargs['text'], 'b1')
+        self.assertIsNone(self.take())
+
+        self.outbox.send(a1)
+        self.assertEqual(self.take().kwargs['text'], 'a2')
+
+    def test_chat_order_with_dispatcher(self):
+        sent, sending_a1 = [], threading.Event()
+
+        def send_message(chat_id, text):
+            if text == 'a1':
+                sending_a1.set()
+                time.sleep(0.1)
+            sent.append(text)
+
+        self.api.send_message.side_effect = send_message
+        outbox = Outbox(global_rate=1000, chat_rate=1000, chat_burst=10, workers=4)
+        outbox.thread = threading.Thread(target=outbox.run, daemon=True)
+        outbox.thread.start()
+        outbox.send_message(1, 'a1')
+        sending_a1.wait(1)
+        outbox.send_message(1, 'a2')
+        outbox.send_message(2, 'b1')
+        outbox.drain(2)
+
+        self.assertEqual(sent, ['b1', 'a1', 'a2'])
+
+
+class SearchTranslationsTestCase(TestCase):
+    fixtures = ['languages.json']
+
+    def setUp(self):
+        get_registry()  # реестр языков загружается один раз на процесс
+
+    @staticmethod
+    def create_user(dictionaries_count: int) -> User:
+        user = User.objects.create(username=f'searcher{dictionaries_count}')
+        for i in range(dictionaries_count):
+            dictionary = Dictionary.objects.create(user=user, name=f'dict{i}')
+            en, ru = 'abcdefgh'[i], 'абвгдежз'[i]
+            PhraseImport(user, dictionary).add_lines([
+                f'cat{en} - кот{ru}',
+                f'catalog{en} - каталог{ru}, справочник{ru}',
+                f'dog{en} - пёс{ru}',
+            ], strict=True)
+        return user
+
+    def test_query_count_does_not_depend_on_dictionaries(self):
+        for dictionaries_count in (1, 4, 8):
+            user = self.create_user(dictionaries_count)
+
+            with self.assertNumQueries(3):
+                text = responses.search_translations(user, 'cat').text
+
+            self.assertEqual(text.count(' - cat'), dictionaries_count * 2)
+            self.assertIn(' - cata - кота [ru]', text)
+            self.assertIn(' - catalogh - каталогз, справочникз [ru]' if dictionaries_count == 8 else 'dict0:', text)
+            self.assertNotIn('dog', text)
+
+
+class DictContentsTestCase(TestCase):
+    fixtures = ['languages.json']
+
+    def setUp(self):
+        user = User.objects.create(username='reader')
+        self.dictionary = Dictionary.objects.create(user=user, name='en-ru')
+        PhraseImport(user, self.dictionary).add_lines([f'cat{c} - кот{c}' for c in 'abcde'], strict=True)
+        self.en, self.ru = get_registry().get_by_code('en'), get_registry().get_by_code('ru')
+
+    def contents(self, **kwargs) -> str:
+        dictionary = Dictionary.objects.get(id=self.dictionary.id)
+        return responses.dict_contents(dictionary, self.en, self.ru, count=2, **kwargs).text
+
+    def phrase_id(self, text: str) -> int:
+        return Phrase.objects.get(text=text).id
+
+    def test_pages(self):
+        self.assertEqual(self.contents().split('\n'), ['Page 1/3', '', 'cata - котa', 'catb - котb'])
+        self.assertIn('Page 2/3\n\ncatc - котc\ncatd - котd',
+                      self.contents(page=2, cursor=self.phrase_id('catb'), direction=1))
+        self.assertIn('Page 3/3\n\ncate - котe', self.contents(page=3, cursor=0, direction=-1))
+
+    def test_deleted_cursor_falls_back_to_first_page(self):
+        cursor = self.phrase_id('catb')
+        Phrase.objects.filter(id=cursor).delete()
+        self.assertIn('Page 1/2\n\ncata - котa\ncatc - котc', self.contents(page=2, cursor=cursor, direction=1))
+
+    def test_page_numbers_follow_actual_phrases(self):
+        # счётчик фраз в сводке разошёлся с фразами словаря
+        summary = DictionarySummary.objects.filter(dictionary=self.dictionary)
+        summary.update(phrases_count={str(self.en.id): 10})
+        self.assertIn('Page 3/3\n\ncate - котe', self.contents(page=3, cursor=self.phrase_id('catd'), direction=1))
+
+        summary.update(phrases_count={str(self.en.id): 1})
+        self.assertIn('Page 1/2\n\ncata - котa\ncatb - котb', self.contents())
+        self.assertIn('Page 2/2\n\ncate - котe', self.contents(page=1, cursor=0, direction=-1))
+
+
+@override_settings(DICT_LIST_PAGE_SIZE=2)
+class DictListTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()   # id в тестовой БД повторяются
+        self.user = User.objects.create(username='lister')
+        # id не совпадают с порядком имён, словарь 'c' другого юзера - с тем же именем
+        for name in ('e', 'c', 'a', 'd', 'b'):
+            Dictionary.objects.create(user=self.user, name=name)
+        other = User.objects.create(username='sharer')
+        Dictionary.objects.create(user=other, name='c').viewers.add(self.user)
+
+    def page(self, cursor=0, direction=1):
+        """(имена словарей страницы, {кнопка навигации: (cursor, direction)})"""
+        buttons = [b for row in responses.dict_list_keyboard(self.user, cursor, direction).keyboard for b in row]
+        names = [b.text for b in buttons if b.text not in ('«', '»')]
+        actions = {b.text: tuple(parse_callback_data(b.callback_data)[1]) for b in buttons if b.text in ('«', '»')}
+        return names, actions
+
+    def test_pages(self):
+        pages = []
+        names, actions = self.page()
+        while 1:
+            pages.append(names)
+            if '»' not in actions:
+                break
+            names, actions = self.page(*actions['»'])
+        self.assertEqual(pages, [['a', 'b'], ['c', 'c'], ['d', 'e']])
+        self.assertEqual(list(actions), ['«'])
+
+        names, actions = self.page(*actions['«'])
+        self.assertEqual(names, ['c', 'c'])
+        self.assertEqual(list(actions), ['«', '»'])
+        names, actions = self.page(*actions['«'])
+        self.assertEqual((names, list(actions)), (['a', 'b'], ['»']))
+
+
+class CallbackDataTestCase(TestCase):
+
+    def assertRoundTrip(self, handler, *args):
+        data = handler('label', *args).callback_data
+        self.assertLessEqual(len(data.encode()), callback_data.MAX_LENGTH)
+        self.assertEqual(parse_callback_data(data), (handler, list(args)))
+
+    def test_round_trip(self):
+        self.assertRoundTrip(handlers.list_dicts_callback)
+        self.assertRoundTrip(handlers.select_dictionary, 0)
+        self.assertRoundTrip(handlers.list_dicts_page, 2 ** 31 + 1, -1)
+        self.assertRoundTrip(handlers.list_dicts_page, -2 ** 40, 1)
+        self.assertRoundTrip(handlers.dict_contents_page, 2 ** 52, 2 ** 31, -(2 ** 31) - 1, -1, 30, 2 ** 33, 1)
+
+    def test_legacy_payloads(self):
+        self.assertEqual(parse_callback_data('list_dicts_page:42:-1'), (handlers.list_dicts_page, [42, -1]))
+        self.assertEqual(parse_callback_data('list_dicts_callback'), (handlers.list_dicts_callback, []))
+        self.assertEqual(
+            parse_callback_data('dict_training_phrase:1:2:3:1'), (handlers.dict_training_phrase, [1, 2, 3, True])
+        )
+
+    def test_invalid_payloads(self):
+        index = handlers.list_dicts_page.index
+        for data in ('list_dicts_page:1', 'unknown:1', '1', '1!!', '1' + 'A' * 5,
+                     callback_data.encode(index, [1]), callback_data.encode(index, [1, 2, 3])):
+            with self.subTest(data=data):
+                self.assertEqual(parse_callback_data(data), (None, []))
+
+    def test_unknown_callback_is_answered(self):
+        callback = mock.Mock(id='query-id', data='unknown:1')
+        callback.from_user.id = 1001
+        with mock.patch('bot.utils.outbox') as outbox, mock.patch('bot.utils.get_user') as get_user:
+            callback_dispatcher(callback)
+        outbox.answer_callback_query.assert_called_once_with(1001, 'query-id')
+        get_user.assert_not_called()
+
+
+class FakeBotApi(BaseHTTPRequestHandler):
+    """Bot API: запоминает вызовы, на все отвечает отправленным сообщением"""
+    calls = None
+
+    def do_POST(self):
+        url = urlsplit(self.path)
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0)).decode()
+        self.calls.append((url.path.rsplit('/', 1)[-1], dict(parse_qsl(url.query), **dict(parse_qsl(body)))))
+
+        data = json.dumps({'ok': True, 'result': {'message_id': 1, 'date': 0, 'chat': {'id': 1, 'type': 'private'}}})
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.end_headers()
+        self.wfile.write(data.encode())
+
+    do_GET = do_POST
+
+    def log_message(self, *args):
+        pass
+
+
+@override_settings(BOT={**settings.BOT, 'WEBHOOK_SECRET': 'secret'})
+class WebhookTestCase(TestCase):
+
+    def setUp(self):
+        self.calls = []
+        server = ThreadingHTTPServer(('127.0.0.1', 0), type('Api', (FakeBotApi,), {'calls': self.calls}))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+
+        get_bot()   # настройки telebot применяются при создании бота
+        patches = [
+            mock.patch.object(telebot.apihelper, 'API_URL', f'http://127.0.0.1:{server.server_port}/bot{{0}}/{{1}}'),
+            mock.patch('bot.start_background_jobs'),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def post_update(self, update_id: int, text: str, secret: str = 'secret'):
+        update = {
+            'update_id': update_id,
+            'message': {
+                'message_id': update_id, 'date': 0, 'text': text,
+                'chat': {'id': 2001, 'type': 'private'},
+                'from': {'id': 2001, 'is_bot': False, 'first_name': 'Webhook'},
+                'entities': [{'type': 'bot_command', 'offset': 0, 'length': len(text)}],
+            },
+        }
+        return self.client.post(
+            '/bot/webhook/', json.dumps(update), content_type='application/json',
+            HTTP_X_TELEGRAM_BOT_API_SECRET_TOKEN=secret,
+        )
+
+    def test_update_answered_once(self):
+        self.assertEqual(self.post_update(70001, '/help', secret='wrong').status_code, 403)
+
+        for _ in range(2):  # повторная доставка того же обновления
+            self.assertEqual(self.post_update(70001, '/help').status_code, 200)
+        outbox.drain(5)
+
+        self.assertEqual([(method, params['chat_id']) for method, params in self.calls], [('sendMessage', '2001')])
+        self.assertTrue(TelegramProfile.objects.filter(id=2001).exists())
+
+
+class AsyncRuntimeTestCase(TestCase):
+
+    def test_run_bot_async_requires_aiohttp(self):
+        with mock.patch.object(aio, 'aiohttp', None), mock.patch('bot.management.commands.run_bot.run_bot') as run:
+            with self.assertRaisesMessage(CommandError, 'poetry install -E async'):
+                call_command('run_bot', '--async')
+        run.assert_not_called()
+
+    @skipIf(aio.aiohttp is None, 'aiohttp is not installed')
+    def test_network_errors_raised_as_requests_exceptions(self):
+        runtime = aio.AsyncRuntime(workers=1, concurrency=1, pool_size=1)
+        runtime.loop = asyncio.new_event_loop()
+        thread = threading.Thread(target=runtime.loop.run_forever, daemon=True)
+        thread.start()
+
+        errors = [
+            (aio.aiohttp.ClientConnectionError('refused'), requests_exceptions.ConnectionError),
+            (aio.aiohttp.ServerTimeoutError('timeout'), requests_exceptions.ReadTimeout),
+            (asyncio.TimeoutError(), requests_exceptions.ReadTimeout),
+            (aio.aiohttp.ClientPayloadError('broken'), requests_exceptions.RequestException),
+        ]
+        try:
+            for error, expected in errors:
+                async def request(*args, error=error):
+                    raise error
+
+                with mock.patch.object(runtime, 'request', request):
+                    with self.assertRaises(expected):
+                        runtime.send_request('get', 'http://localhost/', params={}, timeout=(1, 1))
+        finally:
+            runtime.loop.call_soon_threadsafe(runtime.loop.stop)
+            thread.join()
+            runtime.loop.close()
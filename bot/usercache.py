@@ -0,0 +1,117 @@
+"""
+Кэш юзеров бота по id чата: User вместе с профилем (user.tg) и текущим словарём (user.tg.current_dict).
+
+Два уровня: LRU в памяти процесса и redis (общий для процессов). Актуальность записи в памяти
+проверяется по версии в redis (один GET короткого ключа), так что изменения из других процессов видны сразу.
+При промахе юзер загружается одним запросом с select_related. Изменения профиля записываются
+в кэш сразу после сохранения (write-through, см. store_profile), изменения словаря сбрасывают кэш
+ссылающихся на него профилей.
+
+Из кэша возвращается копия, изменения объекта без сохранения в кэш не попадают.
+"""
+import pickle
+import threading
+import uuid
+from collections import OrderedDict
+from typing import Iterable, Optional
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import transaction
+
+DATA_KEY = 'bot:user:{}'
+VERSION_KEY = 'bot:user:{}:version'
+
+
+class UserCache:
+
+    def __init__(self, size: int, timeout: int):
+        self.size = size
+        self.timeout = timeout
+        self.entries = OrderedDict()    # chat_id -> (версия, pickle юзера)
+        self.lock = threading.Lock()
+
+    def get(self, chat_id: int) -> Optional[User]:
+        version = cache.get(VERSION_KEY.format(chat_id))
+        if version is None:
+            return None
+
+        with self.lock:
+            entry = self.entries.get(chat_id)
+            if entry is not None and entry[0] == version:
+                self.entries.move_to_end(chat_id)
+                return pickle.loads(entry[1])
+
+        entry = cache.get(DATA_KEY.format(chat_id))
+        if entry is None or entry[0] != version:
+            return None
+        self.remember(chat_id, entry)
+        return pickle.loads(entry[1])
+
+    def load(self, chat_id: int) -> Optional[User]:
+        """юзер из кэша или из БД (с последующим кэшированием)"""
+        user = self.get(chat_id)
+        if user is None:
+            user = User.objects.select_related('tg', 'tg__current_dict').filter(tg=chat_id).first()
+            if user is not None:
+                self.store(user)
+        return user
+
+    def store(self, user: User):
+        """записывает юзера (с загруженным user.tg) в оба уровня"""
+        entry = (uuid.uuid4().hex, pickle.dumps(user, pickle.HIGHEST_PROTOCOL))
+        chat_id = user.tg.id
+        cache.set_many({
+            DATA_KEY.format(chat_id): entry,
+            VERSION_KEY.format(chat_id): entry[0],
+        }, timeout=self.timeout)
+        self.remember(chat_id, entry)
+
+    def remember(self, chat_id: int, entry: tuple):
+        with self.lock:
+            self.entries[chat_id] = entry
+            self.entries.move_to_end(chat_id)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, chat_ids: Iterable[int]):
+        chat_ids = list(chat_ids)
+        if not chat_ids:
+            return
+        cache.delete_many([VERSION_KEY.format(chat_id) for chat_id in chat_ids])
+        with self.lock:
+            for chat_id in chat_ids:
+                self.entries.pop(chat_id, None)
+
+
+user_cache = UserCache(settings.USER_CACHE_SIZE, settings.USER_CACHE_TIMEOUT)
+
+
+def store_profile(sender, instance, **kwargs):
+    """write-through после сохранения профиля (обработчик post_save TelegramProfile)"""
+    from bot.models import TelegramProfile
+
+    if not TelegramProfile.user.is_cached(instance):
+        transaction.on_commit(lambda: user_cache.invalidate([instance.id]))
+        return
+
+    user = instance.user
+    User.tg.related.set_cached_value(user, instance)
+    transaction.on_commit(lambda: user_cache.store(user))
+
+
+def invalidate_user(sender, instance, **kwargs):
+    """обработчик post_save User"""
+    from bot.models import TelegramProfile
+
+    profile_ids = list(TelegramProfile.objects.filter(user=instance).values_list('id', flat=True))
+    transaction.on_commit(lambda: user_cache.invalidate(profile_ids))
+
+
+def invalidate_dictionary(sender, instance, **kwargs):
+    """обработчик post_save/pre_delete Dictionary: сбрасывает профили, у которых он текущий"""
+    from bot.models import TelegramProfile
+
+    profile_ids = list(TelegramProfile.objects.filter(current_dict=instance).values_list('id', flat=True))
+    transaction.on_commit(lambda: user_cache.invalidate(profile_ids))
@@ -1,55 +1,93 @@
 from collections import namedtuple
 from inspect import signature
+from itertools import islice
+from typing import Iterable, Iterator, List, Optional, Tuple
+import codecs
+import csv
+import os
 import re
 
-from django.db import transaction
+import requests
+from django.db import IntegrityError, transaction
 from django.contrib.auth.models import User
 from django.utils.crypto import get_random_string
-from telebot.types import Message, InlineKeyboardButton, CallbackQuery
+from telebot import apihelper
+from telebot.types import Message, InlineKeyboardButton, CallbackQuery, Document, Chat
 
-from bot import bot
+from bot import bot, callback_data
 from bot.commands import COMMANDS
 from bot.models import TelegramProfile, USER_STATES
+from bot.outbox import outbox
+from bot.usercache import user_cache
 
 
-CALLBACK_FUNC_HANDLERS = {}
+CALLBACK_FUNC_HANDLERS = {}    # имя -> CallbackHandler (старый формат callback_data)
+CALLBACK_INDEX_HANDLERS = {}   # индекс -> CallbackHandler (см. bot.callback_data)
 
 
 class CallbackHandler:
 
     def __init__(self, func_handler: callable):
-        func_params = list(signature(func_handler).parameters.keys())
-        field_names = func_params[2:] if len(func_params) > 2 else ['empty']
+        params = list(signature(func_handler).parameters.values())[2:]
+        field_names = [p.name for p in params] or ['empty']
         name = func_handler.__name__
+        self.func = func_handler
         self.t = namedtuple(name, field_names=field_names)
+        # приведение аргументов к типам из аннотаций обработчика
+        self.converters = [ARG_CONVERTERS.get(p.annotation, str) for p in params]
+        self.index = callback_data.handler_index(name)
 
-        CALLBACK_FUNC_HANDLERS[name] = func_handler
+        if self.index in CALLBACK_INDEX_HANDLERS:
+            raise ValueError('callback handlers "{}" and "{}" have the same index, rename one of them'.format(
+                name, CALLBACK_INDEX_HANDLERS[self.index].t.__name__))
+        CALLBACK_FUNC_HANDLERS[name] = self
+        CALLBACK_INDEX_HANDLERS[self.index] = self
 
     def __call__(self, label: str, *args, **kwargs):
         return self.mk_button(label, *args, **kwargs)
 
     def mk_button(self, label: str, *args, **kwargs):
-        if args or kwargs:
-            d = self.t(*args, **kwargs)
-            callback_data = ':'.join([self.t.__name__] + list(map(str, d)))
+        values = list(self.t(*args, **kwargs)) if args or kwargs else []
+        if all(isinstance(v, int) for v in values):
+            data = callback_data.encode(self.index, values)
         else:
-            callback_data = self.t.__name__
+            data = ':'.join([self.t.__name__] + list(map(str, values)))
 
-        return InlineKeyboardButton(label, callback_data=callback_data)
+        if len(data.encode()) > callback_data.MAX_LENGTH:
+            raise ValueError(f'callback data is too long: {data}')
+        return InlineKeyboardButton(label, callback_data=data)
+
+    def convert_args(self, args: list) -> list:
+        return [convert(arg) for convert, arg in zip(self.converters, args)]
+
+
+def parse_callback_data(data: str) -> Tuple[Optional[CallbackHandler], list]:
+    """(обработчик, аргументы нужных типов) или (None, []), если данные не распознаны"""
+    try:
+        if callback_data.is_encoded(data):
+            index, args = callback_data.decode(data)
+            handler = CALLBACK_INDEX_HANDLERS.get(index)
+        else:
+            name, *args = data.split(':')
+            handler = CALLBACK_FUNC_HANDLERS.get(name)
+        if handler is None or len(args) != len(handler.converters):
+            return None, []
+        return handler, handler.convert_args(args)
+    except ValueError:
+        return None, []
 
 
 @bot.callback_query_handler(func=lambda x: True)
 def callback_dispatcher(callback: CallbackQuery):
-    parts = callback.data.split(':')
-    callback_name = parts[0]
-    user = get_user(callback.message)
+    handler, args = parse_callback_data(callback.data)
+    if handler is None:
+        print('unknown callback data:', callback.data)
+        # иначе кнопка в клиенте остаётся с индикатором загрузки
+        outbox.answer_callback_query(callback.from_user.id, callback.id)
+        return
 
-    if len(parts) > 1:
-        args = parts[1:]
-    else:
-        args = ()
-
-    CALLBACK_FUNC_HANDLERS[callback_name](callback, user, *args)
+    user = get_user(callback.message)
+    handler.func(callback, user, *args)
 
 
 def get_unique_username(username: str) -> str:
@@ -73,30 +111,42 @@ def update_user_state(profile: TelegramProfile, msg: Message):
 
 
 def get_user(msg: Message, update_state: bool = True) -> User:
-    from_user = msg.chat
-    try:
-        user = User.objects.get(tg=from_user.id)
-        profile = user.tg
-    except User.DoesNotExist:
-        with transaction.atomic():
-            user = User(
-                username=get_unique_username(from_user.username),
-                first_name=from_user.first_name or '',
-                last_name=from_user.last_name or '',
-            )
-            user.set_unusable_password()
-            user.save()
-
-            profile = TelegramProfile.objects.create(
-                id=from_user.id,
-                user=user,
-            )
-
+    """юзер (с профилем и текущим словарём) по id чата, при первом обращении создаётся"""
+    user = user_cache.load(msg.chat.id) or create_user(msg.chat)
     if update_state:
-        update_user_state(profile, msg)
+        update_user_state(user.tg, msg)
     return user
 
 
+def create_user(chat: Chat) -> User:
+    """
+    Создаёт юзера с профилем. Если юзера этого чата параллельно создал другой поток (процесс),
+    возвращает его.
+    """
+    for attempt in range(3):
+        try:
+            with transaction.atomic():
+                user = User(
+                    username=get_unique_username(chat.username),
+                    first_name=chat.first_name or '',
+                    last_name=chat.last_name or '',
+                )
+                user.set_unusable_password()
+                user.save()
+
+                TelegramProfile.objects.create(
+                    id=chat.id,
+                    user=user,
+                )
+            return user
+        except IntegrityError:
+            # профиль уже создан (или занят username, тогда пробуем ещё раз)
+            user = user_cache.load(chat.id)
+            if user is not None:
+                return user
+    raise RuntimeError(f'failed to create user for chat {chat.id}')
+
+
 def str_to_int(s):
     """
     Гарантированно вернёт число из строки.
@@ -110,6 +160,13 @@ def str_to_int(s):
         return int(nums[0]) if len(nums) else 0
 
 
+ARG_CONVERTERS = {
+    int: lambda v: v if isinstance(v, int) else str_to_int(v),
+    bool: lambda v: bool(v if isinstance(v, int) else str_to_int(v)),
+    str: str,
+}
+
+
 def fix_input_uppercase(line: str) -> str:
     """
     Убирает верхний регистр первого символа, если это единственный символ в строке в верхнем регистре.
@@ -127,3 +184,33 @@ def fix_input_uppercase(line: str) -> str:
         return line
 
     return line[0].lower() + line[1:]
+
+
+def chunks(iterable: Iterable, size: int) -> Iterator[List]:
+    """разбивает поток на списки по size элементов"""
+    iterator = iter(iterable)
+    while 1:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def iter_document_lines(document: Document) -> Iterator[str]:
+    """
+    Построчно читает присланный файл, не загружая его целиком в память.
+    Строки .csv/.tsv приводятся к виду "колонка1 - колонка2".
+    """
+    file_path = bot.get_file(document.file_id).file_path
+    url = (apihelper.FILE_URL or 'https://api.telegram.org/file/bot{0}/{1}').format(bot.token, file_path)
+
+    with requests.get(url, stream=True, proxies=apihelper.proxy, timeout=apihelper.READ_TIMEOUT) as response:
+        response.raise_for_status()
+        lines = codecs.iterdecode(response.iter_lines(), 'utf-8-sig')
+
+        extension = os.path.splitext(document.file_name or '')[1].lower()
+        if extension in ('.csv', '.tsv'):
+            for row in csv.reader(lines, delimiter='\t' if extension == '.tsv' else ','):
+                yield ' - '.join(cell.strip() for cell in row if cell.strip())
+        else:
+            yield from lines
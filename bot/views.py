@@ -0,0 +1,49 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.http import HttpRequest, HttpResponse, HttpResponseBadRequest, HttpResponseForbidden, \
+    HttpResponseNotFound
+from django.utils.crypto import constant_time_compare
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
+from telebot.types import Update
+
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+def get_update_key(update_id: int) -> str:
+    return f'bot:update:{update_id}'
+
+
+@csrf_exempt
+@require_POST
+def webhook(request: HttpRequest):
+    """
+    Приём обновлений от telegram в режиме webhook.
+    Повторно доставленные обновления (telegram повторяет доставку при ошибках и таймаутах) пропускаются.
+    """
+    if not settings.BOT['WEBHOOK_SECRET']:
+        return HttpResponseNotFound()
+    if not constant_time_compare(request.headers.get(SECRET_HEADER, ''), settings.BOT['WEBHOOK_SECRET']):
+        return HttpResponseForbidden()
+
+    try:
+        update = Update.de_json(request.body.decode())
+    except (ValueError, KeyError, TypeError):
+        return HttpResponseBadRequest()
+
+    key = get_update_key(update.update_id)
+    if not cache.add(key, 1, timeout=settings.BOT['WEBHOOK_UPDATE_TTL']):
+        return HttpResponse()
+
+    # бот и обработчики загружаются при первом обновлении, остальным view токен не нужен
+    from bot import bot, start_background_jobs
+    from bot import handlers    # NOQA
+
+    start_background_jobs()
+    try:
+        bot.process_new_updates([update])
+    except Exception:
+        cache.delete(key)   # пусть telegram доставит обновление повторно
+        raise
+    return HttpResponse()
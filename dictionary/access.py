@@ -0,0 +1,254 @@
+"""
+Права юзеров на словари (DictionaryAccess).
+
+Синхронизация таблицы с владельцем, редакторами и читателями словаря: обработчики сигналов,
+подключаются в DictionaryAppConfig.ready().
+
+Кэш прав: {id словаря: роль} для каждого юзера, в redis и LRU в памяти процесса
+(актуальность LRU проверяется по версии в redis). Сбрасывается при пересчёте прав
+(DictionaryAccess.objects.rebuild) и удалении словаря, вместе с индексами поиска по префиксу
+(см. dictionary.prefix_index): набор доступных юзеру словарей мог измениться.
+
+Словари фраз и групп фраз (для проверки прав на них) кэшируются в redis, у каждой фразы и группы
+своя версия (см. dictionary.versions.DICTIONARIES_VERSION_KEY), сбрасывается при изменении их связей.
+"""
+import threading
+import uuid
+from collections import OrderedDict, defaultdict
+from types import MappingProxyType
+from typing import Dict, FrozenSet, Iterable, Mapping, Tuple
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+from . import versions
+
+DATA_KEY = 'access:user:{}'
+VERSION_KEY = 'access:user:{}:version'
+OBJECT_DICTIONARIES_KEY = 'access:{}:{}:dictionaries'   # модель (phrase, phrasegroup), id
+
+
+class AccessCache:
+
+    def __init__(self, size: int, timeout: int):
+        self.size = size
+        self.timeout = timeout
+        self.entries = OrderedDict()    # user_id -> (версия, {dictionary_id: role})
+        self.lock = threading.Lock()
+
+    def get(self, user_id: int) -> Mapping[int, int]:
+        """{id словаря: роль} для всех доступных юзеру словарей"""
+        return self.get_entry(user_id)[1]
+
+    def get_version(self, user_id: int) -> str:
+        """версия прав юзера: меняется при любом изменении его словарей (создание, удаление, переименование, доступ)"""
+        return self.get_entry(user_id)[0]
+
+    def get_entry(self, user_id: int) -> Tuple[str, Mapping[int, int]]:
+        version = cache.get(VERSION_KEY.format(user_id))
+        if version is not None:
+            with self.lock:
+                entry = self.entries.get(user_id)
+                if entry is not None and entry[0] == version:
+                    self.entries.move_to_end(user_id)
+                    return entry
+
+            entry = cache.get(DATA_KEY.format(user_id))
+            if entry is not None and entry[0] == version:
+                return self.remember(user_id, entry)
+
+        return self.load(user_id)
+
+    def load(self, user_id: int) -> Tuple[str, Mapping[int, int]]:
+        from .models import DictionaryAccess
+
+        roles = dict(DictionaryAccess.objects.filter(user_id=user_id).values_list('dictionary_id', 'role'))
+        entry = (uuid.uuid4().hex, roles)
+        cache.set_many({
+            DATA_KEY.format(user_id): entry,
+            VERSION_KEY.format(user_id): entry[0],
+        }, timeout=self.timeout)
+        return self.remember(user_id, entry)
+
+    def remember(self, user_id: int, entry: tuple) -> Tuple[str, Mapping[int, int]]:
+        entry = (entry[0], MappingProxyType(entry[1]))  # общий для потоков, только для чтения
+        with self.lock:
+            self.entries[user_id] = entry
+            self.entries.move_to_end(user_id)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+        return entry
+
+    def invalidate(self, user_ids: Iterable[int]):
+        user_ids = list(user_ids)
+        if not user_ids:
+            return
+        cache.delete_many([VERSION_KEY.format(user_id) for user_id in user_ids])
+        with self.lock:
+            for user_id in user_ids:
+                self.entries.pop(user_id, None)
+
+
+access_cache = AccessCache(settings.ACCESS_CACHE_SIZE, settings.ACCESS_CACHE_TIMEOUT)
+
+
+def invalidate_users(user_ids: Iterable[int]):
+    """сбрасывает кэши, зависящие от набора доступных юзерам словарей"""
+    from .prefix_index import prefix_indexes
+
+    user_ids = list(user_ids)
+    access_cache.invalidate(user_ids)
+    prefix_indexes.invalidate(user_ids)
+
+
+def get_objects_dictionary_ids(objs: Iterable) -> Dict[object, FrozenSet[int]]:
+    """
+    {фраза или группа фраз: id словарей, в которые она входит} - одним запросом к redis,
+    при промахах ещё один запрос к БД на фразы и один на группы
+    """
+    from .models import Phrase, PhraseGroup
+
+    keys = {}   # объект -> (ключ версии, ключ данных)
+    for obj in objs:
+        name = obj._meta.model_name
+        keys[obj] = (versions.DICTIONARIES_VERSION_KEY.format(name, obj.pk), OBJECT_DICTIONARIES_KEY.format(name, obj.pk))
+    values = cache.get_many([key for pair in keys.values() for key in pair])
+
+    ret = {}
+    missed = []
+    for obj, (version_key, key) in keys.items():
+        version, entry = values.get(version_key), values.get(key)
+        if version is not None and entry is not None and entry[0] == version:
+            ret[obj] = entry[1]
+        else:
+            missed.append(obj)
+    if not missed:
+        return ret
+
+    # версии читаются до запроса: изменение связей во время запроса не потеряется
+    current_versions = versions.get_versions([keys[obj][0] for obj in missed])
+    loaded = defaultdict(set)
+    phrase_ids = [obj.pk for obj in missed if isinstance(obj, Phrase)]
+    if phrase_ids:
+        for phrase_id, dictionary_id in Phrase.objects\
+                .filter(id__in=phrase_ids, phrase_groups__dictionaries__isnull=False)\
+                .values_list('id', 'phrase_groups__dictionaries'):
+            loaded[('phrase', phrase_id)].add(dictionary_id)
+    group_ids = [obj.pk for obj in missed if isinstance(obj, PhraseGroup)]
+    if group_ids:
+        for group_id, dictionary_id in PhraseGroup.dictionaries.through.objects\
+                .filter(phrasegroup_id__in=group_ids).values_list('phrasegroup_id', 'dictionary_id'):
+            loaded[('phrasegroup', group_id)].add(dictionary_id)
+
+    entries = {}
+    for obj in missed:
+        version_key, key = keys[obj]
+        ret[obj] = frozenset(loaded[(obj._meta.model_name, obj.pk)])
+        entries[key] = (current_versions[version_key], ret[obj])
+    cache.set_many(entries, timeout=settings.ACCESS_CACHE_TIMEOUT)
+    return ret
+
+
+def get_object_dictionary_ids(obj) -> FrozenSet[int]:
+    """id словарей, в которые входит фраза или группа фраз"""
+    return get_objects_dictionary_ids([obj])[obj]
+
+
+def dictionary_saved(sender, instance, **kwargs):
+    """обработчик post_save Dictionary (новый словарь или смена владельца)"""
+    from .models import DictionaryAccess
+    DictionaryAccess.objects.rebuild([instance.id])
+
+
+def members_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    """обработчик m2m_changed Dictionary.editors и Dictionary.viewers (с любой стороны связи)"""
+    from .models import DictionaryAccess
+
+    if not reverse:
+        if action in ('post_add', 'post_remove', 'post_clear'):
+            DictionaryAccess.objects.rebuild([instance.id])
+        return
+
+    # instance - юзер, pk_set - id словарей; при clear они известны только до удаления
+    if action == 'pre_clear':
+        instance._cleared_dictionary_ids = list(
+            sender.objects.filter(user=instance).values_list('dictionary_id', flat=True)
+        )
+    elif action == 'post_clear':
+        DictionaryAccess.objects.rebuild(instance.__dict__.pop('_cleared_dictionary_ids', []))
+    elif action in ('post_add', 'post_remove'):
+        DictionaryAccess.objects.rebuild(pk_set)
+
+
+def dictionary_deleted(sender, instance, **kwargs):
+    """обработчик pre_delete Dictionary: права удаляются каскадно, без rebuild"""
+    user_ids = list(instance.access.values_list('user_id', flat=True))
+    transaction.on_commit(lambda: invalidate_users(user_ids))
+
+
+def _changed_ids(instance, action: str, pk_set, query) -> list:
+    """id изменённых связей m2m_changed; при clear они известны только до удаления (query)"""
+    if action == 'pre_clear':
+        instance._cleared_link_ids = list(query())
+    elif action == 'post_clear':
+        return instance.__dict__.pop('_cleared_link_ids', [])
+    elif action in ('post_add', 'post_remove'):
+        return list(pk_set)
+    return []
+
+
+def _bump_groups_content(group_ids):
+    """сбрасывает версии содержимого словарей групп (см. TrainingQueue)"""
+    from .models import PhraseGroup
+
+    if group_ids:
+        versions.bump_content(set(
+            PhraseGroup.dictionaries.through.objects.filter(phrasegroup_id__in=group_ids)
+            .values_list('dictionary_id', flat=True)
+        ))
+
+
+def group_phrases_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    """обработчик m2m_changed PhraseGroup.phrases: меняются словари фраз и содержимое словарей групп"""
+    if reverse:
+        # instance - фраза
+        group_ids = _changed_ids(
+            instance, action, pk_set,
+            lambda: sender.objects.filter(phrase_id=instance.pk).values_list('phrasegroup_id', flat=True)
+        )
+        if group_ids:
+            versions.bump_dictionaries(phrase_ids=[instance.pk])
+        _bump_groups_content(group_ids)
+        return
+
+    phrase_ids = _changed_ids(
+        instance, action, pk_set,
+        lambda: sender.objects.filter(phrasegroup_id=instance.pk).values_list('phrase_id', flat=True)
+    )
+    versions.bump_dictionaries(phrase_ids=phrase_ids)
+    _bump_groups_content([instance.pk] if phrase_ids else [])
+
+
+def group_dictionaries_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    """обработчик m2m_changed PhraseGroup.dictionaries: меняются словари групп и их фраз, содержимое словарей"""
+    from .models import PhraseGroup
+
+    if not reverse:
+        # instance - группа
+        dictionary_ids = _changed_ids(
+            instance, action, pk_set,
+            lambda: sender.objects.filter(phrasegroup_id=instance.pk).values_list('dictionary_id', flat=True)
+        )
+        group_ids = [instance.pk] if dictionary_ids else []
+    else:
+        group_ids = _changed_ids(
+            instance, action, pk_set,
+            lambda: sender.objects.filter(dictionary_id=instance.pk).values_list('phrasegroup_id', flat=True)
+        )
+        dictionary_ids = [instance.pk] if group_ids else []
+    if group_ids:
+        phrase_ids = PhraseGroup.phrases.through.objects.filter(phrasegroup_id__in=group_ids)\
+            .values_list('phrase_id', flat=True)
+        versions.bump_dictionaries(phrase_ids=set(phrase_ids), group_ids=group_ids)
+        versions.bump_content(dictionary_ids)
@@ -1,6 +1,7 @@
 from django.contrib import admin
 
-from .models import Language, Phrase, PhraseGroup, Dictionary, PhraseUserStat, DictionaryUserStat
+from .models import Language, Phrase, PhraseGroup, Dictionary, PhraseUserStat, DictionaryUserStat, DictionarySummary, \
+    DictionaryUserProgress
 
 
 @admin.register(Language)
@@ -35,7 +36,7 @@ class DictionaryAdmin(admin.ModelAdmin):
 
 @admin.register(PhraseUserStat)
 class PhraseUserStatAdmin(admin.ModelAdmin):
-    list_display = ('user', 'phrase', 'trained_count', 'guessed_count', 'guessed_ratio')
+    list_display = ('user', 'phrase', 'trained_count', 'guessed_count', 'guessed_ratio', 'due_at')
     autocomplete_fields = ['user', 'phrase']
     search_fields = ['user', 'phrase']
     ordering = ['-modified']
@@ -46,3 +47,17 @@ class DictionaryUserStatAdmin(admin.ModelAdmin):
     list_display = ('user', 'dict', 'kind', 'trained_count', 'guessed_count')
     autocomplete_fields = ['user', 'dict']
     ordering = ['-modified']
+
+
+@admin.register(DictionarySummary)
+class DictionarySummaryAdmin(admin.ModelAdmin):
+    list_display = ('dictionary', 'groups_count', 'phrases_count', 'modified')
+    autocomplete_fields = ['dictionary']
+    ordering = ['-modified']
+
+
+@admin.register(DictionaryUserProgress)
+class DictionaryUserProgressAdmin(admin.ModelAdmin):
+    list_display = ('user', 'dictionary', 'language', 'trained_phrases_count')
+    autocomplete_fields = ['user', 'dictionary', 'language']
+    ordering = ['-modified']
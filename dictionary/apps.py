@@ -4,3 +4,26 @@ from django.apps import AppConfig
 class DictionaryAppConfig(AppConfig):
     name = 'dictionary'
     default_auto_field = 'django.db.models.AutoField'
+
+    def ready(self):
+        from django.db.models.signals import post_save, post_delete, pre_delete, m2m_changed
+        from . import access, languages, versions
+        from .models import Dictionary, DictionarySummary, Language, PhraseGroup
+
+        post_save.connect(languages.invalidate, sender=Language, dispatch_uid='languages_invalidate_on_save')
+        post_delete.connect(languages.invalidate, sender=Language, dispatch_uid='languages_invalidate_on_delete')
+
+        post_save.connect(access.dictionary_saved, sender=Dictionary, dispatch_uid='dictionary_access_on_save')
+        pre_delete.connect(access.dictionary_deleted, sender=Dictionary, dispatch_uid='dictionary_access_on_delete')
+        m2m_changed.connect(access.members_changed, sender=Dictionary.editors.through,
+                            dispatch_uid='dictionary_access_on_editors_change')
+        m2m_changed.connect(access.members_changed, sender=Dictionary.viewers.through,
+                            dispatch_uid='dictionary_access_on_viewers_change')
+
+        post_save.connect(versions.dictionary_saved, sender=Dictionary, dispatch_uid='dictionary_content_version_on_save')
+        post_save.connect(versions.summary_saved, sender=DictionarySummary,
+                          dispatch_uid='dictionary_content_version_on_summary_save')
+        m2m_changed.connect(access.group_phrases_changed, sender=PhraseGroup.phrases.through,
+                            dispatch_uid='dictionary_access_on_group_phrases_change')
+        m2m_changed.connect(access.group_dictionaries_changed, sender=PhraseGroup.dictionaries.through,
+                            dispatch_uid='dictionary_access_on_group_dictionaries_change')
@@ -0,0 +1,14 @@
+from django.core.cache import cache
+
+
+def get_redis():
+    """
+    "сырое" соединение с redis дефолтного кэша (для списков, sorted set'ов и т.п.),
+    минуя сериализацию django-redis-cache
+    """
+    return cache.master_client
+
+
+def make_key(key: str) -> str:
+    """ключ с префиксом и версией кэша, чтобы не пересекаться с другими приложениями в той же БД"""
+    return cache.make_key(key)
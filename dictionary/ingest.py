@@ -0,0 +1,224 @@
+"""
+Пакетное добавление фраз в словарь.
+
+Строки вида "phrase_en_1, phrase_en_2 - phrase_ru_3" сначала разбираются целиком,
+затем все фразы пачки находятся одним запросом, а новые фразы, группы и связи между ними
+записываются несколькими bulk-запросами в одной транзакции, независимо от числа строк.
+"""
+from collections import defaultdict
+from typing import List, NamedTuple, Tuple, Iterable
+
+from django.contrib.auth.models import User
+from django.db import IntegrityError, transaction
+from django.utils.functional import cached_property
+from django.utils.translation import gettext as _
+
+from .exceptions import PhraseParseInputError
+from .languages import get_registry
+
+BULK_BATCH_SIZE = 500
+
+PhraseKey = Tuple[int, str]     # (lang_id, text)
+GroupRef = Tuple[str, int]      # ('existing', group_id) | ('new', индекс новой группы в пачке)
+
+
+class ParsedLine(NamedTuple):
+    line: str
+    phrases: List[Tuple['Language', str]]     # (язык, текст) в порядке ввода
+
+
+class ImportResult:
+    def __init__(self):
+        self.new_phrases = []
+        self.new_groups = []
+        self.errors = []    # [(строка, текст ошибки)]
+        self.dictionary_ids = set()     # словари, в которые попали новые фразы (через новые и существующие группы)
+
+    @property
+    def phrases_count(self) -> int:
+        return len(self.new_phrases)
+
+    @property
+    def groups_count(self) -> int:
+        return len(self.new_groups)
+
+
+class PhraseImport:
+    """
+    Добавляет фразы юзера пачками строк (см. add_lines) в словарь dictionary.
+
+    Правила для каждой строки те же, что и при вводе одной строки: новые фразы строки помещаются
+    в группы уже существующих фраз этой строки, а если таких нет - в новую группу, которая добавляется в словарь.
+    Строки пачки учитывают фразы, добавленные предыдущими строками.
+    """
+
+    def __init__(self, user: User, dictionary=None):
+        self.user = user
+        self.dictionary = dictionary
+        self.result = ImportResult()    # накопительный итог по всем пачкам
+
+    @cached_property
+    def languages(self) -> List['Language']:
+        """языки словаря на момент начала импорта: среди них определяется язык фраз"""
+        return self.dictionary.languages() if self.dictionary else []
+
+    def parse_line(self, line: str) -> ParsedLine:
+        languages = get_registry()
+        parts = line.split(' - ')
+        langs = []
+        phrases = []
+
+        for part in parts:
+            if not part:
+                raise PhraseParseInputError(_('Error: Definition contains empty part'))
+
+            # язык, уже найденный в строке, не предпочитаем: у второй части строки другой язык
+            lang = languages.detect(part, preferred=[lang for lang in self.languages if lang not in langs])
+
+            if not lang:
+                raise PhraseParseInputError(_('Error: Failed to detected phrase language: {}.').format(part))
+            if lang in langs:
+                raise PhraseParseInputError(_('Error: {} language detected twice. '
+                                              'Another phrase must me in different language').format(lang))
+
+            phrases_str = [s.strip() for s in part.split(',') if s.strip()]
+            if not phrases_str:
+                raise PhraseParseInputError(_('Error: Empty phrase for language {}').format(lang))
+
+            langs.append(lang)
+            phrases += [(lang, text) for text in phrases_str]
+
+        if len(langs) != 2:
+            raise PhraseParseInputError(_('Error: Invalid phrases count, expect 2'))
+
+        return ParsedLine(line, phrases)
+
+    def parse_lines(self, lines: Iterable[str], strict: bool) -> Tuple[List[ParsedLine], List[Tuple[str, str]]]:
+        """разбирает строки, пропуская пустые; strict - ошибка в любой строке прерывает разбор"""
+        parsed = []
+        errors = []
+        for line in lines:
+            if not line.strip():
+                continue
+            try:
+                parsed.append(self.parse_line(line))
+            except PhraseParseInputError as e:
+                if strict:
+                    raise
+                errors.append((line, str(e)))
+        return parsed, errors
+
+    def resolve(self, keys: Iterable[PhraseKey]) -> dict:
+        """существующие фразы юзера по ключам (lang_id, text), по одному запросу на BULK_BATCH_SIZE текстов"""
+        from .models import Phrase
+
+        keys = set(keys)
+        texts = sorted({text for lang_id, text in keys})
+        lang_ids = {lang_id for lang_id, text in keys}
+        existing = {}
+        for i in range(0, len(texts), BULK_BATCH_SIZE):
+            for phrase in Phrase.objects.filter(user=self.user, lang_id__in=lang_ids, text__in=texts[i:i + BULK_BATCH_SIZE]):
+                if (phrase.lang_id, phrase.text) in keys:
+                    existing[(phrase.lang_id, phrase.text)] = phrase
+        return existing
+
+    def add_lines(self, lines: Iterable[str], strict: bool = False) -> ImportResult:
+        """
+        добавляет пачку строк одной транзакцией, возвращает результат по этой пачке.
+        strict - любая ошибочная строка отменяет всю пачку (PhraseParseInputError),
+        иначе такие строки пропускаются и попадают в result.errors.
+        """
+        from .models import Phrase, PhraseGroup
+
+        result = ImportResult()
+        parsed, result.errors = self.parse_lines(lines, strict)
+
+        existing = self.resolve((lang.id, text) for p in parsed for lang, text in p.phrases)
+        phrase_groups = defaultdict(set)
+        for phrase_id, group_id in PhraseGroup.phrases.through.objects\
+                .filter(phrase_id__in=[p.id for p in existing.values()])\
+                .values_list('phrase_id', 'phrasegroup_id'):
+            phrase_groups[phrase_id].add(('existing', group_id))
+        group_refs = defaultdict(set, {key: phrase_groups[phrase.id] for key, phrase in existing.items()})
+
+        new_phrases = {}    # PhraseKey -> Phrase
+        memberships = []    # [(GroupRef, PhraseKey)]
+        for p in parsed:
+            keys = list(dict.fromkeys((lang.id, text) for lang, text in p.phrases))
+            fresh = [k for k in keys if k not in existing and k not in new_phrases]
+            if not fresh:
+                if strict:
+                    raise PhraseParseInputError(_('Error: no new phrases found'))
+                result.errors.append((p.line, _('Error: no new phrases found')))
+                continue
+
+            groups = set().union(*(group_refs[k] for k in keys if k not in fresh))
+            if not groups:
+                # если нет существующих фраз, создаём новую группу под новые фразы
+                groups = {('new', len(result.new_groups))}
+                result.new_groups.append(PhraseGroup(user=self.user))
+
+            langs = {lang.id: lang for lang, text in p.phrases}
+            for key in fresh:
+                new_phrases[key] = Phrase(user=self.user, lang=langs[key[0]], text=key[1])
+                group_refs[key] = groups
+                memberships += [(group, key) for group in groups]
+
+        result.new_phrases = list(new_phrases.values())
+        try:
+            with transaction.atomic():
+                Phrase.objects.bulk_create(result.new_phrases, batch_size=BULK_BATCH_SIZE)
+                PhraseGroup.objects.bulk_create(result.new_groups, batch_size=BULK_BATCH_SIZE)
+
+                def group_id(ref: GroupRef) -> int:
+                    kind, value = ref
+                    return value if kind == 'existing' else result.new_groups[value].id
+
+                # связи только у новых фраз и групп: их словарей нет в кэше прав (dictionary.access),
+                # поэтому их версии не сбрасываются (bulk_create не отправляет m2m_changed)
+                PhraseGroup.phrases.through.objects.bulk_create([
+                    PhraseGroup.phrases.through(phrasegroup_id=group_id(ref), phrase_id=new_phrases[key].id)
+                    for ref, key in memberships
+                ], batch_size=BULK_BATCH_SIZE)
+                if self.dictionary:
+                    PhraseGroup.dictionaries.through.objects.bulk_create([
+                        PhraseGroup.dictionaries.through(phrasegroup_id=group.id, dictionary_id=self.dictionary.id)
+                        for group in result.new_groups
+                    ], batch_size=BULK_BATCH_SIZE)
+
+                self.update_summaries(result, memberships, new_phrases)
+        except IntegrityError:
+            raise PhraseParseInputError('Database error occurs, failed to save phrases to dictionary')
+
+        self.result.new_phrases += result.new_phrases
+        self.result.new_groups += result.new_groups
+        self.result.errors += result.errors
+        self.result.dictionary_ids |= result.dictionary_ids
+        return result
+
+    def update_summaries(self, result: ImportResult, memberships: List[Tuple[GroupRef, PhraseKey]], new_phrases: dict):
+        """новые фразы учитываются в сводках словарей своих групп"""
+        from .models import PhraseGroup, DictionarySummary
+
+        existing_group_ids = {value for (kind, value), key in memberships if kind == 'existing'}
+        group_dictionaries = defaultdict(set)
+        for group_id, dictionary_id in PhraseGroup.dictionaries.through.objects\
+                .filter(phrasegroup_id__in=existing_group_ids)\
+                .values_list('phrasegroup_id', 'dictionary_id'):
+            group_dictionaries[('existing', group_id)].add(dictionary_id)
+        if self.dictionary:
+            for i in range(len(result.new_groups)):
+                group_dictionaries[('new', i)].add(self.dictionary.id)
+
+        phrase_dictionaries = defaultdict(set)
+        for ref, key in memberships:
+            phrase_dictionaries[key] |= group_dictionaries[ref]
+
+        phrases = defaultdict(lambda: defaultdict(int))
+        for key, dictionary_ids in phrase_dictionaries.items():
+            result.dictionary_ids |= dictionary_ids
+            for dictionary_id in dictionary_ids:
+                phrases[dictionary_id][new_phrases[key].lang_id] += 1
+
+        groups = {self.dictionary.id: len(result.new_groups)} if self.dictionary else {}
+        DictionarySummary.objects.change_counts(groups=groups, phrases=phrases)
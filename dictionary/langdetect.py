@@ -0,0 +1,225 @@
+"""
+Определение языка фразы без обращения к БД, за один проход по символам:
+письменность (по диапазонам Unicode) -> язык, уточнение по характерным буквам
+и статистике триграмм для латиницы.
+
+Для латиницы одного слова с диакритикой мало: заимствования (café, naïve, straße) в английском
+встречаются постоянно, поэтому отдельное слово без других признаков остаётся английским. Если известны
+языки словаря (preferred_codes), выбор делается среди них, а не по всем языкам письменности.
+"""
+from bisect import bisect_right
+from collections import Counter
+from typing import Container, Dict, Iterable, Optional, Tuple
+
+# (начало, конец, письменность), отсортированы по началу
+SCRIPT_RANGES = sorted([
+    (0x0041, 0x005A, 'latin'), (0x0061, 0x007A, 'latin'), (0x00C0, 0x024F, 'latin'), (0x1E00, 0x1EFF, 'latin'),
+    (0x0370, 0x03FF, 'greek'), (0x1F00, 0x1FFF, 'greek'),
+    (0x0400, 0x052F, 'cyrillic'),
+    (0x0530, 0x058F, 'armenian'),
+    (0x0590, 0x05FF, 'hebrew'),
+    (0x0600, 0x06FF, 'arabic'), (0x0750, 0x077F, 'arabic'), (0xFB50, 0xFDFF, 'arabic'), (0xFE70, 0xFEFF, 'arabic'),
+    (0x0900, 0x097F, 'devanagari'),
+    (0x0980, 0x09FF, 'bengali'),
+    (0x0A00, 0x0A7F, 'gurmukhi'),
+    (0x0A80, 0x0AFF, 'gujarati'),
+    (0x0B00, 0x0B7F, 'oriya'),
+    (0x0B80, 0x0BFF, 'tamil'),
+    (0x0C00, 0x0C7F, 'telugu'),
+    (0x0C80, 0x0CFF, 'kannada'),
+    (0x0D00, 0x0D7F, 'malayalam'),
+    (0x0D80, 0x0DFF, 'sinhala'),
+    (0x0E00, 0x0E7F, 'thai'),
+    (0x0E80, 0x0EFF, 'lao'),
+    (0x0F00, 0x0FFF, 'tibetan'),
+    (0x1000, 0x109F, 'myanmar'),
+    (0x10A0, 0x10FF, 'georgian'),
+    (0x1100, 0x11FF, 'hangul'), (0x3130, 0x318F, 'hangul'), (0xAC00, 0xD7AF, 'hangul'),
+    (0x1200, 0x139F, 'ethiopic'),
+    (0x1780, 0x17FF, 'khmer'),
+    (0x3040, 0x30FF, 'kana'),
+    (0x3400, 0x4DBF, 'han'), (0x4E00, 0x9FFF, 'han'), (0xF900, 0xFAFF, 'han'),
+])
+SCRIPT_RANGE_STARTS = [r[0] for r in SCRIPT_RANGES]
+
+# язык по умолчанию для письменности
+SCRIPT_LANGUAGES = {
+    'latin': 'en',
+    'cyrillic': 'ru',
+    'greek': 'el',
+    'armenian': 'hy',
+    'hebrew': 'he',
+    'arabic': 'ar',
+    'devanagari': 'hi',
+    'bengali': 'bn',
+    'gurmukhi': 'pa',
+    'gujarati': 'gu',
+    'oriya': 'or',
+    'tamil': 'ta',
+    'telugu': 'te',
+    'kannada': 'kn',
+    'malayalam': 'ml',
+    'sinhala': 'si',
+    'thai': 'th',
+    'lao': 'lo',
+    'tibetan': 'bo',
+    'myanmar': 'my',
+    'georgian': 'ka',
+    'hangul': 'ko',
+    'ethiopic': 'am',
+    'khmer': 'km',
+    'kana': 'ja',
+    'han': 'zh',
+}
+
+# характерные буквы: буква -> языки, в которых она встречается (голос делится между ними поровну,
+# первый язык в списке - наиболее вероятный - получает небольшую прибавку)
+LETTER_LANGUAGES = {
+    # кириллица
+    'ё': ('ru',), 'ы': ('ru', 'be'), 'э': ('ru', 'be'), 'ъ': ('ru', 'bg'),
+    'і': ('uk', 'be', 'kk'), 'ї': ('uk',), 'є': ('uk',), 'ґ': ('uk',), 'ў': ('be',),
+    'ј': ('sr', 'mk'), 'љ': ('sr', 'mk'), 'њ': ('sr', 'mk'), 'ћ': ('sr',), 'ђ': ('sr',), 'џ': ('sr', 'mk'),
+    'ѓ': ('mk',), 'ќ': ('mk',), 'ѕ': ('mk',),
+    'ә': ('kk',), 'ғ': ('kk',), 'қ': ('kk',), 'ң': ('kk',), 'ө': ('kk', 'mn'), 'ұ': ('kk',), 'ү': ('kk', 'mn'), 'һ': ('kk',),
+    # арабская письменность
+    'پ': ('fa', 'ur'), 'چ': ('fa', 'ur'), 'ژ': ('fa', 'ur'), 'گ': ('fa', 'ur'), 'ی': ('fa', 'ur'),
+    'ے': ('ur',), 'ٹ': ('ur',), 'ڈ': ('ur',), 'ڑ': ('ur',), 'ں': ('ur',),
+    # латиница
+    'ß': ('de',), 'ä': ('de', 'sv', 'fi'), 'ö': ('de', 'sv', 'fi', 'tr', 'hu'), 'ü': ('de', 'tr', 'hu'),
+    'ñ': ('es',), '¿': ('es',), '¡': ('es',),
+    'á': ('es', 'pt', 'hu', 'cs'), 'é': ('fr', 'es', 'pt', 'it', 'hu', 'cs'), 'í': ('es', 'pt', 'hu', 'cs'),
+    'ó': ('es', 'pt', 'hu', 'pl'), 'ú': ('es', 'pt', 'hu', 'cs'),
+    'à': ('fr', 'it', 'pt'), 'è': ('fr', 'it'), 'ù': ('fr', 'it'), 'ì': ('it',), 'ò': ('it',),
+    'â': ('fr', 'pt', 'ro'), 'ê': ('fr', 'pt'), 'î': ('fr', 'ro'), 'ô': ('fr', 'pt'), 'û': ('fr',),
+    'ë': ('fr', 'nl'), 'ï': ('fr', 'nl'), 'ÿ': ('fr',), 'œ': ('fr',), 'ç': ('fr', 'pt', 'tr'),
+    'ã': ('pt',), 'õ': ('pt',),
+    'ą': ('pl',), 'ę': ('pl',), 'ł': ('pl',), 'ń': ('pl',), 'ś': ('pl',), 'ź': ('pl',), 'ż': ('pl',), 'ć': ('pl', 'hr'),
+    'č': ('cs', 'sk', 'hr', 'sl', 'lt', 'lv'), 'š': ('cs', 'sk', 'hr', 'sl', 'lt', 'lv'),
+    'ž': ('cs', 'sk', 'hr', 'sl', 'lt', 'lv'),
+    'ř': ('cs',), 'ů': ('cs',), 'ě': ('cs',), 'ý': ('cs', 'sk'), 'ď': ('cs', 'sk'), 'ť': ('cs', 'sk'),
+    'ň': ('cs', 'sk'), 'ľ': ('sk',), 'ĺ': ('sk',), 'ŕ': ('sk',),
+    'ő': ('hu',), 'ű': ('hu',),
+    'å': ('sv', 'no', 'da'), 'ø': ('no', 'da'), 'æ': ('no', 'da'),
+    'ğ': ('tr',), 'ş': ('tr', 'ro'), 'ı': ('tr',),
+    'ă': ('ro', 'vi'), 'ș': ('ro',), 'ț': ('ro',),
+    'ā': ('lv',), 'ē': ('lv',), 'ī': ('lv',), 'ū': ('lv', 'lt'), 'ģ': ('lv',), 'ķ': ('lv',), 'ļ': ('lv',), 'ņ': ('lv',),
+    'ė': ('lt',), 'į': ('lt',), 'ų': ('lt',),
+    'ð': ('is',), 'þ': ('is',),
+    'đ': ('vi', 'hr'), 'ơ': ('vi',), 'ư': ('vi',), 'ạ': ('vi',), 'ả': ('vi',), 'ấ': ('vi',), 'ầ': ('vi',),
+    'ệ': ('vi',), 'ế': ('vi',), 'ộ': ('vi',), 'ố': ('vi',), 'ồ': ('vi',), 'ợ': ('vi',), 'ớ': ('vi',), 'ờ': ('vi',),
+}
+
+# частые триграммы латиницы, "_" - граница слова
+TRIGRAM_LANGUAGES = {
+    'en': '_th the he_ _an and nd_ ing ng_ _of of_ _to ion tio _in ent er_ ed_ is_ hat tha _wh ly_',
+    'de': 'en_ er_ ch_ der _de die _di ich ein sch cht und _un nd_ ie_ gen ung te_ _ei den',
+    'fr': 'es_ _de de_ le_ _le ent ion _la la_ les et_ _et que _qu ue_ ou_ _pa eur re_ des',
+    'es': '_de de_ os_ la_ _la el_ _el es_ en_ que _qu ue_ as_ ado _co con nte los _se ar_',
+    'it': '_di di_ la_ to_ re_ _la che _ch he_ ell lla zio ion one no_ are per _pe ato il_',
+    'pt': '_de de_ os_ do_ _do da_ _da que _qu ue_ as_ es_ nte _co com ent ar_ em_ _se',
+    'nl': 'en_ de_ _de van _va an_ et_ het _he ij_ een _ee er_ aar oor ing cht sch ie_ _ge',
+}
+TRIGRAMS: Dict[str, Tuple[str, ...]] = {}
+for _lang, _trigrams in TRIGRAM_LANGUAGES.items():
+    for _trigram in _trigrams.split():
+        _trigram = _trigram.replace('_', ' ')
+        TRIGRAMS[_trigram] = TRIGRAMS.get(_trigram, ()) + (_lang,)
+
+# уверенное решение по триграммам: фраза из нескольких слов (отдельные слова слишком неоднозначны),
+# не меньше MIN_TRIGRAM_HITS совпадений и в TRIGRAM_MARGIN раз больше, чем у языка письменности по умолчанию
+MIN_TRIGRAM_WORDS = 2
+# латиница: характерные буквы учитываются только во фразах из стольких слов (см. заимствования выше)
+MIN_LATIN_LETTER_WORDS = 2
+MIN_TRIGRAM_HITS = 3
+TRIGRAM_MARGIN = 2
+FIRST_LETTER_LANGUAGE_BONUS = 0.01
+
+
+def script_of(char: str) -> Optional[str]:
+    code = ord(char)
+    i = bisect_right(SCRIPT_RANGE_STARTS, code) - 1
+    if i >= 0 and code <= SCRIPT_RANGES[i][1]:
+        return SCRIPT_RANGES[i][2]
+    return None
+
+
+# письменности языков (для выбора среди языков словаря): по умолчанию, по характерным буквам и триграммам
+LANGUAGE_SCRIPTS: Dict[str, set] = {}
+for _script, _lang in SCRIPT_LANGUAGES.items():
+    LANGUAGE_SCRIPTS.setdefault(_lang, set()).add(_script)
+for _char, _langs in LETTER_LANGUAGES.items():
+    _script = script_of(_char)
+    for _lang in _langs if _script else ():
+        LANGUAGE_SCRIPTS.setdefault(_lang, set()).add(_script)
+for _lang in TRIGRAM_LANGUAGES:
+    LANGUAGE_SCRIPTS.setdefault(_lang, set()).add('latin')
+
+
+def detect_language_code(text: str, known_codes: Container[str] = None,
+                         preferred_codes: Iterable[str] = ()) -> Optional[str]:
+    """
+    код языка текста ('en', 'ru', 'uk', 'el', 'ja', ...) или None, если в тексте нет букв.
+    known_codes - допустимые коды (языки из таблицы), остальные кандидаты не рассматриваются.
+    preferred_codes - языки словаря: если среди них есть языки письменности текста, ответ - один из них.
+    """
+    scripts = Counter()
+    letters = Counter()
+    trigrams = Counter()
+
+    prev = prev_prev = ' '
+    for char in text.lower() + ' ':
+        script = script_of(char) if char.isalpha() else None
+        if script:
+            scripts[script] += 1
+        if char in LETTER_LANGUAGES:
+            letters[char] += 1
+
+        char = char if script else ' '
+        for code in TRIGRAMS.get(prev_prev + prev + char, ()):
+            trigrams[code] += 1
+        prev_prev, prev = prev, char
+
+    if not scripts:
+        return None
+
+    def is_known(code: str) -> bool:
+        return known_codes is None or code in known_codes
+
+    script = scripts.most_common(1)[0][0]
+    if script == 'han' and scripts['kana'] and is_known('ja'):
+        return 'ja'     # японский текст с кандзи
+    default = SCRIPT_LANGUAGES[script]
+
+    # голосуют только характерные буквы основной письменности (и знаки препинания вроде ¿)
+    votes = Counter()
+    for char, n in letters.items():
+        if script_of(char) in (script, None):
+            codes = LETTER_LANGUAGES[char]
+            for code in codes:
+                votes[code] += n / len(codes)
+            votes[codes[0]] += n * FIRST_LETTER_LANGUAGE_BONUS
+    votes = {code: n for code, n in votes.items() if is_known(code)}
+    trigrams = {code: n for code, n in trigrams.items() if is_known(code)}
+    words_count = len(text.split())
+
+    # латиница: без языков словаря отдельное слово остаётся языком по умолчанию, с ними - выбор среди них.
+    # Характерные буквы других письменностей (і, ї, ў, ...) не встречаются в заимствованиях и решают сами
+    is_latin = script == 'latin'
+    preferred = [code for code in preferred_codes if is_known(code) and script in LANGUAGE_SCRIPTS.get(code, ())]
+    if preferred and (is_latin or not votes or set(votes) & set(preferred)):
+        for candidates in (votes, trigrams):
+            candidates = {code: candidates[code] for code in preferred if code in candidates}
+            if candidates:
+                return max(candidates, key=candidates.get)
+        return default if default in preferred else preferred[0]
+
+    if is_latin and words_count < MIN_LATIN_LETTER_WORDS and is_known(default):
+        return default
+    if votes:
+        return max(votes, key=votes.get)
+
+    if is_latin and trigrams and words_count >= MIN_TRIGRAM_WORDS:
+        best = max(trigrams, key=trigrams.get)
+        if trigrams[best] >= MIN_TRIGRAM_HITS and trigrams[best] >= TRIGRAM_MARGIN * trigrams.get(default, 0):
+            return best
+    return default if is_known(default) else None
@@ -0,0 +1,74 @@
+"""
+Реестр языков в памяти процесса: таблица языков маленькая и почти не меняется,
+поэтому на горячем пути (разбор фраз, обработчики бота) к БД за ней не ходим.
+
+Реестр - неизменяемый снимок, при изменении языков заменяется целиком. Изменения в других процессах
+(например, в админке) замечаются по версии в кэше, которая проверяется не чаще раза в LANGUAGES_CHECK_INTERVAL сек.
+"""
+import threading
+import time
+from types import MappingProxyType
+from typing import Iterable, List, Optional
+
+from django.conf import settings
+from django.core.cache import cache
+
+from .langdetect import detect_language_code
+
+VERSION_KEY = 'languages:version'
+
+
+class LanguageRegistry:
+
+    def __init__(self, languages: Iterable['Language'], version: int):
+        self.version = version
+        self.by_id = MappingProxyType({lang.id: lang for lang in languages})
+        self.by_code = MappingProxyType({lang.code: lang for lang in self.by_id.values()})
+
+    def get(self, language_id) -> Optional['Language']:
+        try:
+            return self.by_id.get(int(language_id))
+        except (TypeError, ValueError):
+            return None
+
+    def get_by_code(self, code: str) -> Optional['Language']:
+        return self.by_code.get(code)
+
+    def filter(self, ids: Iterable[int]) -> List['Language']:
+        """языки с данными id в порядке Language.Meta.ordering"""
+        languages = filter(None, map(self.get, ids))
+        return sorted(languages, key=lambda lang: (-lang.priority, lang.name))
+
+    def detect(self, text: str, preferred: Iterable['Language'] = ()) -> Optional['Language']:
+        """язык текста из числа имеющихся в таблице; preferred - языки словаря (см. detect_language_code)"""
+        code = detect_language_code(text, known_codes=self.by_code, preferred_codes=[lang.code for lang in preferred])
+        return self.by_code.get(code) if code else None
+
+
+_registry = None
+_checked_at = 0.0
+_lock = threading.Lock()
+
+
+def get_registry() -> LanguageRegistry:
+    global _registry, _checked_at
+    registry = _registry
+    if registry is not None and time.monotonic() - _checked_at < settings.LANGUAGES_CHECK_INTERVAL:
+        return registry
+
+    from .models import Language
+
+    with _lock:
+        version = cache.get(VERSION_KEY, 0)
+        if _registry is None or _registry.version != version:
+            _registry = LanguageRegistry(Language.objects.all(), version)
+        _checked_at = time.monotonic()
+        return _registry
+
+
+def invalidate(**kwargs):
+    """таблица языков изменилась (обработчик post_save/post_delete Language)"""
+    global _registry
+    cache.add(VERSION_KEY, 0, timeout=None)
+    cache.incr(VERSION_KEY)
+    _registry = None
@@ -1,7 +1,7 @@
 from django.core.management.base import BaseCommand
 
 from bot.models import TelegramMessageEntity
-from dictionary.models import PhraseGroup, Phrase
+from dictionary.models import PhraseGroup, Phrase, DictionarySummary
 
 
 class Command(BaseCommand):
@@ -11,3 +11,5 @@ class Command(BaseCommand):
         print('deleted orphaned phrases:', Phrase.objects.orphans().delete()[1].get('dictionary.Phrase', 0))
         print('deleted empty groups:', PhraseGroup.objects.empty().delete()[1].get('dictionary.PhraseGroup', 0))
         print('deleted empty message entities:', TelegramMessageEntity.objects.empty().delete()[1].get('bot.TelegramMessageEntity', 0))
+        # сводки пересчитаются при следующем обращении
+        print('reset dictionary summaries:', DictionarySummary.objects.all().delete()[0])
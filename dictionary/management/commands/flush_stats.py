@@ -0,0 +1,9 @@
+from django.core.management.base import BaseCommand
+
+from dictionary.stats import flush
+
+
+class Command(BaseCommand):
+
+    def handle(self, *args: tuple, **options: dict):
+        print('flushed answers:', flush())
@@ -5,8 +5,10 @@ from bot.utils import fix_input_uppercase
 
 def fix_uppercase_phrases(apps, schema_editor):
     from dictionary.models import Phrase, Language
-    lang_en = Language.objects.get(code='en')
-    lang_ru = Language.objects.get(code='ru')
+    lang_en = Language.objects.filter(code='en').first()
+    lang_ru = Language.objects.filter(code='ru').first()
+    if not (lang_en and lang_ru):
+        return  # новая БД: языков (а значит и фраз) ещё нет
 
     phrases = Phrase.objects.filter(text__regex='[A-ZА-Я]')
     phrases_saved = 0
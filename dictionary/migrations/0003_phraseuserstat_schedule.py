@@ -0,0 +1,94 @@
+# Generated by Django 4.1 on 2026-10-18 06:38
+
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import migrations, models
+
+BATCH_SIZE = 1000
+
+# SM-2 на момент миграции (см. dictionary.repetition), не зависит от дальнейших изменений алгоритма
+DEFAULT_EASE = 2.5
+MIN_EASE = 1.3
+MAX_INTERVAL = 365
+
+
+def sm2(ease: float, interval: int, repetitions: int, is_guessed: bool) -> tuple:
+    quality = 5 if is_guessed else 2
+    if quality >= 3:
+        interval = 1 if repetitions == 0 else 6 if repetitions == 1 else round(interval * ease)
+        repetitions += 1
+    else:
+        interval, repetitions = 1, 0
+    ease = max(MIN_EASE, ease + 0.1 - (5 - quality) * (0.08 + (5 - quality) * 0.02))
+    return ease, min(MAX_INTERVAL, interval), repetitions
+
+
+def sm2_from_counters(trained_count: int, guessed_count: int) -> tuple:
+    """приближённое расписание по счётчикам ответов: считаем, что неудачные ответы были раньше удачных"""
+    schedule = (DEFAULT_EASE, 0, 0)
+    for _ in range(trained_count - guessed_count):
+        schedule = sm2(*schedule, False)
+        if schedule[0] == MIN_EASE:
+            break
+    for _ in range(guessed_count):
+        schedule = sm2(*schedule, True)
+        if schedule[1] == MAX_INTERVAL:
+            break
+    return schedule
+
+
+def backfill_schedules(apps, schema_editor):
+    """заполняет расписание повторений по накопленным счётчикам ответов"""
+    PhraseUserStat = apps.get_model('dictionary', 'PhraseUserStat')
+    qs = PhraseUserStat.objects.filter(trained_count__gt=0)\
+        .only('id', 'trained_count', 'guessed_count', 'modified')\
+        .order_by('id')
+
+    batch = []
+    for stat in qs.iterator(chunk_size=BATCH_SIZE):
+        stat.ease, stat.interval, stat.repetitions = sm2_from_counters(stat.trained_count, stat.guessed_count)
+        stat.due_at = stat.modified + timedelta(days=stat.interval)
+        batch.append(stat)
+
+        if len(batch) >= BATCH_SIZE:
+            PhraseUserStat.objects.bulk_update(batch, ['ease', 'interval', 'repetitions', 'due_at'])
+            batch = []
+
+    PhraseUserStat.objects.bulk_update(batch, ['ease', 'interval', 'repetitions', 'due_at'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('dictionary', '0002_fix_uppercase'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='phraseuserstat',
+            name='due_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='phraseuserstat',
+            name='ease',
+            field=models.FloatField(default=2.5),
+        ),
+        migrations.AddField(
+            model_name='phraseuserstat',
+            name='interval',
+            field=models.IntegerField(default=0, help_text='Days until next repetition'),
+        ),
+        migrations.AddField(
+            model_name='phraseuserstat',
+            name='repetitions',
+            field=models.IntegerField(default=0, help_text='Successful repetitions in a row'),
+        ),
+        migrations.AlterIndexTogether(
+            name='phraseuserstat',
+            index_together={('user', 'due_at')},
+        ),
+        migrations.RunPython(backfill_schedules, migrations.RunPython.noop),
+    ]
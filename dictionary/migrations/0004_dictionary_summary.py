@@ -0,0 +1,49 @@
+# Generated by Django 4.1 on 2026-10-18 06:44
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+import model_utils.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('dictionary', '0003_phraseuserstat_schedule'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DictionarySummary',
+            fields=[
+                ('created', model_utils.fields.AutoCreatedField(default=django.utils.timezone.now, editable=False, verbose_name='created')),
+                ('modified', model_utils.fields.AutoLastModifiedField(default=django.utils.timezone.now, editable=False, verbose_name='modified')),
+                ('dictionary', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='+', serialize=False, to='dictionary.dictionary')),
+                ('groups_count', models.IntegerField(default=0)),
+                ('phrases_count', models.JSONField(default=dict, help_text='Phrases count by language id')),
+            ],
+            options={
+                'verbose_name': 'Dictionary summary',
+                'verbose_name_plural': 'Dictionary summaries',
+            },
+        ),
+        migrations.CreateModel(
+            name='DictionaryUserProgress',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', model_utils.fields.AutoCreatedField(default=django.utils.timezone.now, editable=False, verbose_name='created')),
+                ('modified', model_utils.fields.AutoLastModifiedField(default=django.utils.timezone.now, editable=False, verbose_name='modified')),
+                ('trained_phrases_count', models.IntegerField(default=0)),
+                ('dictionary', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='user_progress', to='dictionary.dictionary')),
+                ('language', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='dictionary.language')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='dictionary_progress', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'Dictionary user progress',
+                'verbose_name_plural': 'Dictionary user progress',
+                'unique_together': {('user', 'dictionary', 'language')},
+            },
+        ),
+    ]
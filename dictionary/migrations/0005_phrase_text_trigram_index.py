@@ -0,0 +1,31 @@
+from django.db import migrations
+
+
+def create_trigram_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+
+    # индекс по тому же выражению, что генерирует lookup icontains: UPPER("text"::text) LIKE UPPER(...)
+    schema_editor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    schema_editor.execute(
+        'CREATE INDEX IF NOT EXISTS dictionary_phrase_text_upper_trgm '
+        'ON dictionary_phrase USING gin (UPPER(text::text) gin_trgm_ops)'
+    )
+
+
+def drop_trigram_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+
+    schema_editor.execute('DROP INDEX IF EXISTS dictionary_phrase_text_upper_trgm')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dictionary', '0004_dictionary_summary'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_trigram_index, drop_trigram_index),
+    ]
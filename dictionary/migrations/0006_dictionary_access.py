@@ -0,0 +1,53 @@
+# Generated by Django 4.1 on 2026-10-18 07:04
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def fill_access(apps, schema_editor):
+    Dictionary = apps.get_model('dictionary', 'Dictionary')
+    DictionaryAccess = apps.get_model('dictionary', 'DictionaryAccess')
+    viewer, editor, owner = 1, 2, 3
+
+    roles = {}
+    sources = [
+        (Dictionary.objects.all(), 'id', owner),
+        (Dictionary.editors.through.objects.all(), 'dictionary_id', editor),
+        (Dictionary.viewers.through.objects.all(), 'dictionary_id', viewer),
+    ]
+    for qs, dictionary_field, role in sources:
+        for user_id, dictionary_id in qs.values_list('user_id', dictionary_field).iterator():
+            key = (user_id, dictionary_id)
+            roles[key] = max(roles.get(key, 0), role)
+
+    DictionaryAccess.objects.bulk_create([
+        DictionaryAccess(user_id=user_id, dictionary_id=dictionary_id, role=role)
+        for (user_id, dictionary_id), role in roles.items()
+    ], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('dictionary', '0005_phrase_text_trigram_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DictionaryAccess',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('role', models.PositiveSmallIntegerField(choices=[(1, 'Viewer'), (2, 'Editor'), (3, 'Owner')])),
+                ('dictionary', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='access', to='dictionary.dictionary')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='dictionary_access', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'Dictionary access',
+                'verbose_name_plural': 'Dictionary access',
+                'unique_together': {('user', 'dictionary')},
+            },
+        ),
+        migrations.RunPython(fill_access, migrations.RunPython.noop),
+    ]
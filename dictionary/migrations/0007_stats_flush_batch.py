@@ -0,0 +1,24 @@
+# Generated by Django 4.1 on 2026-10-18 07:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dictionary', '0006_dictionary_access'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StatsFlushBatch',
+            fields=[
+                ('id', models.CharField(max_length=32, primary_key=True, serialize=False)),
+                ('created', models.DateTimeField(auto_now_add=True, db_index=True)),
+            ],
+            options={
+                'verbose_name': 'Stats flush batch',
+                'verbose_name_plural': 'Stats flush batches',
+            },
+        ),
+    ]
@@ -1,18 +1,23 @@
+from datetime import datetime, timedelta
 from typing import List
 import itertools
+import time
 
 from django.utils.translation import gettext_lazy as _
 from django.contrib.auth.models import User
 from django.db import models
 from django.db.models import CASCADE
-from django.db import IntegrityError, transaction
+from django.utils.functional import cached_property
 
 from model_utils import Choices
 from model_utils.models import TimeStampedModel
 
 from dictionary.querysets import LanguageQuerySet, DictionaryQuerySet, PhraseGroupQuerySet, PhraseQuerySet, \
-    DictionaryUserStatQuerySet, PhraseUserStatQuerySet
-from .exceptions import PhraseParseInputError
+    DictionaryUserStatQuerySet, PhraseUserStatQuerySet, DictionarySummaryQuerySet, DictionaryUserProgressQuerySet, \
+    DictionaryAccessQuerySet
+from . import repetition, stats
+from .languages import get_registry
+from .training import TrainingQueue
 
 
 class Language(models.Model):
@@ -79,52 +84,22 @@ class Phrase(TimeStampedModel):
         translations = ', '.join(translations)
         return f'{self.text} - {translations}'
 
-    def guessed_or_not(self, user, dictionary, is_guessed):
+    def guessed_or_not(self, user, dictionary, is_guessed, dst_lang: Language):
         # добавляет синонимы фразы на том же языке в кэш
         bucket = Phrase.objects.get_user_lang_bucket(user, self.lang)
         self.translations(self.lang).push_recent_phrase(bucket)
 
-        DictionaryUserStat.objects.get_training_stat_for_user(dictionary, user).increment_trained(is_guessed=is_guessed)
-        DictionaryUserStat.objects.get_total_stat_for_user(dictionary, user).increment_trained(is_guessed=is_guessed)
-        PhraseUserStat.objects.get_stat_for_user(self, user).increment_trained(is_guessed=is_guessed)
-
-    @classmethod
-    def parse_input(cls, input_str: str, user: User) -> List['Phrase']:
-        """
-        Парсит строку вида "phrase_en_1, phrase_en_2 - phrase_ru_3, phrase_ru_4",
-        возвращает список фраз с автоопределённым языком.
-        Если в списке есть существующие фразы, вернёт их из БД.
-        """
-        parts = input_str.split(' - ')
-        langs = []
-        phrases = []
-
-        for part in parts:
-            if not part:
-                raise PhraseParseInputError(_('Error: Definition contains empty part'))
-
-            lang = Language.objects.detect(part)
-
-            if not lang:
-                raise PhraseParseInputError(_('Error: Failed to detected phrase language: {}.').format(part))
-            if lang in langs:
-                raise PhraseParseInputError(_('Error: {} language detected twice. '
-                                              'Another phrase must me in different language').format(lang))
-
-            phrases_str = [s.strip() for s in part.split(',') if s.strip()]
-            if not phrases_str:
-                raise PhraseParseInputError(_('Error: Empty phrase for language {}').format(lang))
-
-            langs.append(lang)
-            kwargs_list = [dict(user=user, text=text, lang=lang) for text in phrases_str]
-            for kwargs in kwargs_list:
-                existing = Phrase.objects.filter(**kwargs).first()
-                phrases.append(existing or Phrase(**kwargs))
-
-        if len(langs) != 2:
-            raise PhraseParseInputError(_('Error: Invalid phrases count, expect 2'))
-
-        return phrases
+        # статистика запишется в БД при следующем stats.flush()
+        stats.push_answer(stats.Answer(
+            user_id=user.id,
+            dictionary_id=dictionary.id,
+            phrase_id=self.id,
+            src_lang_id=self.lang_id,
+            dst_lang_id=dst_lang.id,
+            is_guessed=bool(is_guessed),
+            timestamp=time.time(),
+        ))
+        TrainingQueue.for_training(user, dictionary, self.lang, dst_lang).rescore(self.id, stats.provisional_due_at())
 
 
 class PhraseGroup(TimeStampedModel):
@@ -147,54 +122,6 @@ class PhraseGroup(TimeStampedModel):
     def phrase_for_lang(self, language: Language):
         return self.phrases.filter(lang=language).pick_random()
 
-    @classmethod
-    def create_from_input(cls, input_str: str, user: User) -> dict:
-        """
-        Парсит строку, получает список фраз (новых и существующих).
-        Если есть только новые фразы, создаёт новую группу и помещает их туда.
-        Если есть существующие и новые фразы, не создаёт новую группу, а помещает новые фразы в существующие группы.
-        Если нет новых фраз, вызывает исключение.
-        """
-        phrases = Phrase.parse_input(input_str, user)
-        new_phrases = []
-        existing_phrases = []
-        existing_group_ids = set()
-
-        for phrase in phrases:
-            if phrase.id:
-                existing_phrases.append(phrase)
-                existing_group_ids |= set(phrase.phrase_groups.values_list('id', flat=True))
-            else:
-                new_phrases.append(phrase)
-
-        if not new_phrases:
-            raise PhraseParseInputError(_('Error: no new phrases found'))
-
-        existing_groups = PhraseGroup.objects.filter(id__in=existing_group_ids)
-        new_groups = []
-        try:
-            with transaction.atomic():
-                Phrase.objects.bulk_create(new_phrases)
-
-                for group in existing_groups:
-                    group.phrases.add(*new_phrases)
-
-                if not existing_group_ids:
-                    # если нет существующих фраз, создаём новую группу под новые фразы
-                    group = PhraseGroup.objects.create(user=user)
-                    group.phrases.add(*new_phrases)
-                    new_groups.append(group)
-
-        except IntegrityError:
-            raise PhraseParseInputError('Database error occurs, failed to save phrases to dictionary')
-
-        return {
-            'new_phrases': new_phrases,
-            'existing_phrases': existing_phrases,
-            'existing_groups': existing_groups,
-            'new_groups': new_groups
-        }
-
 
 class Dictionary(TimeStampedModel):
     name = models.CharField(max_length=64)
@@ -216,8 +143,12 @@ class Dictionary(TimeStampedModel):
     def __str__(self):
         return self.name
 
+    @cached_property
+    def summary(self) -> 'DictionarySummary':
+        return DictionarySummary.objects.for_dictionary(self)
+
     def languages(self):
-        return Language.objects.filter(phrases__phrase_groups__dictionaries=self).distinct()
+        return self.summary.languages()
 
     def language_combinations(self):
         return itertools.permutations(self.languages(), 2)
@@ -230,6 +161,34 @@ class Dictionary(TimeStampedModel):
         return DictionaryUserStat.objects.get_training_stat_for_user(self, user)
 
 
+class DictionaryAccess(models.Model):
+    """
+    Денормализованные права юзеров на словари: владелец, редакторы и читатели в одной таблице,
+    строка на пару (юзер, словарь) с наивысшей ролью. Поддерживается сигналами (см. dictionary.access).
+    """
+    ROLE = Choices(
+        (1, 'viewer', _('Viewer')),
+        (2, 'editor', _('Editor')),
+        (3, 'owner', _('Owner')),
+    )
+
+    user = models.ForeignKey(User, on_delete=CASCADE, related_name='dictionary_access')
+    dictionary = models.ForeignKey(Dictionary, on_delete=CASCADE, related_name='access')
+    role = models.PositiveSmallIntegerField(choices=ROLE)
+
+    objects = DictionaryAccessQuerySet.as_manager()
+
+    class Meta:
+        unique_together = [
+            ['user', 'dictionary']
+        ]
+        verbose_name = _('Dictionary access')
+        verbose_name_plural = _('Dictionary access')
+
+    def __str__(self):
+        return _('Dictionary access #{0}').format(self.id)
+
+
 class PhraseUserStat(TimeStampedModel):
     user = models.ForeignKey(User, on_delete=CASCADE, related_name='phrase_group_stats')
     phrase = models.ForeignKey(Phrase, on_delete=CASCADE, related_name='user_stats')
@@ -237,25 +196,53 @@ class PhraseUserStat(TimeStampedModel):
     guessed_count = models.IntegerField(default=0)
     guessed_ratio = models.FloatField(default=0)
 
+    # расписание повторений (SM-2)
+    ease = models.FloatField(default=repetition.DEFAULT_EASE)
+    interval = models.IntegerField(default=0, help_text=_('Days until next repetition'))
+    repetitions = models.IntegerField(default=0, help_text=_('Successful repetitions in a row'))
+    due_at = models.DateTimeField(blank=True, null=True)
+
     objects = PhraseUserStatQuerySet.as_manager()
 
     class Meta:
         unique_together = [
             ['user', 'phrase']
         ]
+        index_together = [
+            ['user', 'due_at']
+        ]
         verbose_name = _('Phrase user stat')
         verbose_name_plural = _('Phrase user stats')
 
     def __str__(self):
         return _('Phrase user stat #{0}').format(self.id)
 
-    def increment_trained(self, is_guessed: bool = False):
+    @property
+    def schedule(self) -> repetition.Schedule:
+        return repetition.Schedule(self.ease, self.interval, self.repetitions)
+
+    def apply_answer(self, is_guessed: bool, moment: datetime):
         self.trained_count += 1
         if is_guessed:
             self.guessed_count += 1
 
         self.guessed_ratio = 1.0 * self.guessed_count / self.trained_count
-        self.save()
+        self.ease, self.interval, self.repetitions = repetition.sm2(self.schedule, is_guessed)
+        self.due_at = moment + timedelta(days=self.interval)
+
+    def increment_row(self, trained_count: int, guessed_count: int) -> dict:
+        """строка для PhraseUserStat.objects.increment(): приращения счётчиков + текущее расписание"""
+        return {
+            'user_id': self.user_id,
+            'phrase_id': self.phrase_id,
+            'trained_count': trained_count,
+            'guessed_count': guessed_count,
+            'guessed_ratio': 1.0 * guessed_count / trained_count,
+            'ease': self.ease,
+            'interval': self.interval,
+            'repetitions': self.repetitions,
+            'due_at': self.due_at,
+        }
 
 
 class DictionaryUserStat(TimeStampedModel):
@@ -283,26 +270,60 @@ class DictionaryUserStat(TimeStampedModel):
     def guessed_ratio(self) -> float:
         return 1.0 * self.guessed_count / self.trained_count if self.trained_count else 0.0
 
-    def increment_trained(self, is_guessed: bool = False):
-        self.trained_count += 1
-        if is_guessed:
-            self.guessed_count += 1
-        self.save()
+    def with_pending(self) -> 'DictionaryUserStat':
+        """добавляет к счётчикам ещё не записанные в БД ответы (только для чтения, не сохранять)"""
+        trained_count, guessed_count = stats.pending_counters(self.user_id, self.dict_id, self.kind)
+        self.trained_count += trained_count
+        self.guessed_count += guessed_count
+        return self
+
+    def reset(self):
+        with stats.flush_lock():
+            DictionaryUserStat.objects.filter(user_id=self.user_id, dict_id=self.dict_id, kind=self.kind).delete()
+            stats.reset_pending_counters(self.user_id, self.dict_id, self.kind)
 
     def is_training_completed(self, src_lang: Language, dst_lang: Language):
         # если кол-во тренированных слов совпадает с числом групп фраз, содержащих слова на обоих языках
         groups_count = self.dict.phrase_groups.filter(phrases__lang=src_lang).filter(phrases__lang=dst_lang).count()
         return self.trained_count >= groups_count
 
-    def get_progress(self, language=None):
-        phrases_qs = self.dict.phrases
-        if language:
-            phrases_qs = phrases_qs.filter(lang=language)
 
-        trained_phrases_qs = phrases_qs.filter(user_stats__user=self.user, user_stats__trained_count__gt=0)
+class DictionarySummary(TimeStampedModel):
+    """
+    Денормализованная сводка по словарю, поддерживается инкрементально
+    (PhraseImport, удаление фраз) и строится с нуля при первом обращении.
+    """
+    dictionary = models.OneToOneField(Dictionary, on_delete=CASCADE, primary_key=True, related_name='+')
+    groups_count = models.IntegerField(default=0)
+    phrases_count = models.JSONField(default=dict, help_text=_('Phrases count by language id'))
+
+    objects = DictionarySummaryQuerySet.as_manager()
+
+    class Meta:
+        verbose_name = _('Dictionary summary')
+        verbose_name_plural = _('Dictionary summaries')
+
+    def __str__(self):
+        return _('Dictionary summary #{0}').format(self.dictionary_id)
+
+    @property
+    def language_ids(self) -> List[int]:
+        return [int(lang_id) for lang_id, count in self.phrases_count.items() if count > 0]
+
+    def languages(self) -> List[Language]:
+        return get_registry().filter(self.language_ids)
+
+    def get_progress(self, trained_phrases: dict, language: Language = None):
+        """
+        trained_phrases: {lang_id: кол-во тренированных юзером фраз}, см. DictionaryUserProgress
+        """
+        if language:
+            phrases_count = self.phrases_count.get(str(language.id), 0)
+            trained_phrases_count = trained_phrases.get(language.id, 0)
+        else:
+            phrases_count = sum(self.phrases_count.values())
+            trained_phrases_count = sum(trained_phrases.values())
 
-        phrases_count = phrases_qs.count()
-        trained_phrases_count = trained_phrases_qs.count()
         trained_ratio = 1.0 * trained_phrases_count / phrases_count if phrases_count else 0
 
         return {
@@ -310,3 +331,39 @@ class DictionaryUserStat(TimeStampedModel):
             'trained_phrases_count': trained_phrases_count,
             'trained_ratio': trained_ratio
         }
+
+
+class DictionaryUserProgress(TimeStampedModel):
+    """Кол-во тренированных юзером фраз словаря на каждом языке"""
+    user = models.ForeignKey(User, on_delete=CASCADE, related_name='dictionary_progress')
+    dictionary = models.ForeignKey(Dictionary, on_delete=CASCADE, related_name='user_progress')
+    language = models.ForeignKey(Language, on_delete=CASCADE, related_name='+')
+    trained_phrases_count = models.IntegerField(default=0)
+
+    objects = DictionaryUserProgressQuerySet.as_manager()
+
+    class Meta:
+        unique_together = [
+            ['user', 'dictionary', 'language']
+        ]
+        verbose_name = _('Dictionary user progress')
+        verbose_name_plural = _('Dictionary user progress')
+
+    def __str__(self):
+        return _('Dictionary user progress #{0}').format(self.id)
+
+
+class StatsFlushBatch(models.Model):
+    """
+    Пачки статистики, уже применённые к БД (см. dictionary.stats.flush): записывается в одной транзакции
+    со статистикой, повторный flush той же пачки (после сбоя до очистки redis) её пропускает.
+    """
+    id = models.CharField(max_length=32, primary_key=True)
+    created = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    class Meta:
+        verbose_name = _('Stats flush batch')
+        verbose_name_plural = _('Stats flush batches')
+
+    def __str__(self):
+        return self.id
@@ -1,7 +1,10 @@
+from typing import FrozenSet, Iterable, List, Optional
+
 from django.contrib.auth import get_user_model
 from django.contrib.auth.models import Permission
 
 from dictionary import models
+from dictionary.access import access_cache, get_object_dictionary_ids, get_objects_dictionary_ids
 
 UserModel = get_user_model()
 
@@ -27,6 +30,62 @@ DICT_EDITOR_PERMS = {
     'delete_phrasegroup',
 }
 
+DICT_OWNER_PERMS = DICT_EDITOR_PERMS | {
+    'delete_dictionary',
+}
+
+ROLE_PERMS = {
+    models.DictionaryAccess.ROLE.viewer: DICT_VIEWER_PERMS,
+    models.DictionaryAccess.ROLE.editor: DICT_EDITOR_PERMS,
+    models.DictionaryAccess.ROLE.owner: DICT_OWNER_PERMS,
+}
+
+
+def get_dictionary_ids(obj) -> Optional[FrozenSet[int]]:
+    """id словарей, в которые входит объект (None - объект не относится к словарям), из кэша (см. dictionary.access)"""
+    if isinstance(obj, models.Dictionary):
+        return frozenset([obj.id])
+    if isinstance(obj, (models.PhraseGroup, models.Phrase)):
+        return get_object_dictionary_ids(obj)
+    return None
+
+
+def get_role(user_obj, dictionary_ids: Iterable[int]) -> int:
+    """наивысшая роль юзера в словарях (0 - нет доступа), без запросов к БД (см. dictionary.access)"""
+    roles = access_cache.get(user_obj.id)
+    return max((roles.get(dictionary_id, 0) for dictionary_id in dictionary_ids), default=0)
+
+
+def check_perm(user_obj, perm: str, obj, dictionary_ids: Optional[FrozenSet[int]]) -> bool:
+    """право perm на объект, входящий в словари dictionary_ids (см. get_dictionary_ids)"""
+    if isinstance(obj, models.Dictionary):
+        role = get_role(user_obj, [obj.id])
+        return role == models.DictionaryAccess.ROLE.owner or perm in ROLE_PERMS.get(role, ())
+
+    if getattr(obj, 'user_id', None) == user_obj.id:
+        return True
+    if not dictionary_ids:
+        return False
+
+    # права на удаление словаря к его фразам и группам не относятся
+    role = min(get_role(user_obj, dictionary_ids), models.DictionaryAccess.ROLE.editor)
+    return perm in ROLE_PERMS.get(role, ())
+
+
+def objects_with_perm(user_obj, perm: str, objs: Iterable) -> List:
+    """
+    проверка права perm на много объектов (словарей, групп фраз, фраз) за один вызов: те из objs, на которые
+    оно есть. Словари групп и фраз - одним запросом к redis (см. dictionary.access.get_objects_dictionary_ids)
+    """
+    objs = list(objs)
+    if not user_obj.is_active or user_obj.is_anonymous:
+        return []
+
+    related = get_objects_dictionary_ids(
+        obj for obj in objs if isinstance(obj, (models.PhraseGroup, models.Phrase))
+    )
+    return [obj for obj in objs if check_perm(user_obj, perm, obj, related.get(obj))]
+
 
 class DictionaryPermissionsBackend:
 
@@ -38,31 +97,19 @@ class DictionaryPermissionsBackend:
         if not user_obj.is_active or user_obj.is_anonymous or obj is None:
             return set()
 
-        if isinstance(obj, models.Phrase):
-            is_editor = obj.phrase_groups.filter(dictionary__editors=user_obj).exists()
-            is_viewer = obj.phrase_groups.filter(dictionary__viewers=user_obj).exists()
-        elif isinstance(obj, models.PhraseGroup):
-            is_editor = obj.dictionary.editors.filter(id=user_obj).exists()
-            is_viewer = obj.dictionary.viewers.filter(id=user_obj).exists()
-        elif isinstance(obj, models.Dictionary):
-            is_editor = obj.editors.filter(id=user_obj.id).exists()
-            is_viewer = obj.viewers.filter(id=user_obj.id).exists()
-        else:
+        dictionary_ids = get_dictionary_ids(obj)
+        if not dictionary_ids:
             return set()
 
-        ret = set()
-        if is_viewer:
-            ret |= DICT_VIEWER_PERMS
-        if is_editor:
-            ret |= DICT_EDITOR_PERMS
-
-        return ret
+        role = get_role(user_obj, dictionary_ids)
+        if not isinstance(obj, models.Dictionary):
+            # права на удаление словаря к его фразам и группам не относятся
+            role = min(role, models.DictionaryAccess.ROLE.editor)
+        return set(ROLE_PERMS.get(role, ()))
 
     def has_perm(self, user_obj, perm, obj=None):
         if not user_obj.is_active or not obj:
             return False
 
-        if getattr(obj, 'user', None) == user_obj:
-            return True
-
-        return perm in self.get_all_permissions(user_obj, obj)
+        dictionary_ids = None if isinstance(obj, models.Dictionary) else get_dictionary_ids(obj)
+        return check_perm(user_obj, perm, obj, dictionary_ids)
@@ -0,0 +1,137 @@
+import threading
+import uuid
+from bisect import bisect_left
+from collections import OrderedDict, defaultdict
+from typing import List, NamedTuple, Iterable
+
+from django.conf import settings
+from django.core.cache import cache
+
+VERSION_KEY = 'prefix_index:user:{}:version'
+
+
+class IndexEntry(NamedTuple):
+    key: str    # текст фразы в нижнем регистре
+    text: str
+    translations: str   # "перевод1, перевод2 [ru]"
+
+
+class PrefixIndex:
+    """
+    Поиск фраз по началу текста в памяти процесса: отсортированный массив + bisect.
+    """
+
+    def __init__(self, entries: Iterable[IndexEntry]):
+        self.entries = sorted(entries)
+        self.keys = [e.key for e in self.entries]
+
+    def __len__(self):
+        return len(self.entries)
+
+    def search(self, prefix: str, limit: int) -> List[IndexEntry]:
+        prefix = prefix.strip().lower()
+        ret = []
+        i = bisect_left(self.keys, prefix)
+        while i < len(self.keys) and len(ret) < limit and self.keys[i].startswith(prefix):
+            ret.append(self.entries[i])
+            i += 1
+        return ret
+
+    @classmethod
+    def build_for_user(cls, user_id: int) -> 'PrefixIndex':
+        """индекс по всем фразам доступных юзеру словарей с переводами (одним запросом)"""
+        from .models import Dictionary, Phrase
+
+        dictionary_ids = Dictionary.objects.filter(id__in=Dictionary.objects.for_user(user_id)).values('id')
+        rows = Phrase.objects.filter(phrase_groups__dictionaries__in=dictionary_ids)\
+            .values_list('phrase_groups', 'id', 'text', 'lang__code').order_by().distinct()
+
+        groups = defaultdict(list)
+        for group_id, phrase_id, text, lang_code in rows:
+            groups[group_id].append((phrase_id, text, lang_code))
+
+        texts = {}
+        translations = defaultdict(lambda: defaultdict(set))
+        for phrases in groups.values():
+            for phrase_id, text, lang_code in phrases:
+                texts[phrase_id] = text
+                for _, other_text, other_lang_code in phrases:
+                    if other_lang_code != lang_code:
+                        translations[phrase_id][other_lang_code].add(other_text)
+
+        return cls(
+            IndexEntry(
+                key=texts[phrase_id].lower(),
+                text=texts[phrase_id],
+                translations='; '.join(
+                    '{} [{}]'.format(', '.join(sorted(t)), lang_code) for lang_code, t in sorted(by_lang.items())
+                ),
+            )
+            for phrase_id, by_lang in translations.items()
+        )
+
+
+class PrefixIndexCache:
+    """
+    Индексы юзеров, строятся лениво при первом запросе, не более size штук (LRU).
+    Актуальность индекса проверяется по версии в redis (как в dictionary.access), так что
+    сброс (см. invalidate) из любого процесса виден всем процессам.
+    """
+
+    def __init__(self, size: int):
+        self.size = size
+        self.indexes = OrderedDict()    # user_id -> (версия, индекс)
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def get_version(user_id: int) -> str:
+        key = VERSION_KEY.format(user_id)
+        version = cache.get(key)
+        if version is None:
+            version = uuid.uuid4().hex
+            if not cache.add(key, version, timeout=None):
+                version = cache.get(key) or version
+        return version
+
+    def get(self, user_id: int) -> PrefixIndex:
+        # версия читается до построения: сброс во время построения не потеряется
+        version = self.get_version(user_id)
+        with self.lock:
+            entry = self.indexes.get(user_id)
+            if entry is not None and entry[0] == version:
+                self.indexes.move_to_end(user_id)
+                return entry[1]
+
+        index = PrefixIndex.build_for_user(user_id)
+        with self.lock:
+            self.indexes[user_id] = (version, index)
+            self.indexes.move_to_end(user_id)
+            while len(self.indexes) > self.size:
+                self.indexes.popitem(last=False)
+        return index
+
+    def invalidate(self, user_ids: Iterable[int]):
+        user_ids = list(user_ids)
+        if not user_ids:
+            return
+        cache.delete_many([VERSION_KEY.format(user_id) for user_id in user_ids])
+        with self.lock:
+            for user_id in user_ids:
+                self.indexes.pop(user_id, None)
+
+    def invalidate_dictionary(self, dictionary):
+        """сбрасывает индексы всех юзеров, имеющих доступ к словарю"""
+        self.invalidate_dictionaries([dictionary.id])
+
+    def invalidate_dictionaries(self, dictionary_ids: Iterable[int]):
+        """сбрасывает индексы всех юзеров, имеющих доступ хотя бы к одному из словарей"""
+        from dictionary.models import DictionaryAccess
+
+        dictionary_ids = list(dictionary_ids)
+        if dictionary_ids:
+            self.invalidate(set(
+                DictionaryAccess.objects.filter(dictionary_id__in=dictionary_ids).values_list('user_id', flat=True)
+            ))
+
+
+prefix_indexes = PrefixIndexCache(settings.PREFIX_INDEX_CACHE_SIZE)
@@ -1,23 +1,34 @@
 import random
-from typing import List
-from string import ascii_letters
+from collections import defaultdict
+from typing import Dict, Iterable, List
 
-from django.core.cache import cache
-from django.db.models import QuerySet, Q, Count
+from django.db import connections, transaction
+from django.db.models import QuerySet, Q, Subquery, Count, Case, When, Value, FloatField, F, Window, ExpressionWrapper
+from django.db.models.functions import Length, DenseRank, Greatest
 from django.contrib.auth.models import User
 from django.conf import settings
+from django.utils import timezone
+
+from dictionary import versions
+from dictionary.cache import get_redis, make_key
+
+# KEYS[1] - список, ARGV: длина списка, TTL, id фраз (первый окажется в начале)
+PUSH_RECENT_SCRIPT = """
+for i = #ARGV, 3, -1 do
+    redis.call('lrem', KEYS[1], 0, ARGV[i])
+    redis.call('lpush', KEYS[1], ARGV[i])
+end
+redis.call('ltrim', KEYS[1], 0, ARGV[1] - 1)
+redis.call('expire', KEYS[1], ARGV[2])
+"""
 
 
 class LanguageQuerySet(QuerySet):
 
     def detect(self, text: str):
-        if not text:
-            return None
-
-        # TODO: годится только для internal use
-        if text[0] in ascii_letters:
-            return self.english()
-        return self.russian()
+        """язык текста (без запросов к БД, см. dictionary.languages)"""
+        from .languages import get_registry
+        return get_registry().detect(text)
 
     def english(self):
         return self.get(code='en')
@@ -26,6 +37,27 @@ class LanguageQuerySet(QuerySet):
         return self.get(code='ru')
 
 
+class KeysetQuerySet(QuerySet):
+    keyset_field = None     # поле сортировки, вторая часть ключа - id
+
+    def seek(self, cursor_id: int, direction: int, count: int) -> list:
+        """
+        keyset-пагинация по (keyset_field, id), одним запросом: count объектов после объекта cursor_id
+        (direction > 0) или перед ним (direction < 0), без cursor_id - первые (последние) count объектов.
+        Возвращает объекты в порядке (keyset_field, id).
+        """
+        field = self.keyset_field
+        qs = self
+        if cursor_id:
+            cursor_value = Subquery(self.model.objects.filter(id=cursor_id).values(field)[:1])
+            op = 'gt' if direction >= 0 else 'lt'
+            qs = qs.filter(Q(**{f'{field}__{op}': cursor_value}) | Q(**{field: cursor_value, f'id__{op}': cursor_id}))
+
+        if direction >= 0:
+            return list(qs.order_by(field, 'id')[:count])
+        return list(qs.order_by(f'-{field}', '-id')[:count])[::-1]
+
+
 class RandomizeQuerySet(QuerySet):
 
     def ids(self):
@@ -36,60 +68,115 @@ class RandomizeQuerySet(QuerySet):
         return self.get(id=random.choice(ids)) if ids else None
 
 
-class DictionaryQuerySet(QuerySet):
+class DictionaryQuerySet(KeysetQuerySet):
+    keyset_field = 'name'
 
     def for_user(self, user: User):
-        return self.filter(Q(user=user) | Q(viewers=user) | Q(editors=user)).distinct()
-
-
-class PhraseQuerySet(RandomizeQuerySet):
+        """словари, доступные юзеру (свои, на чтение и запись), см. DictionaryAccess"""
+        return self.filter(access__user=user)
+
+
+class DictionaryAccessQuerySet(QuerySet):
+
+    def rebuild(self, dictionary_ids: Iterable[int]):
+        """пересчёт прав на словари по владельцу, редакторам и читателям"""
+        from .access import invalidate_users
+        from .models import Dictionary, DictionaryAccess
+
+        dictionary_ids = set(dictionary_ids)
+        if not dictionary_ids:
+            return
+
+        roles = {}
+        sources = [
+            (Dictionary.objects.filter(id__in=dictionary_ids), 'id', DictionaryAccess.ROLE.owner),
+            (Dictionary.editors.through.objects.filter(dictionary_id__in=dictionary_ids), 'dictionary_id', DictionaryAccess.ROLE.editor),
+            (Dictionary.viewers.through.objects.filter(dictionary_id__in=dictionary_ids), 'dictionary_id', DictionaryAccess.ROLE.viewer),
+        ]
+        for qs, dictionary_field, role in sources:
+            for user_id, dictionary_id in qs.values_list('user_id', dictionary_field):
+                key = (user_id, dictionary_id)
+                roles[key] = max(roles.get(key, 0), role)
+
+        with transaction.atomic():
+            existing = {
+                (access.user_id, access.dictionary_id): access
+                for access in self.select_for_update().filter(dictionary_id__in=dictionary_ids)
+            }
+            self.filter(id__in=[access.id for key, access in existing.items() if key not in roles]).delete()
+
+            changed = []
+            for key, access in existing.items():
+                if key in roles and access.role != roles[key]:
+                    access.role = roles[key]
+                    changed.append(access)
+            self.bulk_update(changed, ['role'])
+
+            self.bulk_create([
+                DictionaryAccess(user_id=user_id, dictionary_id=dictionary_id, role=role)
+                for (user_id, dictionary_id), role in roles.items()
+                if (user_id, dictionary_id) not in existing
+            ], ignore_conflicts=True)
+
+            user_ids = {user_id for user_id, _ in roles} | {user_id for user_id, _ in existing}
+            transaction.on_commit(lambda: invalidate_users(user_ids))
+
+
+class PhraseQuerySet(RandomizeQuerySet, KeysetQuerySet):
+    keyset_field = 'text'
 
     @staticmethod
     def get_user_lang_bucket(user: User, lang) -> str:
-        return f'user:{user.id}:lang:{lang.id}:recent_phrases'
+        return make_key(f'user:{user.id}:lang:{lang.id}:recent_phrase_ids')
 
     @staticmethod
-    def get_recent_phrases_ids(bucket: str) -> List[str]:
-        d = cache.get(bucket)
-        return d.split(',') if d else []
+    def get_recent_phrases_ids(bucket: str) -> List[int]:
+        return [int(i) for i in get_redis().lrange(bucket, 0, -1)]
 
     def get_recent_phrases(self, bucket: str):
         return self.filter(id__in=self.get_recent_phrases_ids(bucket))
 
     def push_recent_phrase(self, bucket: str):
         """
-        добавляет в кэшированный список последних фраз юзера новый id в начало,
-        при этом обрезая список с конца при необходимости
+        добавляет в список последних фраз юзера (redis list) новые id в начало,
+        при этом обрезая список с конца при необходимости. Атомарно, за один запрос к redis.
         """
-        ids = self.get_recent_phrases_ids(bucket)
-        new_ids = list(map(str, self.values_list('id', flat=True)))
-        for i in new_ids:
-            if i in ids:
-                ids.remove(i)
-
-        ids = new_ids + ids
-        d = ','.join(ids[0:settings.RECENT_PHRASES])
-        cache.set(bucket, d)
+        new_ids = list(self.values_list('id', flat=True))
+        if new_ids:
+            get_redis().eval(
+                PUSH_RECENT_SCRIPT, 1, bucket, settings.RECENT_PHRASES, settings.RECENT_PHRASES_TTL, *new_ids
+            )
+
+    def for_training(self, dictionary, src_lang, dst_lang):
+        """фразы словаря на языке src_lang, у которых есть перевод на dst_lang"""
+        return self.filter(phrase_groups__dictionaries=dictionary, lang=src_lang)\
+            .filter(phrase_groups__phrases__lang=dst_lang).distinct()
 
     def get_next_for_training(self, user: User, dictionary, src_lang, dst_lang):
-        """первое нетренированное слово из словаря, либо наименее тренированное"""
-        qs = self.filter(phrase_groups__dictionaries=dictionary, lang=src_lang)\
-            .filter(phrase_groups__phrases__lang=dst_lang).distinct()
+        """
+        следующая фраза очереди тренировки (см. TrainingQueue): нетренированные в случайном порядке,
+        затем по времени повторения, кроме недавно показанных юзеру
+        """
+        from .training import TrainingQueue
+
+        queue = TrainingQueue.for_training(user, dictionary, src_lang, dst_lang)
+        content_version = queue.content_version()
+        if not queue.is_actual(content_version):
+            queue.build(content_version)
 
         recent_ids = self.get_recent_phrases_ids(self.get_user_lang_bucket(user, src_lang))
 
-        # первое нетренированное слово из словаря
-        phrase = qs.exclude(user_stats__user=user, id__in=recent_ids).pick_random()
-        if not phrase:
-            # тренированные слова, начиная с наимеее угаданного
-            qs = qs.filter(user_stats__user=user).order_by('user_stats__guessed_ratio')
+        while 1:
+            phrase_id = queue.next(recent_ids)
+            if phrase_id is None:
+                return None
+
+            phrase = self.for_training(dictionary, src_lang, dst_lang).filter(id=phrase_id).first()
+            if phrase:
+                return phrase
 
-            # возвращаем первое слово не из буффера
-            # если таких нет, то последнее из буффера
-            if qs.count() > len(recent_ids):
-                return qs.exclude(id__in=recent_ids).first()
-            return self.get(id=recent_ids[-1])
-        return phrase
+            # фраза удалена или убрана из словаря после построения очереди
+            queue.remove(phrase_id)
 
     def orphans(self):
         return self.filter(phrase_groups=None)
@@ -100,13 +187,87 @@ class PhraseQuerySet(RandomizeQuerySet):
         return PhraseGroup.objects.filter(id__in=list(ids))
 
     def search(self, template: str):
-        return self.filter(text__icontains=template)
+        """
+        фразы, содержащие шаблон (без учёта регистра), начиная с наиболее похожих.
+        В postgres подстрока ищется по GIN-индексу pg_trgm на UPPER(text) (см. миграцию 0005),
+        похожесть - триграммная; в остальных БД (sqlite для локального запуска) - сначала совпадения по началу и короткие.
+        """
+        if connections[self.db].vendor == 'postgresql':
+            from django.contrib.postgres.search import TrigramSimilarity
+            similarity = TrigramSimilarity('text', template)
+        else:
+            is_prefix = Case(When(text__istartswith=template, then=Value(1.0)), default=Value(0.0))
+            similarity = ExpressionWrapper(is_prefix + 1.0 / (Length('text') + 1), output_field=FloatField())
+
+        return self.filter(text__icontains=template).annotate(similarity=similarity).order_by('-similarity', 'text')
+
+    def search_in_dictionaries(self, template: str, dictionary_ids: List[int], limit_per_dictionary: int) -> List[tuple]:
+        """
+        поиск по нескольким словарям одним запросом: не более limit_per_dictionary лучших фраз на словарь
+        (оконная функция DENSE_RANK по словарю, фраза из нескольких групп словаря считается один раз).
+        Возвращает [(dictionary_id, phrase_id, text, lang_id)], упорядоченные по словарю и похожести.
+        """
+        qs = self.search(template).filter(phrase_groups__dictionaries__in=dictionary_ids).order_by().values(
+            found_dictionary_id=F('phrase_groups__dictionaries'),
+            found_phrase_id=F('id'),
+            found_text=F('text'),
+            found_lang_id=F('lang_id'),
+            found_rank=Window(
+                DenseRank(),
+                partition_by=[F('phrase_groups__dictionaries')],
+                order_by=[F('similarity').desc(), F('text'), F('id')],
+            ),
+        ).distinct()
+
+        connection = connections[self.db]
+        qn = connection.ops.quote_name
+        sql, params = qs.query.sql_with_params()
+        columns = ', '.join(map(qn, ['found_dictionary_id', 'found_phrase_id', 'found_text', 'found_lang_id']))
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'SELECT {columns} FROM ({sql}) ranked WHERE {qn("found_rank")} <= %s '
+                f'ORDER BY {qn("found_dictionary_id")}, {qn("found_rank")}',
+                params + (limit_per_dictionary,)
+            )
+            return cursor.fetchall()
+
+    def translations_in_dictionaries(self, pairs: List[tuple]) -> Dict[tuple, Dict[int, List[str]]]:
+        """
+        переводы фраз в пределах групп словаря одним запросом
+        pairs: [(dictionary_id, phrase_id)]
+        возвращает {(dictionary_id, phrase_id): {lang_id: [тексты]}}, включая синонимы на том же языке
+        """
+        ret = defaultdict(lambda: defaultdict(list))
+        if not pairs:
+            return ret
+
+        pairs = set(pairs)
+        rows = self.filter(
+            phrase_groups__dictionaries__in={d for d, p in pairs},
+            phrase_groups__phrases__in={p for d, p in pairs},
+        ).values_list('phrase_groups__dictionaries', 'phrase_groups__phrases', 'id', 'lang_id', 'text')\
+            .order_by('text').distinct()
+
+        seen = set()
+        for dictionary_id, phrase_id, translation_id, lang_id, text in rows:
+            key = (dictionary_id, phrase_id)
+            if key in pairs and translation_id != phrase_id and (key, translation_id) not in seen:
+                seen.add((key, translation_id))
+                ret[key][lang_id].append(text)
+        return ret
 
     def delete(self):
-        groups = self.phrase_groups()
-        ret = super().delete()
-        # следом удаляем пустые группы
-        groups.empty().delete()
+        from .models import DictionarySummary
+
+        with transaction.atomic():
+            groups = self.phrase_groups()
+            DictionarySummary.objects.remove_phrases(self)
+            ret = super().delete()
+
+            # следом удаляем пустые группы
+            empty_groups = groups.empty()
+            DictionarySummary.objects.remove_groups(list(empty_groups.values_list('id', flat=True)))
+            empty_groups.delete()
         return ret
 
 
@@ -123,19 +284,227 @@ class PhraseGroupQuerySet(RandomizeQuerySet):
         return self.filter(dictionaries=None)
 
 
-class PhraseUserStatQuerySet(QuerySet):
+class CountersQuerySet(QuerySet):
+    """
+    Статистика со счётчиками, которые увеличиваются атомарно одним запросом
+    INSERT ... ON CONFLICT DO UPDATE SET counter = counter + EXCLUDED.counter,
+    без чтения строки и без гонок между потоками и процессами.
+    Отрицательные приращения строк не создают и не опускают счётчики ниже нуля (см. decrement).
+    """
+    unique_fields = ()
+    counter_fields = ('trained_count', 'guessed_count')
+    upsert_batch_size = 500
+
+    def get_conflict_update_sql(self, table: str, qn) -> Dict[str, str]:
+        """выражения для SET: table - текущая строка, EXCLUDED - вставляемая"""
+        ret = {f: f'{table}.{qn(f)} + EXCLUDED.{qn(f)}' for f in self.counter_fields}
+        ret['modified'] = f'EXCLUDED.{qn("modified")}'
+        return ret
+
+    def increment(self, rows: List[dict]):
+        """
+        rows: значения unique_fields, приращения counter_fields и прочие поля модели,
+        которые при вставке новой строки записываются как есть
+        """
+        decrements = [row for row in rows if any(row.get(f, 0) < 0 for f in self.counter_fields)]
+        if decrements:
+            self.decrement(decrements)
+            rows = [row for row in rows if not any(row.get(f, 0) < 0 for f in self.counter_fields)]
+        if not rows:
+            return
+
+        connection = connections[self.db]
+        qn = connection.ops.quote_name
+        opts = self.model._meta
+        table = qn(opts.db_table)
+        now = timezone.now()
+        rows = [{'created': now, 'modified': now, **row} for row in rows]
+
+        columns = list(rows[0].keys())
+        fields = [opts.get_field(c) for c in columns]
+        update_sql = ', '.join(f'{qn(c)} = {sql}' for c, sql in self.get_conflict_update_sql(table, qn).items())
+        row_sql = '(' + ', '.join(['%s'] * len(columns)) + ')'
+
+        with connection.cursor() as cursor:
+            for i in range(0, len(rows), self.upsert_batch_size):
+                batch = rows[i:i + self.upsert_batch_size]
+                params = [
+                    field.get_db_prep_save(row[column], connection)
+                    for row in batch
+                    for column, field in zip(columns, fields)
+                ]
+                cursor.execute(
+                    f'INSERT INTO {table} ({", ".join(map(qn, columns))}) '
+                    f'VALUES {", ".join([row_sql] * len(batch))} '
+                    f'ON CONFLICT ({", ".join(map(qn, self.unique_fields))}) DO UPDATE SET {update_sql}',
+                    params
+                )
+
+    def decrement(self, rows: List[dict]):
+        """уменьшение счётчиков только существующих строк, не ниже нуля: UPDATE ... SET counter = GREATEST(...)"""
+        now = timezone.now()
+        with transaction.atomic(using=self.db):
+            for row in rows:
+                self.filter(**{f: row[f] for f in self.unique_fields}).update(
+                    modified=now,
+                    **{f: Greatest(F(f) + row[f], 0) for f in self.counter_fields if f in row}
+                )
+
+
+class PhraseUserStatQuerySet(CountersQuerySet):
+    unique_fields = ('user_id', 'phrase_id')
+    # расписание повторений рассчитывает единственный писатель (stats.flush под блокировкой)
+    schedule_fields = ('ease', 'interval', 'repetitions', 'due_at')
+
+    def get_conflict_update_sql(self, table: str, qn) -> Dict[str, str]:
+        ret = super().get_conflict_update_sql(table, qn)
+        # в SET справа везде старые значения строки
+        ret['guessed_ratio'] = \
+            f'1.0 * ({table}.{qn("guessed_count")} + EXCLUDED.{qn("guessed_count")}) ' \
+            f'/ ({table}.{qn("trained_count")} + EXCLUDED.{qn("trained_count")})'
+        ret.update({f: f'EXCLUDED.{qn(f)}' for f in self.schedule_fields})
+        return ret
 
     def get_stat_for_user(self, phrase, user: User):
-        obj, created = self.get_or_create(user=user, phrase=phrase)
-        return obj
+        return self.filter(user=user, phrase=phrase).first() or self.model(user=user, phrase=phrase)
+
 
+class DictionaryUserStatQuerySet(CountersQuerySet):
+    unique_fields = ('user_id', 'dict_id', 'kind')
 
-class DictionaryUserStatQuerySet(QuerySet):
+    def get_stat_for_user(self, dictionary, user: User, kind: str):
+        obj = self.filter(user=user, dict=dictionary, kind=kind).first() or self.model(user=user, dict=dictionary, kind=kind)
+        return obj.with_pending()
 
     def get_total_stat_for_user(self, dictionary, user: User):
-        obj, created = self.get_or_create(user=user, dict=dictionary, kind='total')
-        return obj
+        return self.get_stat_for_user(dictionary, user, 'total')
 
     def get_training_stat_for_user(self, dictionary, user: User):
-        obj, created = self.get_or_create(user=user, dict=dictionary, kind='training')
-        return obj
+        return self.get_stat_for_user(dictionary, user, 'training')
+
+
+class DictionarySummaryQuerySet(QuerySet):
+
+    def for_dictionary(self, dictionary):
+        """сводка по словарю; если её ещё нет, строится с нуля"""
+        return self.filter(dictionary=dictionary).first() or self.rebuild(dictionary)
+
+    def rebuild(self, dictionary):
+        """полный пересчёт сводки по словарю и прогресса всех его юзеров"""
+        from .models import Phrase, PhraseUserStat, DictionaryUserProgress
+
+        phrases_count = Phrase.objects.filter(phrase_groups__dictionaries=dictionary)\
+            .values('lang').annotate(n=Count('id', distinct=True)).values_list('lang', 'n')
+        trained_phrases = PhraseUserStat.objects\
+            .filter(trained_count__gt=0, phrase__phrase_groups__dictionaries=dictionary)\
+            .values('user', 'phrase__lang').annotate(n=Count('phrase', distinct=True))\
+            .values_list('user', 'phrase__lang', 'n')
+
+        with transaction.atomic():
+            summary, created = self.update_or_create(dictionary=dictionary, defaults={
+                'groups_count': dictionary.phrase_groups.count(),
+                'phrases_count': {str(lang_id): n for lang_id, n in phrases_count},
+            })
+            DictionaryUserProgress.objects.filter(dictionary=dictionary).delete()
+            DictionaryUserProgress.objects.bulk_create([
+                DictionaryUserProgress(user_id=user_id, dictionary=dictionary, language_id=lang_id, trained_phrases_count=n)
+                for user_id, lang_id, n in trained_phrases
+            ])
+        return summary
+
+    def change_counts(self, groups: Dict[int, int] = None, phrases: Dict[int, Dict[int, int]] = None):
+        """
+        применяет приращения к существующим сводкам (несуществующие будут построены с нуля при обращении)
+        groups: {dictionary_id: delta}
+        phrases: {dictionary_id: {lang_id: delta}}
+        """
+        groups = groups or {}
+        phrases = phrases or {}
+        # версия содержимого сбрасывается и для словарей без сводки (см. TrainingQueue)
+        versions.bump_content(set(groups) | set(phrases))
+        with transaction.atomic():
+            for summary in self.select_for_update().filter(dictionary_id__in=set(groups) | set(phrases)):
+                summary.groups_count += groups.get(summary.dictionary_id, 0)
+                for lang_id, delta in phrases.get(summary.dictionary_id, {}).items():
+                    count = summary.phrases_count.get(str(lang_id), 0) + delta
+                    if count > 0:
+                        summary.phrases_count[str(lang_id)] = count
+                    else:
+                        summary.phrases_count.pop(str(lang_id), None)
+                summary.save(update_fields=['groups_count', 'phrases_count', 'modified'])
+
+    def add_phrases(self, dictionary_ids, phrases: list, groups_count: int = 0):
+        """новые фразы (и группы с ними) добавлены в словари"""
+        phrases_by_lang = defaultdict(int)
+        for phrase in phrases:
+            phrases_by_lang[phrase.lang_id] += 1
+
+        self.change_counts(
+            groups={dictionary_id: groups_count for dictionary_id in dictionary_ids},
+            phrases={dictionary_id: phrases_by_lang for dictionary_id in dictionary_ids},
+        )
+
+    def remove_phrases(self, phrases: 'PhraseQuerySet'):
+        """фразы будут удалены из всех словарей"""
+        from .models import PhraseUserStat, DictionaryUserProgress
+
+        phrases_count = phrases.filter(phrase_groups__dictionaries__isnull=False)\
+            .values('phrase_groups__dictionaries', 'lang').annotate(n=Count('id', distinct=True))\
+            .values_list('phrase_groups__dictionaries', 'lang', 'n')
+        trained_phrases = PhraseUserStat.objects\
+            .filter(trained_count__gt=0, phrase__in=phrases, phrase__phrase_groups__dictionaries__isnull=False)\
+            .values('user', 'phrase__phrase_groups__dictionaries', 'phrase__lang')\
+            .annotate(n=Count('phrase', distinct=True))\
+            .values_list('user', 'phrase__phrase_groups__dictionaries', 'phrase__lang', 'n')
+
+        deltas = defaultdict(dict)
+        for dictionary_id, lang_id, n in phrases_count:
+            deltas[dictionary_id][lang_id] = -n
+
+        self.change_counts(phrases=deltas)
+        DictionaryUserProgress.objects.increment([
+            {'user_id': user_id, 'dictionary_id': dictionary_id, 'language_id': lang_id, 'trained_phrases_count': -n}
+            for user_id, dictionary_id, lang_id, n in trained_phrases
+        ])
+
+    def remove_groups(self, group_ids: List[int]):
+        """группы будут удалены из всех словарей"""
+        from .models import PhraseGroup
+
+        groups_count = PhraseGroup.dictionaries.through.objects.filter(phrasegroup_id__in=group_ids)\
+            .values('dictionary_id').annotate(n=Count('id')).values_list('dictionary_id', 'n')
+        self.change_counts(groups={dictionary_id: -n for dictionary_id, n in groups_count})
+
+
+class DictionaryUserProgressQuerySet(CountersQuerySet):
+    unique_fields = ('user_id', 'dictionary_id', 'language_id')
+    counter_fields = ('trained_phrases_count',)
+
+    def increment(self, rows: List[dict]):
+        super().increment(rows)
+        versions.bump_stats({row['user_id'] for row in rows})
+
+    def trained_phrases(self, user: User, dictionary) -> Dict[int, int]:
+        """{lang_id: кол-во тренированных юзером фраз словаря на этом языке}"""
+        return dict(self.filter(user=user, dictionary=dictionary).values_list('language_id', 'trained_phrases_count'))
+
+    def add_trained_phrases(self, user_phrases: List[tuple]):
+        """фразы впервые натренированы юзерами: [(user_id, phrase_id)]"""
+        from .models import Phrase
+
+        phrase_ids = {phrase_id for user_id, phrase_id in user_phrases}
+        memberships = defaultdict(set)
+        for phrase_id, dictionary_id, lang_id in Phrase.objects\
+                .filter(id__in=phrase_ids, phrase_groups__dictionaries__isnull=False)\
+                .values_list('id', 'phrase_groups__dictionaries', 'lang').distinct():
+            memberships[phrase_id].add((dictionary_id, lang_id))
+
+        deltas = defaultdict(int)
+        for user_id, phrase_id in user_phrases:
+            for dictionary_id, lang_id in memberships[phrase_id]:
+                deltas[(user_id, dictionary_id, lang_id)] += 1
+
+        self.increment([
+            {'user_id': user_id, 'dictionary_id': dictionary_id, 'language_id': lang_id, 'trained_phrases_count': n}
+            for (user_id, dictionary_id, lang_id), n in deltas.items()
+        ])
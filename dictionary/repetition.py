@@ -0,0 +1,43 @@
+from typing import NamedTuple
+
+DEFAULT_EASE = 2.5
+MIN_EASE = 1.3
+MAX_INTERVAL = 365  # дней
+
+# бинарный ответ юзера (Yes/No) в терминах оценки SM-2 (0..5)
+QUALITY_GUESSED = 5
+QUALITY_NOT_GUESSED = 2
+
+
+class Schedule(NamedTuple):
+    ease: float = DEFAULT_EASE
+    interval: int = 0   # дней до следующего повторения
+    repetitions: int = 0    # успешных повторений подряд
+
+
+def sm2(schedule: Schedule, is_guessed: bool) -> Schedule:
+    """
+    Следующее состояние карточки по алгоритму SuperMemo-2.
+    https://www.supermemo.com/en/blog/application-of-a-computer-to-improve-the-results-obtained-in-working-with-the-supermemo-method
+    """
+    quality = QUALITY_GUESSED if is_guessed else QUALITY_NOT_GUESSED
+
+    if quality >= 3:
+        if schedule.repetitions == 0:
+            interval = 1
+        elif schedule.repetitions == 1:
+            interval = 6
+        else:
+            interval = round(schedule.interval * schedule.ease)
+        repetitions = schedule.repetitions + 1
+    else:
+        interval = 1
+        repetitions = 0
+
+    ease = schedule.ease + 0.1 - (5 - quality) * (0.08 + (5 - quality) * 0.02)
+    return Schedule(
+        ease=max(MIN_EASE, ease),
+        interval=min(MAX_INTERVAL, interval),
+        repetitions=repetitions,
+    )
+
@@ -0,0 +1,276 @@
+"""
+Отложенная запись статистики ответов юзеров (write-behind).
+
+Ответ на карточку стоит один round-trip в redis: ответ дописывается в список (для статистики фраз),
+счётчики словаря инкрементятся в хэше. Периодический flush() агрегирует накопленное и применяет
+к БД пачкой запросов, независимо от числа ответов.
+
+Накопленное забирается в :flushing ключи под id пачки и удаляется только после записи в БД. Id пачки
+записывается в БД в той же транзакции (StatsFlushBatch), так что пачка, уже применённая к БД, но не удалённая
+из redis (сбой, завершение процесса, параллельный flush после истечения блокировки), повторно не применяется.
+"""
+import json
+import logging
+import threading
+import time
+import uuid
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone as dt_timezone
+from typing import Dict, List, NamedTuple, Tuple
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import IntegrityError, close_old_connections, transaction
+from django.utils import timezone
+
+from dictionary.cache import get_redis, make_key
+from dictionary.training import TrainingQueue
+
+ANSWERS_KEY = 'stats:answers'
+COUNTERS_KEY = 'stats:counters'
+FLUSHING_SUFFIX = ':flushing'
+FLUSH_LOCK_KEY = 'stats:flush_lock'
+FLUSH_BATCH_KEY = 'stats:flush_batch'
+
+# KEYS: накопленные данные и их :flushing ключи попарно, последний - id пачки; ARGV[1] - id новой пачки.
+# Если предыдущая пачка не дописана, возвращает её id (данные не забираются, пока она не будет удалена)
+GRAB_SCRIPT = """
+local batch_key = KEYS[#KEYS]
+if redis.call('exists', batch_key) == 0 then
+    for i = 1, #KEYS - 1, 2 do
+        if redis.call('exists', KEYS[i + 1]) == 0 and redis.call('exists', KEYS[i]) == 1 then
+            redis.call('rename', KEYS[i], KEYS[i + 1])
+        end
+    end
+    redis.call('set', batch_key, ARGV[1])
+end
+return redis.call('get', batch_key)
+"""
+
+# KEYS: id пачки, затем :flushing ключи; удаляет их, только если пачка та же (ARGV[1])
+FINISH_SCRIPT = """
+if redis.call('get', KEYS[1]) ~= ARGV[1] then
+    return 0
+end
+for i = 1, #KEYS do
+    redis.call('del', KEYS[i])
+end
+return 1
+"""
+
+logger = logging.getLogger(__name__)
+
+
+class Answer(NamedTuple):
+    user_id: int
+    dictionary_id: int
+    phrase_id: int
+    src_lang_id: int
+    dst_lang_id: int
+    is_guessed: bool
+    timestamp: float
+
+
+def _counter_field(user_id: int, dictionary_id: int, kind: str, counter: str) -> str:
+    return f'{user_id}:{dictionary_id}:{kind}:{counter}'
+
+
+def push_answer(answer: Answer):
+    from .models import DictionaryUserStat
+
+    pipe = get_redis().pipeline(transaction=False)
+    pipe.rpush(make_key(ANSWERS_KEY), json.dumps(answer))
+    for kind in (DictionaryUserStat.KIND.training, DictionaryUserStat.KIND.total):
+        pipe.hincrby(make_key(COUNTERS_KEY), _counter_field(answer.user_id, answer.dictionary_id, kind, 'trained'))
+        if answer.is_guessed:
+            pipe.hincrby(make_key(COUNTERS_KEY), _counter_field(answer.user_id, answer.dictionary_id, kind, 'guessed'))
+    pipe.execute()
+
+
+def provisional_due_at() -> datetime:
+    """due_at отвеченной фразы до flush(): не раньше, чем через минимальный интервал SM-2"""
+    return timezone.now() + timedelta(days=1)
+
+
+def pending_counters(user_id: int, dictionary_id: int, kind: str) -> Tuple[int, int]:
+    """ещё не записанные в БД (trained_count, guessed_count) статистики словаря"""
+    fields = [
+        _counter_field(user_id, dictionary_id, kind, 'trained'),
+        _counter_field(user_id, dictionary_id, kind, 'guessed'),
+    ]
+    pipe = get_redis().pipeline(transaction=False)
+    pipe.hmget(make_key(COUNTERS_KEY), fields)
+    pipe.hmget(make_key(COUNTERS_KEY + FLUSHING_SUFFIX), fields)
+    values = [int(v or 0) for v in sum(pipe.execute(), [])]
+    return values[0] + values[2], values[1] + values[3]
+
+
+def get_flush_lock():
+    return cache.lock(make_key(FLUSH_LOCK_KEY), timeout=settings.STATS_FLUSH_LOCK_TIMEOUT)
+
+
+@contextmanager
+def flush_lock():
+    """ожидает завершения flush() в процессе и не даёт начать новый до выхода из блока"""
+    lock = get_flush_lock()
+    lock.acquire()  # не дольше таймаута блокировки, если flush завис
+    try:
+        yield
+    finally:
+        lock.release()
+
+
+def reset_pending_counters(user_id: int, dictionary_id: int, kind: str):
+    """
+    удаляет не записанные в БД счётчики словаря. Вызывается внутри flush_lock() вместе с удалением
+    строки статистики: иначе flush, уже прочитавший счётчики, запишет их в БД после сброса
+    """
+    fields = [
+        _counter_field(user_id, dictionary_id, kind, 'trained'),
+        _counter_field(user_id, dictionary_id, kind, 'guessed'),
+    ]
+    pipe = get_redis().pipeline(transaction=False)
+    pipe.hdel(make_key(COUNTERS_KEY), *fields)
+    pipe.hdel(make_key(COUNTERS_KEY + FLUSHING_SUFFIX), *fields)
+    pipe.execute()
+
+
+def _apply_phrase_stats(answers: List[Answer]) -> dict:
+    """
+    проигрывает ответы по порядку поверх текущего расписания повторений
+    и применяет приращения счётчиков фраз одним INSERT ... ON CONFLICT DO UPDATE
+    """
+    from .models import Phrase, PhraseUserStat, DictionaryUserProgress
+
+    phrase_ids = {a.phrase_id for a in answers}
+    user_ids = {a.user_id for a in answers}
+    existing_phrase_ids = set(Phrase.objects.filter(id__in=phrase_ids).values_list('id', flat=True))
+    stats = {
+        (s.user_id, s.phrase_id): s
+        for s in PhraseUserStat.objects.filter(user_id__in=user_ids, phrase_id__in=phrase_ids)
+    }
+
+    changed = {}
+    first_trained = []
+    deltas = defaultdict(lambda: [0, 0])
+    for answer in answers:
+        if answer.phrase_id not in existing_phrase_ids:
+            continue
+
+        key = (answer.user_id, answer.phrase_id)
+        stat = stats.setdefault(key, PhraseUserStat(user_id=answer.user_id, phrase_id=answer.phrase_id))
+        if not stat.trained_count:
+            first_trained.append(key)
+        stat.apply_answer(answer.is_guessed, datetime.fromtimestamp(answer.timestamp, tz=dt_timezone.utc))
+        changed[key] = stat
+        deltas[key][0] += 1
+        deltas[key][1] += int(answer.is_guessed)
+
+    PhraseUserStat.objects.increment([stat.increment_row(*deltas[key]) for key, stat in changed.items()])
+    DictionaryUserProgress.objects.add_trained_phrases(first_trained)
+    return changed
+
+
+def _apply_dictionary_stats(counters: Dict[bytes, bytes]):
+    """применяет накопленные приращения счётчиков словарей одним INSERT ... ON CONFLICT DO UPDATE"""
+    from .models import Dictionary, DictionaryUserStat
+
+    deltas = {}
+    for field, value in counters.items():
+        user_id, dictionary_id, kind, counter = field.decode().split(':')
+        key = (int(user_id), int(dictionary_id), kind)
+        deltas.setdefault(key, {'trained_count': 0, 'guessed_count': 0})[f'{counter}_count'] += int(value)
+
+    existing_dictionary_ids = set(
+        Dictionary.objects.filter(id__in={k[1] for k in deltas}).values_list('id', flat=True)
+    )
+    DictionaryUserStat.objects.increment([
+        {'user_id': user_id, 'dict_id': dictionary_id, 'kind': kind, **delta}
+        for (user_id, dictionary_id, kind), delta in deltas.items()
+        if dictionary_id in existing_dictionary_ids
+    ])
+
+
+def flush() -> int:
+    """
+    записывает накопленную статистику в БД, возвращает кол-во обработанных ответов.
+    Одновременно выполняется только один flush, блокировка продлевается между этапами.
+    """
+    lock = get_flush_lock()
+    if not lock.acquire(blocking=False):
+        return 0
+
+    try:
+        redis = get_redis()
+        answers_key, counters_key = make_key(ANSWERS_KEY), make_key(COUNTERS_KEY)
+        flushing_keys = [answers_key + FLUSHING_SUFFIX, counters_key + FLUSHING_SUFFIX]
+        batch_key = make_key(FLUSH_BATCH_KEY)
+        keys = [answers_key, flushing_keys[0], counters_key, flushing_keys[1], batch_key]
+        batch_id = redis.eval(GRAB_SCRIPT, len(keys), *keys, uuid.uuid4().hex).decode()
+
+        pipe = redis.pipeline(transaction=False)
+        pipe.lrange(flushing_keys[0], 0, -1)
+        pipe.hgetall(flushing_keys[1])
+        raw_answers, counters = pipe.execute()
+        answers = [Answer(*json.loads(a)) for a in raw_answers]
+
+        lock.reacquire()
+        phrase_stats = apply_batch(batch_id, answers, counters)
+        lock.reacquire()
+
+        # точные позиции отвеченных фраз в очередях тренировки
+        pipe = redis.pipeline(transaction=False)
+        for a in answers:
+            stat = phrase_stats.get((a.user_id, a.phrase_id))
+            if stat:
+                queue = TrainingQueue(a.user_id, a.dictionary_id, a.src_lang_id, a.dst_lang_id)
+                queue.rescore(a.phrase_id, stat.due_at, redis=pipe)
+        # до удаления :flushing ключей pending_counters() кратковременно учитывает их повторно
+        pipe.eval(FINISH_SCRIPT, 1 + len(flushing_keys), batch_key, *flushing_keys, batch_id)
+        pipe.execute()
+
+        return len(answers)
+    finally:
+        lock.release()
+
+
+def apply_batch(batch_id: str, answers: List[Answer], counters: Dict[bytes, bytes]) -> dict:
+    """применяет пачку к БД одной транзакцией, если она ещё не применена; {(user_id, phrase_id): PhraseUserStat}"""
+    from .models import StatsFlushBatch
+
+    if not answers and not counters:
+        return {}
+
+    with transaction.atomic():
+        try:
+            with transaction.atomic():
+                StatsFlushBatch.objects.create(id=batch_id)
+        except IntegrityError:
+            logger.warning('stats batch %s is already applied, skipped', batch_id)
+            return {}
+
+        StatsFlushBatch.objects.filter(
+            created__lt=timezone.now() - timedelta(days=settings.STATS_FLUSH_BATCHES_KEEP_DAYS)
+        ).delete()
+        phrase_stats = _apply_phrase_stats(answers)
+        _apply_dictionary_stats(counters)
+    return phrase_stats
+
+
+class StatsFlusher(threading.Thread):
+    """фоновый поток, периодически сбрасывающий статистику в БД"""
+
+    def __init__(self, interval: float):
+        super().__init__(name='stats-flusher', daemon=True)
+        self.interval = interval
+
+    def run(self):
+        while 1:
+            time.sleep(self.interval)
+            try:
+                flush()
+            except Exception:
+                logger.exception('stats flush failed')
+            finally:
+                close_old_connections()
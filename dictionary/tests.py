@@ -0,0 +1,535 @@
+import importlib
+import json
+import threading
+import time
+from datetime import timedelta
+from pathlib import Path
+from unittest import mock, skipIf
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+
+from dictionary import repetition, stats, versions
+from dictionary.cache import get_redis, make_key
+from dictionary.ingest import PhraseImport
+from dictionary.langdetect import detect_language_code
+from dictionary.languages import get_registry
+from dictionary.models import (
+    Dictionary, DictionaryAccess, DictionarySummary, DictionaryUserProgress, DictionaryUserStat, Phrase, PhraseGroup,
+    PhraseUserStat, StatsFlushBatch
+)
+from dictionary.permissions import DICT_EDITOR_PERMS, DICT_OWNER_PERMS, DICT_VIEWER_PERMS, objects_with_perm
+from dictionary.prefix_index import PrefixIndexCache
+from dictionary.training import TrainingQueue
+
+FIXTURE_CODES = {
+    entry['fields']['code']
+    for entry in json.loads((Path(__file__).parent / 'fixtures' / 'languages.json').read_text())
+}
+
+
+class DetectLanguageTestCase(SimpleTestCase):
+
+    def detect(self, text: str, preferred=()) -> str:
+        return detect_language_code(text, known_codes=FIXTURE_CODES, preferred_codes=preferred)
+
+    def test_loanwords_stay_english(self):
+        for word in ('café', 'naïve', 'résumé', 'façade', 'straße', 'Mädchen', 'cat'):
+            with self.subTest(word=word):
+                self.assertEqual(self.detect(word), 'en')
+                self.assertEqual(self.detect(word, preferred=['en', 'ru']), 'en')
+
+    def test_dictionary_languages_preferred(self):
+        self.assertEqual(self.detect('straße', preferred=['de', 'ru']), 'de')
+        self.assertEqual(self.detect('Hund', preferred=['de', 'ru']), 'de')
+        self.assertEqual(self.detect('кот', preferred=['uk', 'en']), 'uk')
+        self.assertEqual(self.detect('собака', preferred=['de', 'ru']), 'ru')
+
+    def test_letters_of_other_scripts(self):
+        self.assertEqual(self.detect('кіт'), 'uk')
+        self.assertEqual(self.detect('кіт', preferred=['en', 'ru']), 'uk')
+        self.assertEqual(self.detect('кот'), 'ru')
+
+    def test_phrases(self):
+        self.assertEqual(self.detect('où est la gare'), 'fr')
+        self.assertEqual(self.detect('¿dónde está la estación?'), 'es')
+        self.assertIsNone(self.detect('123'))
+
+
+class RepetitionTestCase(SimpleTestCase):
+    schedule_migration = importlib.import_module('dictionary.migrations.0003_phraseuserstat_schedule')
+
+    def test_sm2(self):
+        table = [
+            # (ease, interval, repetitions), угадано -> (ease, interval, repetitions)
+            ((2.5, 0, 0), True, (2.6, 1, 1)),
+            ((2.6, 1, 1), True, (2.7, 6, 2)),
+            ((2.7, 6, 2), True, (2.8, 16, 3)),
+            ((2.5, 16, 3), False, (2.18, 1, 0)),
+            ((1.4, 6, 2), False, (1.3, 1, 0)),
+            ((1.3, 1, 0), True, (1.4, 1, 1)),
+            ((2.5, 200, 5), True, (2.6, 365, 6)),
+        ]
+        for schedule, is_guessed, expected in table:
+            with self.subTest(schedule=schedule, is_guessed=is_guessed):
+                ease, interval, repetitions = repetition.sm2(repetition.Schedule(*schedule), is_guessed)
+                self.assertAlmostEqual(ease, expected[0])
+                self.assertEqual((interval, repetitions), expected[1:])
+
+    def test_migration_copy(self):
+        for schedule in [(2.5, 0, 0), (2.6, 1, 1), (2.7, 6, 2), (1.3, 1, 0), (2.5, 200, 5)]:
+            for is_guessed in (True, False):
+                with self.subTest(schedule=schedule, is_guessed=is_guessed):
+                    self.assertEqual(
+                        self.schedule_migration.sm2(*schedule, is_guessed),
+                        tuple(repetition.sm2(repetition.Schedule(*schedule), is_guessed))
+                    )
+
+        table = [
+            # (trained_count, guessed_count) -> (ease, interval, repetitions)
+            ((1, 1), (2.6, 1, 1)),
+            ((3, 3), (2.8, 16, 3)),
+            ((2, 0), (1.86, 1, 0)),
+            ((2, 1), (2.28, 1, 1)),
+            ((100, 0), (1.3, 1, 0)),
+            ((30, 30), (3.1, 365, 6)),     # останавливается на максимальном интервале
+        ]
+        for counters, expected in table:
+            with self.subTest(counters=counters):
+                ease, interval, repetitions = self.schedule_migration.sm2_from_counters(*counters)
+                self.assertAlmostEqual(ease, expected[0])
+                self.assertEqual((interval, repetitions), expected[1:])
+
+
+class PhraseImportLanguageTestCase(TestCase):
+    fixtures = ['languages.json']
+
+    def test_loanwords_in_english_dictionary(self):
+        user = User.objects.create(username='importer')
+        dictionary = Dictionary.objects.create(user=user, name='en-ru')
+        PhraseImport(user, dictionary).add_lines(['cat - кот'], strict=True)
+
+        importer = PhraseImport(user, Dictionary.objects.get(id=dictionary.id))
+        importer.add_lines(['café - кафе', 'straße - улица', 'résumé - резюме'], strict=True)
+
+        english = get_registry().get_by_code('en')
+        self.assertEqual(
+            set(Phrase.objects.filter(user=user, text__in=['café', 'straße', 'résumé']).values_list('lang', flat=True)),
+            {english.id}
+        )
+
+
+class PhraseImportTestCase(TestCase):
+    fixtures = ['languages.json']
+
+    def test_new_and_existing_phrases(self):
+        user = User.objects.create(username='importer')
+        dictionary = Dictionary.objects.create(user=user, name='en-ru')
+        PhraseImport(user, dictionary).add_lines(['cat - кот', 'dog - пёс'], strict=True)
+        dictionary.summary  # сводка строится с нуля, дальше обновляется импортом
+
+        importer = PhraseImport(user, dictionary)
+        importer.add_lines(['cat - котик', 'fox - лиса'])
+        importer.add_lines(['dog - пёс', 'owl - сова, сыч'])
+
+        result = importer.result
+        self.assertEqual((result.phrases_count, result.groups_count), (6, 2))
+        self.assertEqual([line for line, e in result.errors], ['dog - пёс'])
+        self.assertEqual(PhraseGroup.objects.get(phrases__text='котик'), PhraseGroup.objects.get(phrases__text='cat'))
+
+        english, russian = get_registry().get_by_code('en'), get_registry().get_by_code('ru')
+        summary = DictionarySummary.objects.get(dictionary=dictionary)
+        self.assertEqual(summary.groups_count, 4)
+        self.assertEqual(summary.phrases_count, {str(english.id): 4, str(russian.id): 6})
+
+        rebuilt = DictionarySummary.objects.rebuild(dictionary)
+        self.assertEqual((summary.groups_count, summary.phrases_count), (rebuilt.groups_count, rebuilt.phrases_count))
+
+
+class PhraseSearchTestCase(TestCase):
+    fixtures = ['languages.json']
+
+    @skipIf(connection.vendor == 'postgresql', 'postgres ranks by trigram similarity')
+    def test_prefix_before_substring(self):
+        user = User.objects.create(username='searcher')
+        dictionary = Dictionary.objects.create(user=user, name='en-ru')
+        PhraseImport(user, dictionary).add_lines([
+            'scatter - разбрасывать', 'bobcat - рысь', 'catalog - каталог', 'Cats - кошки', 'cat - кот', 'dog - пёс',
+        ], strict=True)
+
+        # сначала совпадения по началу, среди них и среди остальных - короткие
+        self.assertEqual(
+            list(Phrase.objects.search('CAT').values_list('text', flat=True)),
+            ['cat', 'Cats', 'catalog', 'bobcat', 'scatter']
+        )
+        self.assertEqual(
+            [text for d, p, text, lang in Phrase.objects.search_in_dictionaries('cat', [dictionary.id], 2)],
+            ['cat', 'Cats']
+        )
+
+
+class PrefixIndexCacheTestCase(TestCase):
+    fixtures = ['languages.json']
+
+    def test_sharing_resets_indexes_of_other_processes(self):
+        owner = User.objects.create(username='owner')
+        viewer = User.objects.create(username='viewer')
+        dictionary = Dictionary.objects.create(user=owner, name='en-ru')
+        PhraseImport(owner, dictionary).add_lines(['cat - кот'], strict=True)
+
+        # индексы двух процессов с общим redis
+        indexes, other_indexes = PrefixIndexCache(10), PrefixIndexCache(10)
+        self.assertEqual(other_indexes.get(viewer.id).search('ca', 10), [])
+        self.assertEqual(indexes.get(viewer.id).search('ca', 10), [])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            dictionary.viewers.add(viewer)
+        for cache in (indexes, other_indexes):
+            self.assertEqual([e.text for e in cache.get(viewer.id).search('ca', 10)], ['cat'])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            viewer.readable_dictionaries.clear()
+        for cache in (indexes, other_indexes):
+            self.assertEqual(cache.get(viewer.id).search('ca', 10), [])
+
+    def test_new_phrases_reset_indexes_of_group_dictionaries(self):
+        owner = User.objects.create(username='owner')
+        viewer = User.objects.create(username='viewer')
+        shared = Dictionary.objects.create(user=owner, name='shared')
+        private = Dictionary.objects.create(user=owner, name='private')
+        shared.viewers.add(viewer)
+        PhraseImport(owner, shared).add_lines(['cat - кот'], strict=True)
+
+        indexes = PrefixIndexCache(10)
+        self.assertEqual([e.text for e in indexes.get(viewer.id).search('кот', 10)], ['кот'])
+
+        # новая фраза попадает в существующую группу, а значит, и в словарь shared
+        result = PhraseImport(owner, private).add_lines(['cat - котик'], strict=True)
+        self.assertEqual(result.dictionary_ids, {shared.id})
+        indexes.invalidate_dictionaries(result.dictionary_ids)
+        self.assertEqual([e.text for e in indexes.get(viewer.id).search('кот', 10)], ['кот', 'котик'])
+
+
+class PermissionsTestCase(TestCase):
+    fixtures = ['languages.json']
+    perms = sorted(DICT_OWNER_PERMS | {'add_dictionary'})
+
+    def setUp(self):
+        cache.clear()   # id в тестовой БД повторяются
+        self.owner, self.editor, self.viewer, self.stranger = (
+            User.objects.create(username=name) for name in ('owner', 'editor', 'viewer', 'stranger')
+        )
+        self.dictionary = Dictionary.objects.create(user=self.owner, name='en-ru')
+        self.dictionary.editors.add(self.editor)
+        self.dictionary.viewers.add(self.viewer)
+        PhraseImport(self.owner, self.dictionary).add_lines(['cat - кот'], strict=True)
+        PhraseImport(self.editor, self.dictionary).add_lines(['dog - пёс'], strict=True)
+        self.objects = [self.dictionary, *PhraseGroup.objects.all(), *Phrase.objects.all()]
+
+    @staticmethod
+    def old_has_perm(user: User, perm: str, obj) -> bool:
+        """прежний backend: автор объекта - все права, иначе права редактора или читателя его словарей"""
+        if obj.user == user:
+            return True
+        if isinstance(obj, Dictionary):
+            role = DictionaryAccess.objects.filter(user=user, dictionary=obj).values_list('role', flat=True).first()
+            is_editor = role is not None and role >= DictionaryAccess.ROLE.editor
+            is_viewer = role is not None
+        else:
+            dictionaries = Dictionary.objects.filter(
+                phrase_groups__phrases=obj) if isinstance(obj, Phrase) else obj.dictionaries.all()
+            is_editor = dictionaries.filter(editors=user).exists()
+            is_viewer = is_editor or dictionaries.filter(viewers=user).exists()
+            # владелец словаря - не автор фраз соавторов, но прав у него не меньше, чем у редактора
+            is_editor = is_editor or dictionaries.filter(user=user).exists()
+        return perm in (DICT_EDITOR_PERMS if is_editor else DICT_VIEWER_PERMS if is_viewer else ())
+
+    def test_same_answers_as_old_backend(self):
+        for user in (self.owner, self.editor, self.viewer, self.stranger):
+            for obj in self.objects:
+                for perm in self.perms:
+                    with self.subTest(user=user.username, obj=f'{obj._meta.model_name}#{obj.pk}', perm=perm):
+                        self.assertEqual(user.has_perm(perm, obj), self.old_has_perm(user, perm, obj))
+
+    def test_checks_without_queries(self):
+        for obj in self.objects:
+            self.viewer.has_perm('view_phrase', obj)
+
+        with self.assertNumQueries(0):
+            for obj in self.objects:
+                for perm in self.perms:
+                    self.viewer.has_perm(perm, obj)
+
+    def test_membership_change_resets_cache(self):
+        group = PhraseGroup.objects.create(user=self.editor)
+        self.assertFalse(self.viewer.has_perm('view_phrasegroup', group))
+        with self.captureOnCommitCallbacks(execute=True):
+            group.dictionaries.add(self.dictionary)
+        self.assertTrue(self.viewer.has_perm('view_phrasegroup', group))
+
+    def test_membership_change_keeps_other_entries(self):
+        for obj in self.objects:
+            self.viewer.has_perm('view_phrase', obj)
+        version_keys = {
+            obj: versions.DICTIONARIES_VERSION_KEY.format(obj._meta.model_name, obj.pk) for obj in self.objects[1:]
+        }
+        before = cache.get_many(list(version_keys.values()))
+
+        cat = Phrase.objects.get(text='cat')
+        other_dictionary = Dictionary.objects.create(user=self.editor, name='other')
+        with self.captureOnCommitCallbacks(execute=True):
+            cat.phrase_groups.get().dictionaries.add(other_dictionary)
+
+        changed = {
+            f'{obj._meta.model_name}:{obj}' for obj, key in version_keys.items() if cache.get(key) != before[key]
+        }
+        cat_group = cat.phrase_groups.get()
+        self.assertEqual(changed, {f'phrasegroup:{cat_group}', f'phrase:{cat}', f'phrase:{Phrase.objects.get(text="кот")}'})
+
+    def test_batch_check(self):
+        for user in (self.owner, self.editor, self.viewer, self.stranger):
+            for perm in ('view_phrase', 'change_phrasegroup', 'delete_dictionary'):
+                with self.subTest(user=user.username, perm=perm):
+                    expected = [obj for obj in self.objects if user.has_perm(perm, obj)]
+                    self.assertEqual(objects_with_perm(user, perm, self.objects), expected)
+
+    def test_batch_check_queries(self):
+        objects_with_perm(self.viewer, 'view_dictionary', [self.dictionary])
+        with self.assertNumQueries(2):  # фразы и группы, каждые одним запросом
+            objects_with_perm(self.viewer, 'view_phrase', self.objects)
+        with self.assertNumQueries(0):
+            self.assertEqual(objects_with_perm(self.viewer, 'view_phrase', self.objects), self.objects)
+
+
+class DictionaryAccessTestCase(TestCase):
+
+    def roles(self, dictionary):
+        return {
+            access.user.username: access.role
+            for access in DictionaryAccess.objects.filter(dictionary=dictionary).select_related('user')
+        }
+
+    def test_rows_follow_members(self):
+        owner, other, member = (User.objects.create(username=name) for name in ('owner', 'other', 'member'))
+        dictionary = Dictionary.objects.create(user=owner, name='en-ru')
+        role = DictionaryAccess.ROLE
+        self.assertEqual(self.roles(dictionary), {'owner': role.owner})
+
+        dictionary.viewers.add(member)
+        self.assertEqual(self.roles(dictionary), {'owner': role.owner, 'member': role.viewer})
+        dictionary.editors.add(member)
+        self.assertEqual(self.roles(dictionary), {'owner': role.owner, 'member': role.editor})
+        dictionary.editors.remove(member)
+        self.assertEqual(self.roles(dictionary), {'owner': role.owner, 'member': role.viewer})
+
+        # с другой стороны связи
+        member.editable_dictionaries.add(dictionary)
+        member.readable_dictionaries.clear()
+        self.assertEqual(self.roles(dictionary), {'owner': role.owner, 'member': role.editor})
+        member.editable_dictionaries.clear()
+        self.assertEqual(self.roles(dictionary), {'owner': role.owner})
+
+        dictionary.user = other
+        dictionary.save()
+        self.assertEqual(self.roles(dictionary), {'other': role.owner})
+
+
+class CountersTestCase(TestCase):
+    fixtures = ['languages.json']
+
+    def test_negative_increments_do_not_insert_rows(self):
+        user = User.objects.create(username='trainee')
+        dictionary = Dictionary.objects.create(user=user, name='en-ru')
+        english, russian = get_registry().get_by_code('en'), get_registry().get_by_code('ru')
+        row = {'user_id': user.id, 'dictionary_id': dictionary.id}
+
+        DictionaryUserProgress.objects.increment([
+            {**row, 'language_id': english.id, 'trained_phrases_count': 2},
+            {**row, 'language_id': russian.id, 'trained_phrases_count': -1},
+        ])
+        self.assertEqual(DictionaryUserProgress.objects.trained_phrases(user, dictionary), {english.id: 2})
+
+        DictionaryUserProgress.objects.increment([{**row, 'language_id': english.id, 'trained_phrases_count': -3}])
+        self.assertEqual(DictionaryUserProgress.objects.trained_phrases(user, dictionary), {english.id: 0})
+
+
+class StatsResetTestCase(TestCase):
+
+    def test_reset_waits_for_flush_in_progress(self):
+        user = User.objects.create(username='trainee')
+        dictionary = Dictionary.objects.create(user=user, name='en-ru')
+        stats.push_answer(stats.Answer(user.id, dictionary.id, 1, 1, 2, True, time.time()))
+        stat = DictionaryUserStat.objects.get_training_stat_for_user(dictionary, user)
+
+        started, released = threading.Event(), []
+
+        def flush():
+            with stats.flush_lock():
+                started.set()
+                time.sleep(0.3)
+                released.append(time.monotonic())
+
+        flushing = threading.Thread(target=flush)
+        flushing.start()
+        started.wait()
+        stat.reset()
+        reset_at = time.monotonic()
+        flushing.join()
+
+        self.assertGreaterEqual(reset_at, released[0], 'reset does not wait for flush')
+        self.assertEqual(stats.pending_counters(user.id, dictionary.id, stat.kind), (0, 0))
+
+
+class StatsFlushTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create(username='trainee')
+        self.dictionary = Dictionary.objects.create(user=self.user, name='en-ru')
+        stats.push_answer(stats.Answer(self.user.id, self.dictionary.id, 1, 1, 2, True, time.time()))
+
+    def trained_count(self):
+        return DictionaryUserStat.objects.get(
+            user=self.user, dict=self.dictionary, kind=DictionaryUserStat.KIND.training
+        ).trained_count
+
+    def test_failed_finish_not_applied_twice(self):
+        with mock.patch.object(stats, 'FINISH_SCRIPT', "return redis.error_reply('finish failed')"):
+            with self.assertRaises(Exception):
+                stats.flush()
+        self.assertEqual(self.trained_count(), 1)
+
+        with self.assertLogs('dictionary.stats', 'WARNING'):
+            stats.flush()
+        self.assertEqual(self.trained_count(), 1)
+        self.assertEqual(stats.pending_counters(self.user.id, self.dictionary.id, DictionaryUserStat.KIND.training), (0, 0))
+
+        stats.push_answer(stats.Answer(self.user.id, self.dictionary.id, 1, 1, 2, False, time.time()))
+        self.assertEqual(stats.flush(), 1)
+        self.assertEqual(self.trained_count(), 2)
+        self.assertEqual(StatsFlushBatch.objects.count(), 2)
+
+    def test_stale_finish_keeps_newer_batch(self):
+        with mock.patch.object(stats, 'FINISH_SCRIPT', "return redis.error_reply('finish failed')"):
+            with self.assertRaises(Exception):
+                stats.flush()
+
+        redis = get_redis()
+        batch_key = make_key(stats.FLUSH_BATCH_KEY)
+        flushing_key = make_key(stats.COUNTERS_KEY + stats.FLUSHING_SUFFIX)
+        redis.set(batch_key, 'newer')
+        redis.eval(stats.FINISH_SCRIPT, 2, batch_key, flushing_key, 'older')
+        self.assertEqual(redis.get(batch_key), b'newer')
+        self.assertTrue(redis.exists(flushing_key))
+
+    def test_lock_renewed(self):
+        lock = mock.Mock()
+        lock.acquire.return_value = True
+        with mock.patch.object(stats, 'get_flush_lock', return_value=lock):
+            stats.flush()
+        self.assertEqual(lock.reacquire.call_count, 2)
+        lock.release.assert_called_once()
+
+
+class RecentPhrasesTestCase(TestCase):
+    fixtures = ['languages.json']
+
+    @override_settings(RECENT_PHRASES=3, RECENT_PHRASES_TTL=60)
+    def test_push_moves_repeats_to_head_and_trims(self):
+        cache.clear()
+        user = User.objects.create(username='trainee')
+        PhraseImport(user).add_lines([f'cat{c} - кот{c}' for c in 'abcde'], strict=True)
+        english = get_registry().get_by_code('en')
+        bucket = Phrase.objects.get_user_lang_bucket(user, english)
+
+        def push(*letters):
+            Phrase.objects.filter(text__in=[f'cat{c}' for c in letters]).push_recent_phrase(bucket)
+            ids = Phrase.objects.get_recent_phrases_ids(bucket)
+            texts = dict(Phrase.objects.filter(id__in=ids).values_list('id', 'text'))
+            return [texts[i][-1] for i in ids]
+
+        self.assertEqual(push('a', 'b'), ['a', 'b'])
+        self.assertEqual(push('c'), ['c', 'a', 'b'])
+        self.assertEqual(push('b'), ['b', 'c', 'a'])
+        self.assertEqual(push('d', 'e'), ['d', 'e', 'b'])
+        self.assertTrue(0 < get_redis().ttl(bucket) <= 60)
+
+
+class TrainingQueueTestCase(TestCase):
+    fixtures = ['languages.json']
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create(username='trainee')
+        self.dictionary = Dictionary.objects.create(user=self.user, name='en-ru')
+        with self.captureOnCommitCallbacks(execute=True):
+            PhraseImport(self.user, self.dictionary).add_lines(['cat - кот', 'dog - пёс', 'fox - лиса'], strict=True)
+        self.english, self.russian = get_registry().get_by_code('en'), get_registry().get_by_code('ru')
+        self.queue = TrainingQueue.for_training(self.user, self.dictionary, self.english, self.russian)
+        self.phrases = {p.text: p for p in Phrase.objects.filter(lang=self.english)}
+
+    def members(self):
+        return [int(i) for i in get_redis().zrange(self.queue.key, 0, -1)]
+
+    def next_text(self):
+        phrase = Phrase.objects.get_next_for_training(self.user, self.dictionary, self.english, self.russian)
+        return phrase and phrase.text
+
+    def test_build_untrained_first(self):
+        now = timezone.now()
+        PhraseUserStat.objects.create(user=self.user, phrase=self.phrases['cat'], due_at=now + timedelta(days=1))
+        PhraseUserStat.objects.create(user=self.user, phrase=self.phrases['dog'], due_at=now)
+
+        self.assertEqual(self.queue.build(), 3)
+        self.assertEqual(self.members(), [self.phrases[t].id for t in ('fox', 'dog', 'cat')])
+
+    def test_next_skips_recent(self):
+        self.queue.build()
+        first, second, third = self.members()
+        self.assertEqual(self.queue.next([]), first)
+        self.assertEqual(self.queue.next([first]), second)
+        self.assertEqual(self.queue.next([second, first]), third)
+        # все фразы недавние - самая давняя из них
+        self.assertEqual(self.queue.next([third, second, first]), first)
+
+    def test_rescore(self):
+        self.queue.build()
+        first, second, third = self.members()
+        self.queue.rescore(first, timezone.now())
+        self.assertEqual(self.members(), [second, third, first])
+
+        # фразы, которой нет в очереди, rescore не добавляет
+        self.queue.rescore(0, timezone.now())
+        self.assertNotIn(0, self.members())
+
+    def test_added_phrases_trained(self):
+        self.assertIsNotNone(self.next_text())
+        with self.captureOnCommitCallbacks(execute=True):
+            PhraseImport(self.user, self.dictionary).add_lines(['owl - сова'], strict=True)
+
+        self.assertIsNotNone(self.next_text())
+        self.assertIn(Phrase.objects.get(text='owl').id, self.members())
+
+    def test_removed_phrases_not_trained(self):
+        self.queue.build()
+        cat = self.phrases['cat']
+        group = cat.phrase_groups.get()
+        with self.captureOnCommitCallbacks(execute=True):
+            group.dictionaries.remove(self.dictionary)
+        self.assertNotEqual(self.next_text(), 'cat')
+        self.assertNotIn(cat.id, self.members())
+
+    def test_membership_rechecked(self):
+        cat = self.phrases['cat']
+        self.queue.build()
+        for text in ('dog', 'fox'):
+            self.queue.rescore(self.phrases[text].id, timezone.now())
+        # версия содержимого не сброшена (on_commit не выполняется), очередь не перестраивается
+        cat.phrase_groups.get().dictionaries.remove(self.dictionary)
+
+        self.assertEqual(self.members()[0], cat.id)
+        self.assertNotEqual(self.next_text(), 'cat')
+        self.assertNotIn(cat.id, self.members())
@@ -0,0 +1,106 @@
+import random
+from datetime import datetime
+from typing import List, Optional
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db.models import OuterRef, Subquery
+
+from dictionary import versions
+from dictionary.cache import get_redis, make_key
+
+UNTRAINED_SCORE = -1.0
+UNTRAINED_JITTER = 0.1     # перемешивает нетренированные фразы между собой
+ZADD_CHUNK_SIZE = 1000
+
+
+class TrainingQueue:
+    """
+    Предрассчитанная очередь фраз для тренировки юзера по словарю в направлении src_lang -> dst_lang.
+    Хранится в redis sorted set: сначала нетренированные фразы (в случайном порядке),
+    затем тренированные по времени следующего повторения (due_at, SM-2).
+    Выбор следующей фразы и пересчёт score после ответа стоят O(log n).
+    Очередь помнит версию содержимого словаря, на которой построена (versions.CONTENT_VERSION_KEY),
+    и перестраивается после добавления, импорта или удаления фраз словаря.
+    """
+
+    def __init__(self, user_id: int, dictionary_id: int, src_lang_id: int, dst_lang_id: int):
+        self.user_id = user_id
+        self.dictionary_id = dictionary_id
+        self.src_lang_id = src_lang_id
+        self.dst_lang_id = dst_lang_id
+        self.key = make_key(
+            f'user:{user_id}:dict:{dictionary_id}:lang:{src_lang_id}-{dst_lang_id}:training_queue'
+        )
+        self.version_key = self.key + ':version'
+
+    @classmethod
+    def for_training(cls, user: User, dictionary, src_lang, dst_lang) -> 'TrainingQueue':
+        return cls(user.id, dictionary.id, src_lang.id, dst_lang.id)
+
+    @staticmethod
+    def score(due_at: Optional[datetime]) -> float:
+        if due_at is None:
+            return UNTRAINED_SCORE + random.random() * UNTRAINED_JITTER
+        return due_at.timestamp()
+
+    def content_version(self) -> str:
+        key = versions.CONTENT_VERSION_KEY.format(self.dictionary_id)
+        return versions.get_versions([key])[key]
+
+    def is_actual(self, content_version: str) -> bool:
+        """очередь существует и построена на текущей версии содержимого словаря"""
+        pipe = get_redis().pipeline(transaction=False)
+        pipe.exists(self.key)
+        pipe.get(self.version_key)
+        exists, version = pipe.execute()
+        return bool(exists) and version == content_version.encode()
+
+    def build(self, content_version: Optional[str] = None) -> int:
+        """
+        (пере)создаёт очередь одним запросом к БД, возвращает кол-во фраз в ней.
+        Версия читается до запроса к БД: изменения, сделанные во время построения, сбросят её
+        """
+        from .models import Phrase, PhraseUserStat
+
+        content_version = content_version or self.content_version()
+
+        user_stats = PhraseUserStat.objects.filter(user_id=self.user_id, phrase=OuterRef('pk'))
+        rows = Phrase.objects\
+            .for_training(self.dictionary_id, self.src_lang_id, self.dst_lang_id)\
+            .annotate(user_due_at=Subquery(user_stats.values('due_at')[:1]))\
+            .values_list('id', 'user_due_at')
+
+        scores = {phrase_id: self.score(due_at) for phrase_id, due_at in rows}
+        ids = list(scores.keys())
+
+        pipe = get_redis().pipeline()
+        pipe.delete(self.key)
+        for i in range(0, len(ids), ZADD_CHUNK_SIZE):
+            pipe.zadd(self.key, {phrase_id: scores[phrase_id] for phrase_id in ids[i:i + ZADD_CHUNK_SIZE]})
+        pipe.expire(self.key, settings.TRAINING_QUEUE_TTL)
+        pipe.set(self.version_key, content_version, ex=settings.TRAINING_QUEUE_TTL)
+        pipe.execute()
+        return len(ids)
+
+    def next(self, exclude_ids: List[int]) -> Optional[int]:
+        """
+        первая фраза очереди не из exclude_ids (буфера последних фраз),
+        если таких нет - самая давняя фраза из буфера
+        """
+        members = [int(i) for i in get_redis().zrange(self.key, 0, len(exclude_ids))]
+        for phrase_id in members:
+            if phrase_id not in exclude_ids:
+                return phrase_id
+
+        if members:
+            return max(members, key=exclude_ids.index)
+        return None
+
+    def rescore(self, phrase_id: int, due_at: Optional[datetime], redis=None):
+        """обновляет позицию фразы в очереди, если та существует"""
+        (redis or get_redis()).zadd(self.key, {phrase_id: self.score(due_at)}, xx=True)
+
+    def remove(self, phrase_id: int):
+        """убирает из очереди фразу, удалённую из словаря после построения очереди"""
+        get_redis().zrem(self.key, phrase_id)
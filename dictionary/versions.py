@@ -0,0 +1,60 @@
+"""
+Версии данных для кэширования производных от них (отрендеренных ответов бота и т.п.).
+
+Версия содержимого словаря меняется при изменении его сводки (фразы, группы, см. DictionarySummary),
+связей его групп (см. dictionary.access) и самого словаря, версия статистики юзера - при изменении его прогресса (DictionaryUserProgress).
+Версия словарей фразы (группы фраз) - при изменении её связей с группами (словарями), см. dictionary.access.
+Версия - случайный токен в redis, сброс версии - удаление ключа: новый токен создаётся при следующем чтении,
+так что ключи, построенные на старой версии, больше не совпадут (даже если ключ версии вытеснен из redis).
+"""
+import uuid
+from typing import Dict, Iterable, List
+
+from django.core.cache import cache
+from django.db import transaction
+
+CONTENT_VERSION_KEY = 'dictionary:{}:content_version'
+STATS_VERSION_KEY = 'dictionary:user:{}:stats_version'
+DICTIONARIES_VERSION_KEY = 'dictionary:{}:{}:dictionaries_version'  # модель (phrase, phrasegroup), id
+
+
+def get_versions(keys: List[str]) -> Dict[str, str]:
+    """текущие версии по ключам, одним запросом к redis (недостающие создаются)"""
+    versions = cache.get_many(keys)
+    for key in keys:
+        if key not in versions:
+            version = uuid.uuid4().hex
+            if not cache.add(key, version, timeout=None):
+                version = cache.get(key) or version
+            versions[key] = version
+    return versions
+
+
+def bump(keys: Iterable[str]):
+    keys = list(keys)
+    if keys:
+        transaction.on_commit(lambda: cache.delete_many(keys))
+
+
+def bump_content(dictionary_ids: Iterable[int]):
+    bump(CONTENT_VERSION_KEY.format(dictionary_id) for dictionary_id in dictionary_ids)
+
+
+def bump_stats(user_ids: Iterable[int]):
+    bump(STATS_VERSION_KEY.format(user_id) for user_id in user_ids)
+
+
+def bump_dictionaries(phrase_ids: Iterable[int] = (), group_ids: Iterable[int] = ()):
+    bump([DICTIONARIES_VERSION_KEY.format('phrase', phrase_id) for phrase_id in phrase_ids] +
+         [DICTIONARIES_VERSION_KEY.format('phrasegroup', group_id) for group_id in group_ids])
+
+
+def summary_saved(sender, instance, **kwargs):
+    """обработчик post_save DictionarySummary (изменение счётчиков фраз и групп)"""
+    bump_content([instance.dictionary_id])
+
+
+def dictionary_saved(sender, instance, **kwargs):
+    """обработчик post_save Dictionary (переименование)"""
+    bump_content([instance.id])
+
@@ -222,12 +222,61 @@ if configure('sentry', False):
 BOT = {
     'TOKEN': configure('bot.token'),
     'THREADED': configure('bot.threaded', False, coerce_type=bool),
+    # >1: обновления обрабатываются в WORKERS потоках с сохранением порядка внутри чата (см. bot.dispatcher),
+    # вместо THREADED
+    'WORKERS': configure('bot.workers', 1, coerce_type=int),
+    'WORKER_QUEUE_SIZE': configure('bot.worker_queue_size', 100, coerce_type=int),
+    'METRICS_INTERVAL': 300,     # сек, как часто печатать метрики обработки обновлений
+    # asyncio-рантайм (см. bot.aio, требует aiohttp: poetry install -E async), вместо THREADED и WORKERS
+    'ASYNC': configure('bot.async', False, coerce_type=bool),
+    'ASYNC_WORKERS': configure('bot.async_workers', 8, coerce_type=int),  # потоков для обработчиков (ORM)
+    'ASYNC_CONCURRENCY': 100,    # обновлений в обработке одновременно
+    'HTTP_POOL_SIZE': 50,    # соединений с Bot API
+    # ограничения скорости отправки сообщений (см. bot.outbox), сообщений в сек
+    'SEND_GLOBAL_RATE': configure('bot.send_global_rate', 25, coerce_type=float),
+    'SEND_CHAT_RATE': configure('bot.send_chat_rate', 1, coerce_type=float),
+    'SEND_CHAT_BURST': 3,    # сообщений в чат подряд без ожидания
+    'SEND_WORKERS': configure('bot.send_workers', 8, coerce_type=int),  # потоков, отправляющих сообщения
     'PROXY': {
         'http': configure('bot.proxy.http'),
         'https': configure('bot.proxy.https'),
-    }
+    },
+    # адреса Bot API (для локального тестового сервера), по умолчанию api.telegram.org
+    'API_URL': configure('bot.api_url', None),   # 'http://host/bot{0}/{1}'
+    'FILE_URL': configure('bot.file_url', None),     # 'http://host/file/bot{0}/{1}'
+    # режим webhook: обновления принимает web-сервис (см. bot.views.webhook, ./manage.py set_webhook)
+    'WEBHOOK_URL': configure('bot.webhook.url', None),
+    'WEBHOOK_SECRET': configure('bot.webhook.secret', None),
+    'WEBHOOK_UPDATE_TTL': 24 * 3600,     # столько telegram хранит недоставленные обновления
 }
+# буферизованная запись лога ответов (см. bot.logbuffer)
+LOG_FLUSH_BATCH = configure('bot.log_flush_batch', 200, coerce_type=int)
+LOG_FLUSH_INTERVAL = configure('bot.log_flush_interval', 1, coerce_type=float)    # сек
+LOG_BUFFER_SIZE = configure('bot.log_buffer_size', 10000, coerce_type=int)
+# кэш юзеров бота по id чата (см. bot.usercache)
+USER_CACHE_SIZE = configure('bot.user_cache_size', 10000, coerce_type=int)
+USER_CACHE_TIMEOUT = 24 * 3600
+# срок хранения лога (./manage.py prune_logs, см. bot.partitions)
+LOG_RETENTION_DAYS = configure('bot.log_retention_days', 365, coerce_type=int)
+LOG_PARTITIONS_AHEAD = 2    # мес., на сколько вперёд создавать партиции лога
 
 # dictionary
 RECENT_PHRASES = configure('dictionary.recent_phrases', 40, coerce_type=int)
+RECENT_PHRASES_TTL = configure('dictionary.recent_phrases_ttl', 7 * 24 * 3600, coerce_type=int)
+TRAINING_QUEUE_TTL = configure('dictionary.training_queue_ttl', 24 * 3600, coerce_type=int)
+STATS_FLUSH_INTERVAL = configure('dictionary.stats_flush_interval', 5, coerce_type=int)
+STATS_FLUSH_LOCK_TIMEOUT = 60
+STATS_FLUSH_BATCHES_KEEP_DAYS = 7   # сколько хранить id применённых пачек статистики, см. dictionary.stats.flush
 DICT_CONTENTS_PAGE_SIZE = 10
+DICT_LIST_PAGE_SIZE = 6
+DICT_LIST_CACHE_TIMEOUT = 24 * 3600     # клавиатуры списка словарей, см. bot.responses.dict_list_keyboard
+RENDER_CACHE_TIMEOUT = 24 * 3600    # отрендеренные ответы (карточка словаря), см. bot.responses.cached_response
+RENDER_CACHE_LOCK_TIMEOUT = 10
+PREFIX_INDEX_CACHE_SIZE = configure('dictionary.prefix_index_cache_size', 1000, coerce_type=int)
+INLINE_QUERY_RESULTS_LIMIT = 20
+LANGUAGES_CHECK_INTERVAL = 60  # сек, см. dictionary.languages
+IMPORT_BATCH_SIZE = configure('dictionary.import_batch_size', 1000, coerce_type=int)
+IMPORT_PROGRESS_INTERVAL = 2  # сек, не чаще редактируем сообщение о ходе импорта
+IMPORT_MAX_FILE_SIZE = 20 * 1024 * 1024     # ограничение Bot API на скачивание файлов
+ACCESS_CACHE_SIZE = configure('dictionary.access_cache_size', 10000, coerce_type=int)  # см. dictionary.access
+ACCESS_CACHE_TIMEOUT = 24 * 3600
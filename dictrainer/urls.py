@@ -16,6 +16,9 @@ Including another URLconf
 from django.contrib import admin
 from django.urls import path
 
+from bot import views as bot_views
+
 urlpatterns = [
     path('admin/', admin.site.urls),
+    path('bot/webhook/', bot_views.webhook, name='bot_webhook'),
 ]